@@ -1,10 +1,27 @@
 from fastapi import FastAPI
-from constants import CONNECTION_STRING
-from pymongo import MongoClient, errors
+from constants import KNOWLEDGE_BASE_SYNC, UNANSWERED_TRACKING
+from pymongo import errors
 import logging
-from utils.databse_schema import check_and_create_db_schema
+from utils.databse_schema import schema_bootstrap
+from utils.retriever import get_retriever
+from utils.unanswered import unanswered_recorder
+from utils.chat_log import chat_log_writer
+from utils.index_maintenance import index_scheduler
+from utils.knowledge_base_sync import knowledge_base_sync
+from utils.mongo_client import mongo_manager, close_mongo_clients
+from utils.conversation_memory import wait_for_summaries
 
-from routers import home, chat, get_chat_logs, review_chat, delete_docs, add_context
+from routers import (
+    home,
+    chat,
+    get_chat_logs,
+    review_chat,
+    delete_docs,
+    add_context,
+    metrics,
+    health,
+    get_unanswered_questions,
+)
 
 # Initialize FastAPI app
 app = FastAPI()
@@ -12,15 +29,29 @@ app = FastAPI()
 
 @app.on_event("startup")
 async def startup_event():
-    """Establish database connection on app startup."""
+    """Set the database up in the background so health checks are served right away."""
     global client
+    logging.basicConfig(level=logging.INFO)
     try:
-        logging.info("Connecting to MongoDB cluster for logging chat")
-        client = MongoClient(CONNECTION_STRING)
-        logging.info("Successfully connected to MongoDB cluster.")
+        # the client shared with the routers, it connects in the background
+        client = mongo_manager.client()
 
-        # check for database Schema and create if not exists
-        check_and_create_db_schema(client)
+        # write the chat logs in batches in the background
+        chat_log_writer.start(client)
+
+        # update the search indexes marked dirty by the routes in the background
+        index_scheduler.start(client)
+
+        # check for database Schema and create if not exists, then load the knowledge
+        # base into the retrieval backend and start clustering and flushing unanswered
+        # questions, /ready reports when this is done. The changes made by the other
+        # workers are watched from before the load, so none is missed.
+        steps = [get_retriever().warm_up]
+        if KNOWLEDGE_BASE_SYNC:
+            steps.insert(0, knowledge_base_sync.start)
+        if UNANSWERED_TRACKING == "lsh":
+            steps.append(unanswered_recorder.start)
+        schema_bootstrap.start(client, steps)
     except errors.PyMongoError as e:
         logging.error(f"Failed to connect to MongoDB during startup: {e}")
         client = None
@@ -30,10 +61,19 @@ async def startup_event():
 async def shutdown_event():
     """Close database connection on app shutdown."""
     global client
+    # let the conversation summaries being generated reach the session store
+    await wait_for_summaries()
+    # write the queued chat logs before closing the connection, they are spilled to
+    # disk if there is no connection
+    chat_log_writer.stop()
     if client:
-        client.close()
-        logging.info("MongoDB connection closed.")
+        # write the pending unanswered questions before closing the connection
+        unanswered_recorder.stop()
+        # run the index updates still pending
+        index_scheduler.stop()
+        knowledge_base_sync.stop()
         client = None
+    close_mongo_clients()
 
 
 # include home router
@@ -53,3 +93,12 @@ app.include_router(review_chat.router)
 
 # include the delete_docs router
 app.include_router(delete_docs.router)
+
+# include the get_unanswered_questions router
+app.include_router(get_unanswered_questions.router)
+
+# include the metrics router
+app.include_router(metrics.router)
+
+# include the health and readiness router
+app.include_router(health.router)
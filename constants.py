@@ -18,25 +18,213 @@ GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 # Error codes
 ERROR_CODE_CONNECTION_FAILED = "ERR_CONNECTION_FAILED"
 
-# uncomment the model you want to use
-# GROQ Model
-# MODEL = "llama-3.3-70b-versatile"
+# MODEL TEMPERATURE
+MODEL_TEMPERATURE = 0
 
-# OPENAI Model
-# MODEL = "gpt-4o-mini"
+# Chat model providers of the LLM router, in order of preference
+# Only the providers with an API key are used ("fake" ones need none, for testing)
+# concurrency: maximum number of simultaneous calls to the provider
+# rate_limit: maximum number of calls per second, None for no limit
+LLM_PROVIDERS = [
+    {
+        "name": "groq",
+        "kind": "groq",
+        "model": "llama-3.3-70b-versatile",
+        "concurrency": 16,
+        "rate_limit": 0.5,
+    },
+    {
+        "name": "openai",
+        "kind": "openai",
+        "model": "gpt-4o-mini",
+        "concurrency": 32,
+        "rate_limit": None,
+    },
+    {
+        "name": "google",
+        "kind": "google",
+        "model": "gemini-2.0-flash",
+        "concurrency": 32,
+        "rate_limit": None,
+    },
+]
+# Seconds before a provider call is abandoned and the next provider is tried, for streams
+# the longest wait for the first chunk and between two chunks
+LLM_TIMEOUT = 30
+# Send a second request to another provider when the first one is slower than the
+# provider's LLM_HEDGE_PERCENTILE latency, but at least LLM_HEDGE_MIN_DELAY seconds
+LLM_HEDGE_ENABLED = True
+LLM_HEDGE_PERCENTILE = 0.95
+LLM_HEDGE_MIN_DELAY = 1.0
+# Weight of the latest latency in the moving average used to rank the providers
+LLM_EWMA_ALPHA = 0.2
+# Seconds a provider is skipped after failing repeatedly
+LLM_FAILURE_COOLDOWN = 30
 
-# GEMINI Model
-MODEL = "gemini-2.0-flash"
+# Languages of the knowledge base
+SUPPORTED_LANGUAGES = ["en", "hu", "de"]
 
-# MODEL TEMPERATURE
-MODEL_TEMPERATURE = 0
+# How the missing languages of a new question are translated
+# "structured": question and answer together, one JSON returning LLM call per language
+# "text": question and answer with separate LLM calls
+TRANSLATION_MODE = "structured"
+# Maximum number of concurrent translation calls
+TRANSLATION_CONCURRENCY = 8
+# Retries of a failed translation call, waiting TRANSLATION_RETRY_DELAY seconds doubled
+# after every attempt
+TRANSLATION_RETRIES = 2
+TRANSLATION_RETRY_DELAY = 0.5
+
+# Rows of a bulk upload translated concurrently and inserted together
+BULK_INGEST_BATCH_SIZE = 50
+
+# Cache of translations, keyed by the source text, the languages and the models
+TRANSLATION_CACHE_ENABLED = True
+TRANSLATION_CACHE_SIZE = 10000
+# Also keep the translations in the translation cache collection, shared by all workers
+TRANSLATION_CACHE_PERSISTENT = True
+
+# Questions detected below this confidence search all languages
+LANGUAGE_DETECTION_MIN_CONFIDENCE = 0.8
+
+# Where the conversation history of the chat sessions is kept
+# "memory": in process, not shared between uvicorn workers
+# "mongo": in the sessions collection, shared by all workers
+# "file": in local JSON files, shared by the workers of one host
+SESSION_STORE = "memory"
+# How the conversation history is sent to the LLM
+# "window": the last SESSION_HISTORY_WINDOW exchanges
+# "summary": the latest messages fitting in SESSION_HISTORY_TOKEN_BUDGET, older ones
+#   are folded into a running summary generated in the background
+SESSION_MEMORY = "window"
+# Number of past question and answer exchanges sent to the LLM
+SESSION_HISTORY_WINDOW = 5
+SESSION_HISTORY_TOKEN_BUDGET = 600
+SESSION_SUMMARY_MAX_WORDS = 150
+# Messages kept in "summary" mode if the summaries fall behind
+SESSION_MAX_MESSAGES = 40
+SESSION_TTL = 3600  # seconds since the last exchange
+# Maximum size of the text kept by the "memory" store
+SESSION_MAX_BYTES = 64 * 1024 * 1024
+SESSION_FILE_DIRECTORY = "sessions"
+
+# MongoDB connections of a process, split between the pools of its two drivers
+MONGO_MAX_POOL_SIZE = 100
+# The sync driver serves the sync routes, run in the threadpool (40 threads by default),
+# and the background threads: chat log writer, unanswered question recorder, index
+# maintenance and knowledge base sync
+MONGO_SYNC_MAX_POOL_SIZE = 36
+# The asyncio driver serves the async routes, which DB_CONCURRENCY_LIMIT keeps within it
+MONGO_ASYNC_MAX_POOL_SIZE = MONGO_MAX_POOL_SIZE - MONGO_SYNC_MAX_POOL_SIZE
+MONGO_MIN_POOL_SIZE = 0
+MONGO_CONNECT_TIMEOUT = 5  # seconds
+# Seconds an operation waits for a reachable server
+MONGO_SERVER_SELECTION_TIMEOUT = 5
+MONGO_SOCKET_TIMEOUT = 30  # seconds
+# Seconds an operation waits for a free connection of the pool
+MONGO_WAIT_QUEUE_TIMEOUT = 5
+# Seconds between the background heartbeats checking the servers
+MONGO_HEARTBEAT_INTERVAL = 10
+
+# Atlas Search index updates requested by the routes are run in the background
+# seconds without a new change before a dirty index is updated, coalescing a burst
+INDEX_UPDATE_DELAY = 2
+# seconds after the first change of a burst when the index is updated anyway
+INDEX_UPDATE_MAX_DELAY = 30
+# minimum seconds between two updates of the same index
+INDEX_UPDATE_INTERVAL = 60
+INDEX_MAINTENANCE_POLL_INTERVAL = 1  # seconds
+
+# Startup schema setup, running in the background
+# seconds between checks of the search indexes being built
+SCHEMA_POLL_INTERVAL = 1
+# seconds the search indexes are waited for before reporting ready anyway
+SCHEMA_SEARCH_INDEX_TIMEOUT = 120
+# seconds before retrying a failed setup, e.g. while the database is not reachable
+SCHEMA_RETRY_INTERVAL = 5
 
-# Maximum number of chats to store for different users
-MAX_CONTEXTS = 5
+# Maximum number of concurrent LLM calls and database operations of the async routes
+LLM_CONCURRENCY_LIMIT = 32
+# the database operations wait here rather than for a connection of the pool
+DB_CONCURRENCY_LIMIT = MONGO_ASYNC_MAX_POOL_SIZE
 
 # Score thresholds
 SCORE_THRESHOLD_MULTILINGUAL = 1.5
 SCORE_THRESHOLD_UNANSWERED = 0.2
+# Minimum character n-gram cosine similarity accepted by the hybrid backend
+SCORE_THRESHOLD_SIMILARITY = 0.6
+# First questions of a conversation matching a knowledge base question above the
+# threshold of the retrieval backend are answered with its stored answer, without the
+# LLM. Opt-in, it changes the answers of /chat.
+FAST_PATH_ENABLED = False
+# The thresholds are BM25 scores: Atlas Search and "bm25" both use the Lucene BM25
+# formula, "hybrid" passages carry the BM25 score of their lexical match, never the
+# fused RRF score. Backends missing here never take the fast path.
+SCORE_THRESHOLD_FAST_PATH = {"atlas": 4.0, "bm25": 4.0, "hybrid": 4.0}
+
+# Retrieval backend used to search the knowledge base
+# "atlas": Atlas Search `$search` aggregation
+# "bm25": in-process BM25 index built from the collections at startup
+# "hybrid": "bm25" fused with character n-gram TF-IDF vectors
+RETRIEVAL_BACKEND = "atlas"
+
+# Look up the knowledge base and the unanswered questions in a single query
+# and record misses with an upsert. Only used with UNANSWERED_TRACKING = "search",
+# "lsh" never looks the unanswered questions up, its lookup is already one query
+COMBINED_RETRIEVAL = True
+
+# Number of knowledge base candidates fetched per question before reranking
+RETRIEVAL_TOP_K = 5
+
+# Reranking of the candidates into LLM context passages
+# weight of the normalized retrieval score against the question term overlap
+RERANK_RETRIEVAL_WEIGHT = 0.5
+# passages scoring below this fraction of the best passage are dropped
+RERANK_MIN_RELATIVE_SCORE = 0.6
+CONTEXT_MAX_PASSAGES = 3
+CONTEXT_TOKEN_BUDGET = 1000
+
+# How misses are recorded in the unanswered questions collection
+# "lsh": clustered in process with MinHash/LSH and flushed in batches in the background
+# "search": searched in the collection and inserted on the request path
+UNANSWERED_TRACKING = "lsh"
+# Minimum estimated Jaccard similarity for a miss to join an existing cluster
+UNANSWERED_SIMILARITY_THRESHOLD = 0.5
+UNANSWERED_FLUSH_INTERVAL = 5  # seconds
+UNANSWERED_MAX_SAMPLES = 5
+
+# Apply the knowledge base changes made by the other uvicorn workers to the local
+# retrieval backend and caches of every worker, from a change stream or, where change
+# streams are not supported, by reloading them every KNOWLEDGE_BASE_RESYNC_INTERVAL
+KNOWLEDGE_BASE_SYNC = True
+KNOWLEDGE_BASE_RESYNC_INTERVAL = 30  # seconds
+
+# Cache of knowledge base hits in front of the retrieval backend
+RETRIEVAL_CACHE_SIZE = 1024
+RETRIEVAL_CACHE_TTL = 600  # seconds
+
+# Cache of generated answers, only sensible with a MODEL_TEMPERATURE of 0
+RESPONSE_CACHE_ENABLED = True
+RESPONSE_CACHE_SIZE = 4096
+RESPONSE_CACHE_TTL = 86400  # seconds
+# Also keep the answers in the response cache collection, shared by all workers
+RESPONSE_CACHE_PERSISTENT = False
+
+# Maximum number of questions of a /chat/batch request and of its answers generated
+# at the same time
+CHAT_BATCH_MAX_SIZE = 500
+CHAT_BATCH_CONCURRENCY = 8
+
+# Chat logs are queued and written in batches by a background thread
+CHAT_LOG_QUEUE_SIZE = 10000
+CHAT_LOG_BATCH_SIZE = 500
+CHAT_LOG_FLUSH_INTERVAL = 1  # seconds
+# Logs that can't be queued or written are kept in this file until they are written,
+# every process appends its pid to the name, e.g. chat_logs_spill.<pid>.jsonl
+CHAT_LOG_SPILL_FILE = "chat_logs_spill.jsonl"
+# /rate_chat answers 503 (retry) instead of 404 for the unknown logs younger than this,
+# they can still be queued or spilled by another worker
+CHAT_LOG_RETRY_WINDOW = 60  # seconds
 
 # DB Constants
 DB_NAME = "RAG-index"
@@ -44,6 +232,9 @@ CHAT_LOGS_COLLECTION = "Chat-Logs"
 MULTILINGUAL_QUESTIONS_COLLECTION = "Multilingual-Questions"
 UNANSWERED_QUESTIONS_COLLECTION = "Unanswered-Questions"
 REVIEW_QUESTIONS_COLLECTION = "Review-Questions"
+SESSIONS_COLLECTION = "Chat-Sessions"
+RESPONSE_CACHE_COLLECTION = "Response-Cache"
+TRANSLATION_CACHE_COLLECTION = "Translation-Cache"
 
 # DB Indexes
 MULTILINGUAL_QUESTIONS_INDEX = "multilingual_questions_index"
@@ -1,11 +1,18 @@
-from fastapi import APIRouter, Depends, HTTPException
-from pymongo import MongoClient
+from fastapi import APIRouter, Depends, HTTPException, Query, Request
+from motor.motor_asyncio import AsyncIOMotorClient
+from bson import ObjectId
 from datetime import datetime
+from pymongo import DeleteMany, UpdateOne
+from typing import Optional
 
-from utils.mongo_client import get_mongo_client
+from utils.mongo_client import get_async_mongo_client
 from utils.base_models import MultilingualQuestionRequest
 from utils.translation import translate_to_all_languages
-from utils.databse_schema import update_index
+from utils.index_maintenance import index_scheduler
+from utils.concurrency import db_limiter
+from utils.get_context import on_documents_added, on_document_removed
+from utils.response_cache import response_cache
+from utils.ingestion import build_documents, ingest_rows, iter_csv_rows, iter_jsonl_rows
 from constants import *
 
 router = APIRouter()
@@ -22,7 +29,10 @@ router = APIRouter()
                 "application/json": {
                     "example": {
                         "detail": "Multilingual question created successfully.",
-                        "id": "generated_id",
+                        "group_id": "677ec97711172d691541fa4b",
+                        "en_id": "677ec97711172d691541fa4c",
+                        "hu_id": "677ec97711172d691541fa4d",
+                        "de_id": "677ec97711172d691541fa4e",
                     }
                 }
             },
@@ -48,9 +58,9 @@ router = APIRouter()
     },
     tags=["Multilingual Questions"],
 )
-def create_multilingual_question(
+async def create_multilingual_question(
     request: MultilingualQuestionRequest,
-    client: MongoClient = Depends(get_mongo_client),
+    client: AsyncIOMotorClient = Depends(get_async_mongo_client),
 ):
     try:
         # Validate that at least one language pair is provided
@@ -63,45 +73,310 @@ def create_multilingual_question(
         multilingual_questions = db[MULTILINGUAL_QUESTIONS_COLLECTION]
 
         # Prepare data for translation
-        data = request.dict()
-        translations = translate_to_all_languages(data)
-
-        # Prepare the document to insert
-        document_en = {
-            "question": translations.get("en_question"),
-            "answer": translations.get("en_answer"),
-            "references": request.references or [],
-            "timestamp": datetime.utcnow(),
-        }
+        data = request.model_dump()
+        translations = await translate_to_all_languages(data)
 
-        document_hu = {
-            "question": translations.get("hu_question"),
-            "answer": translations.get("hu_answer"),
-            "references": request.references or [],
-            "timestamp": datetime.utcnow(),
-        }
+        # Prepare the documents to insert, one per language linked by a group_id
+        documents = build_documents(translations, request.references)
 
-        document_de = {
-            "question": translations.get("de_question"),
-            "answer": translations.get("de_answer"),
-            "references": request.references or [],
-            "timestamp": datetime.utcnow(),
-        }
+        async with db_limiter.acquire():
+            await multilingual_questions.insert_many(documents)
 
-        inserted_en = multilingual_questions.insert_one(document_en)
-        inserted_hu = multilingual_questions.insert_one(document_hu)
-        inserted_de = multilingual_questions.insert_one(document_de)
+        # keep the retrieval backend and cache in sync with the collection
+        on_documents_added(MULTILINGUAL_QUESTIONS_COLLECTION, documents)
 
-        # update the index of the collection
-        update_index(multilingual_questions, MULTILINGUAL_QUESTIONS_INDEX)
+        # update the index of the collection in the background
+        index_scheduler.mark_dirty(
+            MULTILINGUAL_QUESTIONS_COLLECTION, MULTILINGUAL_QUESTIONS_INDEX
+        )
 
         return {
             "detail": "Multilingual question created successfully.",
-            "en_id": str(inserted_en.inserted_id),
-            "hu_id": str(inserted_hu.inserted_id),
-            "de_id": str(inserted_de.inserted_id),
+            "group_id": str(documents[0]["group_id"]),
+            **{
+                f"{document['lang']}_id": str(document["_id"])
+                for document in documents
+            },
         }
     except Exception as e:
         raise HTTPException(
             status_code=500, detail="Failed to create multilingual question."
         ) from e
+
+
+@router.post(
+    "/add_multilingual_questions/bulk",
+    summary="Create multilingual questions from an uploaded file",
+    description=(
+        "Accepts a JSON lines or CSV file as the raw request body, with one question per row and the fields of "
+        "`/add_multilingual_question` (`question_en`, `answer_en`, `question_hu`, `answer_hu`, `question_de`, "
+        "`answer_de`, `references`). CSV files need a header row and hold the references as whitespace "
+        "separated URLs. The format is taken from the `format` parameter, or else from the `Content-Type` "
+        "header (`text/csv`, otherwise JSON lines). The file is read as it is uploaded and ingested in "
+        "batches: the rows of a batch are translated concurrently and inserted together, and the search index "
+        "is updated once at the end. Rows that can't be ingested are listed in `errors` with their row number, "
+        "counted without the CSV header and blank lines. The languages of a row are inserted all or none: when "
+        "one of them fails, the others are deleted again. If that fails too, the error lists the `inserted` ids, or "
+        "the `group_id` when the insert failed without telling which languages were written."
+    ),
+    responses={
+        200: {
+            "description": "The upload was processed, see `errors` for the rows that were not inserted.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Bulk upload processed.",
+                        "rows": 5000,
+                        "inserted_rows": 4998,
+                        "inserted_documents": 14994,
+                        "errors": [
+                            {
+                                "row": 17,
+                                "error": "At least one pair of question and answer must be provided in the same language.",
+                            },
+                            {"row": 2311, "error": "Translation failed."},
+                        ],
+                    }
+                }
+            },
+        },
+        400: {
+            "description": "Unsupported format.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Unsupported format, use jsonl or csv."}
+                }
+            },
+        },
+        500: {
+            "description": "Internal server error.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Failed to process the bulk upload."}
+                }
+            },
+        },
+    },
+    tags=["Multilingual Questions"],
+)
+async def create_multilingual_questions_bulk(
+    request: Request,
+    format: Optional[str] = Query(None, description="jsonl or csv"),
+    client: AsyncIOMotorClient = Depends(get_async_mongo_client),
+):
+    if format is None:
+        content_type = request.headers.get("content-type", "")
+        format = "csv" if "csv" in content_type else "jsonl"
+    if format not in ("jsonl", "csv"):
+        raise HTTPException(
+            status_code=400, detail="Unsupported format, use jsonl or csv."
+        )
+
+    parse_rows = iter_csv_rows if format == "csv" else iter_jsonl_rows
+    try:
+        report = await ingest_rows(parse_rows(request.stream()), client)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail="Failed to process the bulk upload."
+        ) from e
+    finally:
+        # one index update for the whole upload, also for what was inserted before a failure
+        index_scheduler.mark_dirty(
+            MULTILINGUAL_QUESTIONS_COLLECTION, MULTILINGUAL_QUESTIONS_INDEX
+        )
+
+    return {"detail": "Bulk upload processed.", **report}
+
+
+def parse_group_id(group_id):
+    if not ObjectId.is_valid(group_id):
+        raise HTTPException(status_code=400, detail="Invalid group id.")
+    return ObjectId(group_id)
+
+
+@router.get(
+    "/multilingual_questions/group/{group_id}",
+    summary="Get the language variants of a multilingual question",
+    description="Returns the documents of every language of the multilingual question group `group_id`.",
+    responses={
+        200: {
+            "description": "The documents of the group.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "group_id": "677ec97711172d691541fa4b",
+                        "questions": [
+                            {
+                                "id": "677ec97711172d691541fa4c",
+                                "lang": "en",
+                                "question": "What is the significance of roles?",
+                                "answer": "The significance of roles is that they align with later developed regulations...",
+                                "references": ["https://example.com/roles"],
+                            }
+                        ],
+                    }
+                }
+            },
+        },
+        400: {
+            "description": "Invalid group id.",
+            "content": {
+                "application/json": {"example": {"detail": "Invalid group id."}}
+            },
+        },
+        404: {
+            "description": "Multilingual question group not found.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Multilingual question group not found."}
+                }
+            },
+        },
+    },
+    tags=["Multilingual Questions"],
+)
+async def get_multilingual_question_group(
+    group_id: str,
+    client: AsyncIOMotorClient = Depends(get_async_mongo_client),
+):
+    group = parse_group_id(group_id)
+    multilingual_questions = client[DB_NAME][MULTILINGUAL_QUESTIONS_COLLECTION]
+    async with db_limiter.acquire():
+        documents = await multilingual_questions.find({"group_id": group}).to_list(
+            length=None
+        )
+    if not documents:
+        raise HTTPException(
+            status_code=404, detail="Multilingual question group not found."
+        )
+
+    return {
+        "group_id": group_id,
+        "questions": [
+            {
+                "id": str(document["_id"]),
+                "lang": document.get("lang"),
+                "question": document.get("question"),
+                "answer": document.get("answer"),
+                "references": document.get("references", []),
+            }
+            for document in documents
+        ],
+    }
+
+
+@router.put(
+    "/multilingual_questions/group/{group_id}",
+    summary="Update a multilingual question",
+    description=(
+        "Replaces every language variant of the multilingual question group `group_id` with one bulk write. "
+        "Like `/add_multilingual_question`, the missing languages are translated from a provided question and "
+        "answer pair. The variants keep their IDs and creation `timestamp` and get an `updated_at`, variants "
+        "of languages no longer supported are deleted, and the answers cached from the old ones are dropped."
+    ),
+    responses={
+        200: {
+            "description": "Multilingual question updated successfully.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Multilingual question updated successfully.",
+                        "group_id": "677ec97711172d691541fa4b",
+                    }
+                }
+            },
+        },
+        400: {
+            "description": "Invalid input.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "At least one pair of question and answer must be provided in the same language."
+                    }
+                }
+            },
+        },
+        404: {
+            "description": "Multilingual question group not found.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Multilingual question group not found."}
+                }
+            },
+        },
+        500: {
+            "description": "Internal server error.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Failed to update multilingual question."}
+                }
+            },
+        },
+    },
+    tags=["Multilingual Questions"],
+)
+async def update_multilingual_question_group(
+    group_id: str,
+    request: MultilingualQuestionRequest,
+    client: AsyncIOMotorClient = Depends(get_async_mongo_client),
+):
+    group = parse_group_id(group_id)
+    try:
+        request.validate_languages()
+    except ValueError as ve:
+        raise HTTPException(status_code=400, detail=str(ve))
+
+    multilingual_questions = client[DB_NAME][MULTILINGUAL_QUESTIONS_COLLECTION]
+    async with db_limiter.acquire():
+        old_documents = await multilingual_questions.find(
+            {"group_id": group}, {"_id": 1, "lang": 1}
+        ).to_list(length=None)
+    if not old_documents:
+        raise HTTPException(
+            status_code=404, detail="Multilingual question group not found."
+        )
+
+    try:
+        translations = await translate_to_all_languages(request.model_dump())
+        documents = build_documents(translations, request.references, group)
+        now = datetime.utcnow()
+        operations = []
+        for document in documents:
+            # the creation time of an existing variant is kept
+            timestamp = document.pop("timestamp")
+            document["updated_at"] = now
+            operations.append(
+                UpdateOne(
+                    {"group_id": group, "lang": document["lang"]},
+                    {"$set": document, "$setOnInsert": {"timestamp": timestamp}},
+                    upsert=True,
+                )
+            )
+        # the variants the request no longer yields
+        operations.append(
+            DeleteMany({"group_id": group, "lang": {"$nin": SUPPORTED_LANGUAGES}})
+        )
+
+        async with db_limiter.acquire():
+            result = await multilingual_questions.bulk_write(operations)
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail="Failed to update multilingual question."
+        ) from e
+
+    # drop the old variants from the retrieval backend and the caches, then add the new ones
+    old_ids = [document["_id"] for document in old_documents]
+    for doc_id in old_ids:
+        on_document_removed(MULTILINGUAL_QUESTIONS_COLLECTION, doc_id)
+    await response_cache.ainvalidate_documents(old_ids)
+    # the replaced documents keep their _id, the missing languages get a new one
+    ids = {document.get("lang"): document["_id"] for document in old_documents}
+    for index, document in enumerate(documents):
+        document["_id"] = result.upserted_ids.get(index) or ids[document["lang"]]
+    on_documents_added(MULTILINGUAL_QUESTIONS_COLLECTION, documents)
+
+    index_scheduler.mark_dirty(
+        MULTILINGUAL_QUESTIONS_COLLECTION, MULTILINGUAL_QUESTIONS_INDEX
+    )
+
+    return {"detail": "Multilingual question updated successfully.", "group_id": group_id}
@@ -1,57 +1,228 @@
 from fastapi import APIRouter, Depends, HTTPException
-from pymongo import MongoClient
+from fastapi.responses import StreamingResponse
+from motor.motor_asyncio import AsyncIOMotorClient
+from typing import List
+import asyncio
+import json
+import logging
+import time
 import uuid
 
-from utils.mongo_client import get_mongo_client
-from utils.base_models import ChatRequest, ChatResponse
-from utils import chat_log
+from utils.mongo_client import get_async_mongo_client
+from utils.base_models import ChatRequest, ChatResponse, ChatBatchItem
 
-from langchain.chains import LLMChain
-from langchain_core.prompts import (
-    ChatPromptTemplate,
-    HumanMessagePromptTemplate,
-    MessagesPlaceholder,
+from utils.chat_engine import ChatEngine
+from utils.llm_router import llm_router, LLMUnavailableError
+from utils.chat_log import chat_log_writer
+from utils.get_context import (
+    afind_passages_in_knowledge_base,
+    afind_passages_batch,
+    afind_group_answer,
 )
-from langchain_core.messages import SystemMessage
-from langchain.chains.conversation.memory import ConversationBufferWindowMemory
-from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
-from langchain_google_genai import ChatGoogleGenerativeAI
-from pymongo import MongoClient
-from utils.chat_log import chat_log
-from utils.get_context import find_answer_in_knowledge_base
-from utils.databse_schema import update_index
+from utils.language import detect_language
+from utils.metrics import get_counter, increment, observe, register_metrics, timer
+from utils.tokens import count_tokens
+from utils.index_maintenance import index_scheduler
+from utils.retriever import get_retriever
+from utils.concurrency import llm_limiter
+from utils.session_store import session_store, new_session
+from utils.conversation_memory import prompt_history, remember
+from utils.response_cache import response_cache, response_cache_key
+from utils.singleflight import SingleFlight
 
 from constants import *
 
 # Router instance
 router = APIRouter()
 
-# Chat contexts
-chat_contexts = {}
+# the LLM router spreads the calls over every provider with an API key
+chat_engine = ChatEngine(llm_router)
 
-# define chat instance based on available API KEY and MODEL
-try:
-    chat_instance = ChatGroq(
-        groq_api_key=GROQ_API_KEY, model_name=MODEL, temperature=MODEL_TEMPERATURE
-    )
-except Exception as e:
-    print(f"GROQ Instance Error: {e}")
-try:
-    chat_instance = ChatOpenAI(
-        model=MODEL, temperature=MODEL_TEMPERATURE, max_retries=2
-    )
-except Exception as e:
-    print(f"OpenAI Instance Error: {e}")
-try:
-    chat_instance = ChatGoogleGenerativeAI(model=MODEL, temperature=MODEL_TEMPERATURE)
-except Exception as e:
-    print(f"Google Generative AI Instance Error: {e}")
+# Concurrent identical first-turn questions share one LLM generation
+llm_flight = SingleFlight("llm")
+register_metrics("llm_singleflight", llm_flight.stats)
 
+register_metrics(
+    "fast_path",
+    lambda: {
+        "answers": get_counter("chat.fast_path"),
+        "ratio": get_counter("chat.fast_path") / max(1, get_counter("chat.answered")),
+    },
+)
 
 system_prompt = "You are a friendly conversational chatbot who responds in the language of the user."
 
 
+async def prepare_chat(request, db_client):
+    """
+    Retrieve the passages answering the question and set up the conversation.
+
+    Shared by the regular and the streaming chat endpoints. Raises a 404 before
+    anything is generated if the knowledge base has no answer.
+
+    Returns:
+        dict: the turn, see `build_turn`.
+    """
+    # Detect the language once, retrieval only searches that language's partition
+    lang = detect_language(request.question)
+
+    # Check knowledge base for the passages answering the question
+    with timer("chat.retrieval"):
+        passages = await afind_passages_in_knowledge_base(
+            db_client, request.question, lang
+        )
+    if not passages:
+        # update index of unanswered questions, the combined lookup upserts into
+        # a dynamically mapped index which picks the new question up on its own
+        # and tracked misses are not searched at all
+        if UNANSWERED_TRACKING == "search" and not COMBINED_RETRIEVAL:
+            index_scheduler.mark_dirty(
+                UNANSWERED_QUESTIONS_COLLECTION, UNANSWERED_QUESTIONS_INDEX
+            )
+        raise HTTPException(
+            status_code=404, detail=f"Question not found in knowledge base"
+        )
+    return await build_turn(request, passages, lang, db_client)
+
+
+async def build_turn(request, passages, lang, db_client):
+    """
+    Load the conversation and build the LLM messages from the passages.
+
+    Returns:
+        dict: the "chat_id", its "session", the LLM "messages", the
+        "reference_question_id", the "reference_ids" of all passages, the
+        "response_key" identifying the answer, whether it is the "first_turn" of the
+        conversation, the estimated "prompt_tokens" and the stored "fast_answer"
+        returned without the LLM, if any.
+    """
+    reference_question_id = passages[0]["id"]
+    response = "\n\n".join(passage["answer"] for passage in passages)
+
+    # Retrieve or create chat context
+    chat_id = request.id
+    session = await session_store.load(chat_id) if chat_id else None
+    if session is None:
+        chat_id = str(uuid.uuid4())
+        session = new_session()
+    summary, history = prompt_history(session)
+    first_turn = not history and not summary
+    increment("chat.answered")
+
+    # create system prompt
+    system_prompt = chat_engine.system_prompt(response, summary)
+
+    # Construct the messages
+    messages = chat_engine.build_messages(system_prompt, history, request.question)
+
+    reference_ids = [passage["id"] for passage in passages]
+    prompt_tokens = (
+        count_tokens(system_prompt)
+        + sum(count_tokens(content) for _, content in history)
+        + count_tokens(request.question)
+    )
+
+    observe("chat.context_passages", len(passages))
+    observe("chat.context_tokens", count_tokens(system_prompt))
+    observe("chat.prompt_tokens", prompt_tokens)
+    return {
+        "chat_id": chat_id,
+        "session": session,
+        "messages": messages,
+        "reference_question_id": reference_question_id,
+        "reference_ids": reference_ids,
+        "response_key": response_cache_key(
+            reference_ids,
+            request.question,
+            [["summary", summary]] + history if summary else history,
+        ),
+        "first_turn": first_turn,
+        "prompt_tokens": prompt_tokens,
+        "fast_answer": (
+            await fast_path_answer(db_client, passages, lang) if first_turn else None
+        ),
+    }
+
+
+async def fast_path_answer(db_client, passages, lang):
+    """
+    Return the stored answer of a high confidence match in the question's language,
+    None if the LLM should answer.
+
+    A match in another language is answered with its variant in the question's
+    language, if its group has one.
+    """
+    if not FAST_PATH_ENABLED:
+        return None
+    # the score of a passage is on the scale of the backend that found it
+    threshold = SCORE_THRESHOLD_FAST_PATH.get(get_retriever().name)
+    best = passages[0]
+    if threshold is None or (best["score"] or 0.0) <= threshold:
+        return None
+    # untagged documents and undetected languages can't be told apart
+    if lang is None or best["lang"] in (lang, None):
+        return best["answer"]
+    if best.get("group_id") is None:
+        return None
+    answer = await afind_group_answer(db_client, best["group_id"], lang)
+    if answer is not None:
+        increment("chat.fast_path_group")
+    return answer
+
+
+async def get_cached_response(turn):
+    """Return the cached answer of the turn, None on a miss or if caching is disabled."""
+    if not RESPONSE_CACHE_ENABLED:
+        return None
+    return await response_cache.get(turn["response_key"])
+
+
+async def cache_response(turn, response):
+    if RESPONSE_CACHE_ENABLED:
+        await response_cache.set(turn["response_key"], response, turn["reference_ids"])
+
+
+async def generate_response(turn):
+    """
+    Answer from the response cache, or generate the answer and cache it.
+
+    Identical first-turn questions arriving at the same time share one generation,
+    follow-ups have their own history and are never coalesced.
+    """
+    if turn["fast_answer"] is not None:
+        increment("chat.fast_path")
+        return turn["fast_answer"]
+
+    response = await get_cached_response(turn)
+    if response is not None:
+        return response
+
+    async def generate():
+        async with llm_limiter.acquire():
+            with timer("chat.llm"):
+                try:
+                    response = await chat_engine.generate(turn["messages"])
+                except LLMUnavailableError as e:
+                    logging.error(e)
+                    raise HTTPException(
+                        status_code=503, detail="No LLM provider available"
+                    )
+        await cache_response(turn, response)
+        return response
+
+    if not turn["first_turn"]:
+        return await generate()
+    response, coalesced = await llm_flight.do(turn["response_key"], generate)
+    if coalesced:
+        increment("chat.coalesced")
+    return response
+
+
+def sse_event(event, data):
+    """Format one server-sent event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
 @router.post(
     "/chat",
     summary="Chat with the AI assistant",
@@ -76,6 +247,8 @@ system_prompt = "You are a friendly conversational chatbot who responds in the l
                         "id": "b37e6182-8b0b-4a82-9d10-d7f6ddc52fd3",
                         "response": "The significance of roles is that they align with later developed regulations...",
                         "reference_question_id": "677ec97711172d691541fa4c",
+                        "log_id": "677ec9a811172d691541fa52",
+                        "prompt_tokens": 412,
                     }
                 }
             },
@@ -114,80 +287,311 @@ system_prompt = "You are a friendly conversational chatbot who responds in the l
                 }
             },
         },
+        503: {
+            "description": "Every configured LLM provider failed or timed out.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "No LLM provider available"}
+                }
+            },
+        },
     },
     tags=["Chat"],
 )
-def chat_endpoint(
-    request: ChatRequest, db_client: MongoClient = Depends(get_mongo_client)
+async def chat_endpoint(
+    request: ChatRequest,
+    db_client: AsyncIOMotorClient = Depends(get_async_mongo_client),
 ):
-    global chat_contexts
+    turn = await prepare_chat(request, db_client)
+    chat_id = turn["chat_id"]
+    reference_question_id = turn["reference_question_id"]
+
+    response = await generate_response(turn)
+
+    await remember(chat_id, turn["session"], request.question, response)
 
-    # Check knowledge base for predefined answer
-    reference_question_id, predefined_answer = find_answer_in_knowledge_base(
-        db_client, request.question
+    # Queue the response to be logged in the database
+    log_id = chat_log_writer.log(
+        request.question, response, chat_id, reference_question_id
     )
-    if predefined_answer:
-        response = predefined_answer
-        # Ensure chat_id is set if predefined answer is found
-        chat_id = request.id if request.id else str(uuid.uuid4())
+
+    return ChatResponse(
+        id=chat_id,
+        response=response.strip(),
+        reference_question_id=reference_question_id,
+        log_id=log_id,
+        prompt_tokens=turn["prompt_tokens"],
+    )
+
+
+@router.post(
+    "/chat/stream",
+    summary="Chat with the AI assistant, streaming the answer",
+    description=(
+        "Streaming variant of `/chat` using server-sent events. A `meta` event with the chat `id` and the "
+        "`reference_question_id` is sent as soon as the knowledge base lookup is done, followed by `token` "
+        "events carrying the answer as the LLM generates it, and a final `done` event with the `log_id` once "
+        "the exchange is logged. The conversation context is updated with the complete answer, so a later "
+        "`/chat` or `/chat/stream` request with the same `id` continues the conversation. If the question is "
+        "not found in the knowledge base, a regular 404 response is returned instead of a stream. If the LLM "
+        "fails mid-stream, an `error` event is sent and the stream ends."
+    ),
+    responses={
+        200: {
+            "description": "A stream of server-sent events.",
+            "content": {
+                "text/event-stream": {
+                    "example": (
+                        'event: meta\ndata: {"id": "b37e6182-8b0b-4a82-9d10-d7f6ddc52fd3", '
+                        '"reference_question_id": "677ec97711172d691541fa4c", "prompt_tokens": 412}\n\n'
+                        'event: token\ndata: {"text": "The significance"}\n\n'
+                        'event: token\ndata: {"text": " of roles is..."}\n\n'
+                        'event: done\ndata: {"log_id": "677ec9a811172d691541fa52"}\n\n'
+                    )
+                }
+            },
+        },
+        404: {
+            "description": "Question not found in knowledge base",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Question not found in knowledge base"}
+                }
+            },
+        },
+        500: {
+            "description": "Internal server error if the database interaction fails.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Database connection failed"}
+                }
+            },
+        },
+    },
+    tags=["Chat"],
+)
+async def chat_stream_endpoint(
+    request: ChatRequest,
+    db_client: AsyncIOMotorClient = Depends(get_async_mongo_client),
+):
+    # Retrieval happens before the stream starts so a miss is still a plain 404
+    turn = await prepare_chat(request, db_client)
+    chat_id = turn["chat_id"]
+    reference_question_id = turn["reference_question_id"]
+    cached_response = turn["fast_answer"]
+    if cached_response is not None:
+        increment("chat.fast_path")
     else:
-        # update index of unanswered questions
-        db = db_client[DB_NAME]
-        unanswered_questions = db[UNANSWERED_QUESTIONS_COLLECTION]
-        update_index(unanswered_questions, UNANSWERED_QUESTIONS_INDEX)
-        raise HTTPException(
-            status_code=404, detail=f"Question not found in knowledge base"
+        cached_response = await get_cached_response(turn)
+
+    async def events():
+        nonlocal cached_response
+        yield sse_event(
+            "meta",
+            {
+                "id": chat_id,
+                "reference_question_id": reference_question_id,
+                "prompt_tokens": turn["prompt_tokens"],
+            },
         )
 
-    # create system prompt
-    system_prompt = f"""You are a friendly conversational chatbot who responds in the language of the user.
-Use the following information to answer the user's question:
-{response}
+        if cached_response is None and turn["first_turn"]:
+            # share the answer of an identical question being generated right now,
+            # after the meta event so the ids are still sent immediately
+            try:
+                cached_response, coalesced = await llm_flight.wait(turn["response_key"])
+            except Exception as e:
+                logging.error(f"Shared chat response failed: {e}")
+                increment("chat.stream.errors")
+                yield sse_event("error", {"detail": "LLM response failed"})
+                return
+            if coalesced:
+                increment("chat.coalesced")
 
-And keep your answer to the point unless the user asks for more details."""
+        if cached_response is not None:
+            # a stored or cached answer is sent as a single token
+            response = cached_response
+            yield sse_event("token", {"text": response})
+        else:
+            chunks = []
+            start = time.perf_counter()
+            try:
+                async with llm_limiter.acquire():
+                    with timer("chat.llm"):
+                        async for text in chat_engine.stream(turn["messages"]):
+                            if not chunks:
+                                observe(
+                                    "chat.stream.first_token",
+                                    (time.perf_counter() - start) * 1000,
+                                )
+                            chunks.append(text)
+                            yield sse_event("token", {"text": text})
+            except Exception as e:
+                logging.error(f"Streaming chat response failed: {e}")
+                increment("chat.stream.errors")
+                yield sse_event("error", {"detail": "LLM response failed"})
+                return
 
-    # Retrieve or create chat context
-    chat_id = request.id
-    if not chat_id or chat_id not in chat_contexts:
-        chat_id = str(uuid.uuid4())
-        memory = ConversationBufferWindowMemory(
-            k=5, memory_key="chat_history", return_messages=True
+            response = "".join(chunks)
+            await cache_response(turn, response)
+
+        # Keep the conversation in sync with the regular endpoint
+        await remember(chat_id, turn["session"], request.question, response)
+
+        # Queue the response to be logged in the database
+        log_id = chat_log_writer.log(
+            request.question, response, chat_id, reference_question_id
         )
-        chat_contexts[chat_id] = memory
-    else:
-        memory = chat_contexts[chat_id]
-
-    # Construct prompt and conversation chain
-    prompt = ChatPromptTemplate.from_messages(
-        [
-            SystemMessage(content=system_prompt),
-            MessagesPlaceholder(variable_name="chat_history"),
-            HumanMessagePromptTemplate.from_template("{human_input}"),
-        ]
-    )
+        yield sse_event("done", {"log_id": log_id})
 
-    conversation = LLMChain(
-        llm=chat_instance,
-        prompt=prompt,
-        verbose=False,
-        memory=memory,
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        # keep proxies from buffering the stream
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    response = conversation.predict(human_input=request.question)
 
-    # Maintain only defined maximum contexts
-    if len(chat_contexts) > MAX_CONTEXTS:
-        oldest_context_id = list(chat_contexts.keys())[0]
-        del chat_contexts[oldest_context_id]
+@router.post(
+    "/chat/batch",
+    summary="Answer a batch of questions",
+    description=(
+        "Bulk variant of `/chat` for offline evaluation and pre-warming. The knowledge base lookups of every "
+        "question are done in one bulk retrieval pass, the answers are generated concurrently (at most "
+        "`CHAT_BATCH_CONCURRENCY` at a time) and the exchanges are logged together. The results are returned in "
+        "the order of the questions; a question that can't be answered gets the `status_code` and `error` it "
+        "would have got from `/chat` instead of failing the whole batch."
+    ),
+    response_model=List[ChatBatchItem],
+    responses={
+        200: {
+            "description": "The result of every question, in order.",
+            "content": {
+                "application/json": {
+                    "example": [
+                        {
+                            "status_code": 200,
+                            "id": "b37e6182-8b0b-4a82-9d10-d7f6ddc52fd3",
+                            "response": "The significance of roles is that they align with later developed regulations...",
+                            "reference_question_id": "677ec97711172d691541fa4c",
+                            "log_id": "677ec9a811172d691541fa52",
+                            "prompt_tokens": 412,
+                            "error": None,
+                        },
+                        {
+                            "status_code": 404,
+                            "id": None,
+                            "response": None,
+                            "reference_question_id": None,
+                            "log_id": None,
+                            "prompt_tokens": None,
+                            "error": "Question not found in knowledge base",
+                        },
+                    ]
+                }
+            },
+        },
+        400: {
+            "description": "Too many questions in the batch",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "At most 500 questions per batch"}
+                }
+            },
+        },
+        500: {
+            "description": "Internal server error if the database interaction fails.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Database connection failed"}
+                }
+            },
+        },
+    },
+    tags=["Chat"],
+)
+async def chat_batch_endpoint(
+    requests: List[ChatRequest],
+    db_client: AsyncIOMotorClient = Depends(get_async_mongo_client),
+):
+    if len(requests) > CHAT_BATCH_MAX_SIZE:
+        raise HTTPException(
+            status_code=400,
+            detail=f"At most {CHAT_BATCH_MAX_SIZE} questions per batch",
+        )
+    if not requests:
+        return []
+
+    langs = [detect_language(request.question) for request in requests]
+
+    # one retrieval pass for every question
+    with timer("chat.batch_retrieval"):
+        passages_list = await afind_passages_batch(
+            db_client, [request.question for request in requests], langs
+        )
 
-    # Log the response in the database
-    log_id = chat_log(
-        db_client, request.question, response, chat_id, reference_question_id
-    )
+    if (
+        UNANSWERED_TRACKING == "search"
+        and not COMBINED_RETRIEVAL
+        and not all(passages_list)
+    ):
+        index_scheduler.mark_dirty(
+            UNANSWERED_QUESTIONS_COLLECTION, UNANSWERED_QUESTIONS_INDEX
+        )
 
-    return ChatResponse(
-        id=chat_id,
-        response=response.strip(),
-        reference_question_id=reference_question_id,
-        log_id=log_id,
+    # bounds this batch only, the LLM calls also share the global llm limiter
+    semaphore = asyncio.Semaphore(CHAT_BATCH_CONCURRENCY)
+
+    async def answer(request, passages, lang):
+        if not passages:
+            raise HTTPException(
+                status_code=404, detail="Question not found in knowledge base"
+            )
+        async with semaphore:
+            turn = await build_turn(request, passages, lang, db_client)
+            response = await generate_response(turn)
+        await remember(turn["chat_id"], turn["session"], request.question, response)
+        return turn, response
+
+    results = await asyncio.gather(
+        *(
+            answer(request, passages, lang)
+            for request, passages, lang in zip(requests, passages_list, langs)
+        ),
+        return_exceptions=True,
     )
+
+    items = []
+    log_entries = []
+    for request, result in zip(requests, results):
+        if isinstance(result, HTTPException):
+            items.append(
+                ChatBatchItem(status_code=result.status_code, error=result.detail)
+            )
+            continue
+        if isinstance(result, BaseException):
+            logging.error(f"Failed to answer a batch question: {result!r}")
+            items.append(
+                ChatBatchItem(status_code=500, error="Failed to answer the question")
+            )
+            continue
+        turn, response = result
+        items.append(
+            ChatBatchItem(
+                id=turn["chat_id"],
+                response=response.strip(),
+                reference_question_id=turn["reference_question_id"],
+                prompt_tokens=turn["prompt_tokens"],
+            )
+        )
+        log_entries.append(
+            (request.question, response, turn["chat_id"], turn["reference_question_id"])
+        )
+    increment("chat.batch_questions", len(requests))
+
+    # queued together, so the logs of the batch are written with one insert_many
+    log_ids = iter(chat_log_writer.log_many(log_entries))
+    for item in items:
+        if item.status_code == 200:
+            item.log_id = next(log_ids)
+    return items
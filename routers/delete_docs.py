@@ -4,8 +4,11 @@
 
 from fastapi import APIRouter, HTTPException
 from bson import ObjectId
+from pymongo import DeleteOne
 
 from utils.mongo_client import get_mongo_client
+from utils.get_context import on_document_removed
+from utils.translation_cache import translation_cache
 from constants import *
 
 router = APIRouter()
@@ -105,10 +108,34 @@ def delete_chat_log(id: str):
         raise HTTPException(status_code=500, detail="Failed to delete chat log.") from e
 
 
+def delete_group(db_client, group_id):
+    """
+    Delete every language variant of a multilingual question group with one bulk write,
+    and drop them from the retrieval backend and caches.
+    """
+    multilingual_questions = db_client[DB_NAME][MULTILINGUAL_QUESTIONS_COLLECTION]
+    doc_ids = [
+        document["_id"]
+        for document in multilingual_questions.find({"group_id": group_id}, {"_id": 1})
+    ]
+    if not doc_ids:
+        return 0
+    # by _id, exactly the variants dropped from the caches below are deleted
+    result = multilingual_questions.bulk_write(
+        [DeleteOne({"_id": doc_id}) for doc_id in doc_ids], ordered=False
+    )
+    for doc_id in doc_ids:
+        on_document_removed(MULTILINGUAL_QUESTIONS_COLLECTION, doc_id, db_client)
+    return result.deleted_count
+
+
 @router.delete(
     "/multilingual_questions/{id}",
     summary="Delete a multilingual question",
-    description="Delete a specific multilingual question by ID.",
+    description=(
+        "Delete a specific multilingual question by ID. Its variants in the other languages are kept, "
+        "use `DELETE /multilingual_questions/group/{group_id}` to delete them all."
+    ),
     responses={
         200: {
             "description": "Multilingual question deleted successfully.",
@@ -148,8 +175,11 @@ def delete_multilingual_question(id: str):
             raise HTTPException(
                 status_code=404, detail="Multilingual question not found."
             )
+        on_document_removed(MULTILINGUAL_QUESTIONS_COLLECTION, ObjectId(id), db_client)
 
         return {"detail": "Multilingual question deleted successfully."}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=500, detail="Failed to delete multilingual question."
@@ -199,9 +229,115 @@ def delete_unanswered_question(id: str):
             raise HTTPException(
                 status_code=404, detail="Unanswered question not found."
             )
+        on_document_removed(UNANSWERED_QUESTIONS_COLLECTION, id)
 
         return {"detail": "Unanswered question deleted successfully."}
     except Exception as e:
         raise HTTPException(
             status_code=500, detail="Failed to delete unanswered question."
         ) from e
+
+
+@router.delete(
+    "/translation_cache",
+    summary="Purge the translation cache",
+    description=(
+        "Delete every cached translation, e.g. after changing the translation prompt. The persistent "
+        "cache shared by all workers is emptied, the in-memory cache only in the worker serving the request."
+    ),
+    responses={
+        200: {
+            "description": "Translation cache purged successfully.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Translation cache purged successfully.",
+                        "deleted_count": 1250,
+                    }
+                }
+            },
+        },
+        500: {
+            "description": "Internal server error.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Failed to purge translation cache."}
+                }
+            },
+        },
+    },
+    tags=["Delete Documents"],
+)
+def purge_translation_cache():
+    try:
+        db_client = get_mongo_client()
+        deleted_count = translation_cache.purge(db_client)
+
+        return {
+            "detail": "Translation cache purged successfully.",
+            "deleted_count": deleted_count,
+        }
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail="Failed to purge translation cache."
+        ) from e
+
+
+@router.delete(
+    "/multilingual_questions/group/{group_id}",
+    summary="Delete a multilingual question group",
+    description="Delete every language variant of the multilingual question group `group_id` with one bulk write.",
+    responses={
+        200: {
+            "description": "Multilingual question group deleted successfully.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "detail": "Multilingual question group deleted successfully.",
+                        "deleted_count": 3,
+                    }
+                }
+            },
+        },
+        404: {
+            "description": "Multilingual question group not found.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Multilingual question group not found."}
+                }
+            },
+        },
+        500: {
+            "description": "Internal server error.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Failed to delete multilingual question group."}
+                }
+            },
+        },
+    },
+    tags=["Delete Documents"],
+)
+def delete_multilingual_question_group(group_id: str):
+    try:
+        db_client = get_mongo_client()
+        deleted_count = (
+            delete_group(db_client, ObjectId(group_id))
+            if ObjectId.is_valid(group_id)
+            else 0
+        )
+        if deleted_count == 0:
+            raise HTTPException(
+                status_code=404, detail="Multilingual question group not found."
+            )
+
+        return {
+            "detail": "Multilingual question group deleted successfully.",
+            "deleted_count": deleted_count,
+        }
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=500, detail="Failed to delete multilingual question group."
+        ) from e
@@ -0,0 +1,73 @@
+from fastapi import Query, Depends, APIRouter
+from pymongo import MongoClient, DESCENDING
+from utils.mongo_client import get_mongo_client
+from constants import DB_NAME, UNANSWERED_QUESTIONS_COLLECTION
+
+router = APIRouter()
+
+
+@router.get(
+    "/unanswered_questions/top",
+    summary="Retrieve the most asked unanswered questions",
+    description=(
+        "Returns the unanswered questions ranked by how often they were asked. Near-identical "
+        "phrasings of the same question are counted together, and a few of them are kept as "
+        "`samples`. Counts are written in the background every few seconds, so the latest "
+        "misses may not be included yet."
+    ),
+    responses={
+        200: {
+            "description": (
+                "A list of unanswered questions, most asked first:\n\n"
+                "- **_id**: Unique identifier for the unanswered question.\n"
+                "- **question**: The first phrasing of the question.\n"
+                "- **lang**: The detected language of the question, if any.\n"
+                "- **count**: How often the question was asked.\n"
+                "- **first_seen** / **last_seen**: When the question was first and last asked.\n"
+                "- **samples**: Other phrasings of the same question."
+            ),
+            "content": {
+                "application/json": {
+                    "example": [
+                        {
+                            "_id": "6790c1f2a1b2c3d4e5f60718",
+                            "question": "How do I reset my password?",
+                            "lang": "en",
+                            "count": 42,
+                            "first_seen": "2025-01-20T09:12:03.120000",
+                            "last_seen": "2025-01-22T16:40:51.005000",
+                            "samples": [
+                                "how can I reset my password",
+                                "How do I reset my pasword??",
+                            ],
+                        }
+                    ]
+                }
+            },
+        },
+        500: {
+            "description": "Internal Server Error",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Database connection failed"}
+                }
+            },
+        },
+    },
+    tags=["Get Unanswered Questions"],
+)
+def get_top_unanswered_questions(
+    limit: int = Query(
+        20, description="Maximum number of questions to return.", ge=1, le=500
+    ),
+    db_client: MongoClient = Depends(get_mongo_client),
+):
+    db = db_client[DB_NAME]
+    collection = db[UNANSWERED_QUESTIONS_COLLECTION]
+
+    questions = list(collection.find().sort("count", DESCENDING).limit(limit))
+
+    # Convert MongoDB object IDs to strings and prepare the JSON response
+    for question in questions:
+        question["_id"] = str(question["_id"])
+    return questions
@@ -0,0 +1,102 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+
+from utils.mongo_client import mongo_manager
+from utils.databse_schema import schema_bootstrap
+
+router = APIRouter()
+
+
+@router.get(
+    "/health",
+    summary="Liveness check",
+    description=(
+        "Returns right away without querying the database. The database status comes from the "
+        "heartbeats the MongoDB driver sends in the background."
+    ),
+    responses={
+        200: {
+            "description": "The process is running.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "status": "ok",
+                        "database": {
+                            "healthy": True,
+                            "servers": {
+                                "cluster0-shard-00-00.mongodb.net:27017": {
+                                    "ok": True,
+                                    "last_heartbeat_seconds_ago": 4.2,
+                                    "round_trip_ms": 12.5,
+                                }
+                            },
+                        },
+                    }
+                }
+            },
+        },
+    },
+    tags=["Health"],
+)
+def health():
+    database = mongo_manager.health.stats()
+    return {"status": "ok" if database["healthy"] else "degraded", "database": database}
+
+
+@router.get(
+    "/ready",
+    summary="Readiness check",
+    description=(
+        "Returns 200 once the database schema is set up, the search indexes can be queried and the "
+        "knowledge base is loaded, and while the database is reachable. Returns 503 otherwise, so a "
+        "load balancer only sends traffic to ready instances."
+    ),
+    responses={
+        200: {
+            "description": "The instance can serve requests.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "ready": True,
+                        "database_healthy": True,
+                        "bootstrap": {
+                            "state": "ready",
+                            "attempts": 1,
+                            "duration_seconds": 1.3,
+                            "error": None,
+                        },
+                    }
+                }
+            },
+        },
+        503: {
+            "description": "The instance is still starting up or the database is down.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "ready": False,
+                        "database_healthy": True,
+                        "bootstrap": {
+                            "state": "running",
+                            "attempts": 1,
+                            "duration_seconds": None,
+                            "error": None,
+                        },
+                    }
+                }
+            },
+        },
+    },
+    tags=["Health"],
+)
+def ready():
+    database_healthy = mongo_manager.healthy()
+    is_ready = schema_bootstrap.ready() and database_healthy
+    return JSONResponse(
+        status_code=200 if is_ready else 503,
+        content={
+            "ready": is_ready,
+            "database_healthy": database_healthy,
+            "bootstrap": schema_bootstrap.stats(),
+        },
+    )
@@ -0,0 +1,41 @@
+from fastapi import APIRouter
+
+from utils.metrics import collect_metrics
+
+router = APIRouter()
+
+
+@router.get(
+    "/metrics",
+    summary="Runtime metrics",
+    description=(
+        "Returns the counters and statistics collected by the running process, "
+        "e.g. the hit, miss and eviction counts of the retrieval cache."
+    ),
+    responses={
+        200: {
+            "description": "Current metrics of this process.",
+            "content": {
+                "application/json": {
+                    "example": {
+                        "counters": {},
+                        "retrieval_cache": {
+                            "size": 42,
+                            "maxsize": 1024,
+                            "ttl": 600,
+                            "hits": 120,
+                            "misses": 58,
+                            "hit_rate": 0.674,
+                            "evictions": 0,
+                            "expirations": 3,
+                            "invalidations": 1,
+                        },
+                    }
+                }
+            },
+        },
+    },
+    tags=["Metrics"],
+)
+def get_metrics():
+    return collect_metrics()
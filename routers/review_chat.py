@@ -1,11 +1,18 @@
 from fastapi import APIRouter, Depends, HTTPException
 from pymongo import MongoClient
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 from bson.objectid import ObjectId
 
+from utils.chat_log import chat_log_writer
 from utils.mongo_client import get_mongo_client
 from utils.base_models import RateChatRequest
-from constants import DB_NAME, REVIEW_QUESTIONS_COLLECTION, CHAT_LOGS_COLLECTION
+from constants import (
+    DB_NAME,
+    REVIEW_QUESTIONS_COLLECTION,
+    CHAT_LOGS_COLLECTION,
+    CHAT_LOG_FLUSH_INTERVAL,
+    CHAT_LOG_RETRY_WINDOW,
+)
 
 router = APIRouter()
 
@@ -29,6 +36,14 @@ router = APIRouter()
                 "application/json": {"example": {"detail": "Chat log not found."}}
             },
         },
+        503: {
+            "description": "The chat log is recent and not written yet, e.g. it is queued by another worker. Retry after the `Retry-After` seconds.",
+            "content": {
+                "application/json": {
+                    "example": {"detail": "Chat log not written yet, retry later."}
+                }
+            },
+        },
         500: {
             "description": "Internal server error.",
             "content": {
@@ -48,10 +63,20 @@ def rate_chat_endpoint(
         chat_logs = db[CHAT_LOGS_COLLECTION]
         review_questions = db[REVIEW_QUESTIONS_COLLECTION]
 
-        # Find the chat log by log_id
-        print(request.log_id)
-        chat_log = chat_logs.find_one({"_id": ObjectId(request.log_id)})
+        # Find the chat log by log_id, it may still be waiting to be written
+        log_id = ObjectId(request.log_id)
+        chat_log = chat_log_writer.find(request.log_id) or chat_logs.find_one(
+            {"_id": log_id}
+        )
         if not chat_log:
+            age = datetime.now(timezone.utc) - log_id.generation_time
+            if age < timedelta(seconds=CHAT_LOG_RETRY_WINDOW):
+                # queued or spilled by another worker or host, written soon
+                raise HTTPException(
+                    status_code=503,
+                    detail="Chat log not written yet, retry later.",
+                    headers={"Retry-After": str(CHAT_LOG_FLUSH_INTERVAL)},
+                )
             raise HTTPException(status_code=404, detail="Chat log not found.")
 
         # Prepare the review entry
@@ -66,5 +91,7 @@ def rate_chat_endpoint(
         review_questions.insert_one(review_entry)
 
         return {"detail": "Chat log reviewed successfully."}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to review chat log.") from e
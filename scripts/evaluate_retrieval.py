@@ -0,0 +1,369 @@
+# This script evaluates the knowledge base retrieval offline and helps tuning the thresholds
+#
+# A dataset is a JSON file with the knowledge base documents and labeled questions:
+#   {"documents": [{"_id": ..., "question": ..., "answer": ..., "lang": ...}],
+#    "queries": [{"question": ..., "expected_id": ... or null}],
+#    "unanswered": [{"_id": ..., "question": ..., "lang": ...}],
+#    "unanswered_queries": [{"question": ..., "expected_id": ...}]}
+# Queries with a null expected_id should not match anything and count as false hits
+# if they do. The optional unanswered entries tune SCORE_THRESHOLD_UNANSWERED: every
+# unanswered query is another phrasing of the expected unanswered question.
+#
+# Export a dataset from the chat logs (needs MONGODB_CONN_STR):
+#   python -m scripts.evaluate_retrieval export --output dataset.json
+# Evaluate the local backends on it, without any database:
+#   python -m scripts.evaluate_retrieval evaluate --dataset dataset.json
+# Gate a CI job on the recall at the configured threshold:
+#   python -m scripts.evaluate_retrieval evaluate --dataset dataset.json --fail-under 0.8
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+
+from constants import (
+    CONNECTION_STRING,
+    DB_NAME,
+    CHAT_LOGS_COLLECTION,
+    MULTILINGUAL_QUESTIONS_COLLECTION,
+    MULTILINGUAL_QUESTIONS_INDEX,
+    UNANSWERED_QUESTIONS_COLLECTION,
+    UNANSWERED_QUESTIONS_INDEX,
+    RETRIEVAL_TOP_K,
+    SCORE_THRESHOLD_MULTILINGUAL,
+    SCORE_THRESHOLD_UNANSWERED,
+)
+from utils.get_context import afetch_top_results
+from utils.language import detect_language
+from utils.metrics import summarize
+from utils.rerank import rerank
+from utils.retriever import RETRIEVERS, set_retriever
+
+DEFAULT_THRESHOLDS = [0.5, 1.0, 1.5, 2.0, 2.5, 3.0, 4.0]
+DEFAULT_UNANSWERED_THRESHOLDS = [0.1, 0.2, 0.5, 1.0, 1.5, 2.0]
+DEFAULT_BACKENDS = ["bm25", "hybrid"]
+
+
+def export_dataset(client, output, limit):
+    """Write the knowledge base and the labeled chat log questions to a dataset file."""
+    db = client[DB_NAME]
+    projection = {"question": 1, "answer": 1, "lang": 1}
+    documents = list(db[MULTILINGUAL_QUESTIONS_COLLECTION].find({}, projection))
+    known_ids = {str(document["_id"]) for document in documents}
+
+    queries = []
+    for log in db[CHAT_LOGS_COLLECTION].find(
+        {"refernced_question_id": {"$nin": [None, ""]}},
+        {"question": 1, "refernced_question_id": 1},
+    ).limit(limit):
+        # skip logs pointing at documents deleted since
+        if log["refernced_question_id"] in known_ids:
+            queries.append(
+                {"question": log["question"], "expected_id": log["refernced_question_id"]}
+            )
+
+    # questions nobody could answer are negatives, the other phrasings sampled by the
+    # clustering are labeled queries of the unanswered questions
+    unanswered = []
+    unanswered_queries = []
+    for document in db[UNANSWERED_QUESTIONS_COLLECTION].find(
+        {}, {"question": 1, "lang": 1, "samples": 1}
+    ).limit(limit):
+        if not document.get("question"):
+            continue
+        queries.append({"question": document["question"], "expected_id": None})
+        document["_id"] = str(document["_id"])
+        for sample in document.pop("samples", None) or []:
+            if sample != document["question"]:
+                unanswered_queries.append(
+                    {"question": sample, "expected_id": document["_id"]}
+                )
+        unanswered.append(document)
+
+    for document in documents:
+        document["_id"] = str(document["_id"])
+    dataset = {
+        "documents": documents,
+        "queries": queries,
+        "unanswered": unanswered,
+        "unanswered_queries": unanswered_queries,
+    }
+    with open(output, "w", encoding="utf-8") as file:
+        json.dump(dataset, file, ensure_ascii=False)
+    print(
+        f"Exported {len(documents)} documents, {len(queries)} queries, {len(unanswered)} "
+        f"unanswered questions and {len(unanswered_queries)} of their phrasings to {output}"
+    )
+
+
+def load_dataset(path):
+    with open(path, encoding="utf-8") as file:
+        dataset = json.load(file)
+    for document in dataset["documents"] + dataset.get("unanswered", []):
+        document["_id"] = str(document["_id"])
+    return dataset
+
+
+async def run_queries(client, queries, db_collection, db_index, threshold, limit, detect_lang):
+    """
+    Search every query at one threshold, with the retrieval path of the app.
+
+    The backends apply the threshold before they take the top `limit` results, and
+    the fused hybrid ranking depends on what passed, so every threshold is searched
+    rather than filtering the results of one search afterwards.
+
+    Returns:
+        tuple: (results of every query, latencies in ms)
+    """
+    runs = []
+    latencies = []
+    for query in queries:
+        lang = detect_language(query["question"]) if detect_lang else None
+        start = time.perf_counter()
+        results, _ = await afetch_top_results(
+            client, query["question"], db_collection, db_index, threshold, lang, limit
+        )
+        latencies.append((time.perf_counter() - start) * 1000)
+        runs.append(results or [])
+    return runs, latencies
+
+
+async def sweep(use_database, queries, db_collection, db_index, thresholds, limit, detect_lang):
+    """
+    Search the queries at every threshold.
+
+    Returns:
+        tuple: ({threshold: results of every query}, latencies in ms)
+    """
+    client = None
+    if use_database:
+        # created here, the client is bound to the event loop running the queries
+        from motor.motor_asyncio import AsyncIOMotorClient
+
+        client = AsyncIOMotorClient(CONNECTION_STRING)
+    runs = {}
+    latencies = []
+    try:
+        for threshold in thresholds:
+            runs[threshold], run_latencies = await run_queries(
+                client, queries, db_collection, db_index, threshold, limit, detect_lang
+            )
+            latencies.extend(run_latencies)
+    finally:
+        if client is not None:
+            client.close()
+    return runs, latencies
+
+
+def score_threshold(queries, runs, threshold, k, use_rerank):
+    """Compute recall@1, recall@k, MRR, hit rate and false hit rate at one threshold."""
+    positives = 0
+    recall_at_1 = 0
+    recall_at_k = 0
+    reciprocal_ranks = 0.0
+    hits = 0
+    false_hits = 0
+
+    for query, results in zip(queries, runs):
+        if use_rerank:
+            results = rerank(query["question"], [dict(result) for result in results])
+        ranked_ids = [str(result["_id"]) for result in results[:k]]
+
+        expected_id = query.get("expected_id")
+        if ranked_ids:
+            hits += 1
+            if ranked_ids[0] != expected_id:
+                false_hits += 1
+        if expected_id is None:
+            continue
+        positives += 1
+        if expected_id in ranked_ids:
+            rank = ranked_ids.index(expected_id) + 1
+            recall_at_k += 1
+            reciprocal_ranks += 1 / rank
+            if rank == 1:
+                recall_at_1 += 1
+
+    total = len(queries) or 1
+    positives = positives or 1
+    return {
+        "threshold": threshold,
+        "recall@1": recall_at_1 / positives,
+        f"recall@{k}": recall_at_k / positives,
+        "mrr": reciprocal_ranks / positives,
+        "hit_rate": hits / total,
+        "false_hit_rate": false_hits / total,
+    }
+
+
+def print_table(title, latencies, rows):
+    print(f"\n== {title}")
+    print(
+        "latency ms  p50 {p50:.3f}  p95 {p95:.3f}  p99 {p99:.3f}".format(**latencies)
+        if latencies["count"]
+        else "latency ms  n/a"
+    )
+    columns = list(rows[0].keys())
+    print("  ".join(f"{column:>14}" for column in columns))
+    for row in rows:
+        print("  ".join(f"{row[column]:>14.3f}" for column in columns))
+
+
+def evaluate(args):
+    dataset = load_dataset(args.dataset) if args.dataset else None
+    if dataset is None:
+        from pymongo import MongoClient
+
+        # evaluate against the live knowledge base, labeled by the chat logs
+        export_dataset(MongoClient(CONNECTION_STRING), args.output_dataset, args.limit)
+        dataset = load_dataset(args.output_dataset)
+    queries = dataset["queries"]
+    unanswered_queries = dataset.get("unanswered_queries", [])
+    # the configured thresholds are always part of the sweep
+    thresholds = sorted(set(args.thresholds) | {SCORE_THRESHOLD_MULTILINGUAL})
+    unanswered_thresholds = sorted(
+        set(args.unanswered_thresholds) | {SCORE_THRESHOLD_UNANSWERED}
+    )
+    # the app reranks the RETRIEVAL_TOP_K best results
+    limit = max(args.k, RETRIEVAL_TOP_K)
+
+    report = {}
+    failed = False
+    for backend in args.backends:
+        retriever = RETRIEVERS[backend]()
+        if backend != "atlas":
+            retriever.load_documents(MULTILINGUAL_QUESTIONS_COLLECTION, dataset["documents"])
+            retriever.load_documents(
+                UNANSWERED_QUESTIONS_COLLECTION, dataset.get("unanswered", [])
+            )
+        set_retriever(retriever)
+
+        runs, latencies = asyncio.run(
+            sweep(
+                backend == "atlas",
+                queries,
+                MULTILINGUAL_QUESTIONS_COLLECTION,
+                MULTILINGUAL_QUESTIONS_INDEX,
+                thresholds,
+                limit,
+                args.detect_language,
+            )
+        )
+        rows = [
+            score_threshold(queries, runs[threshold], threshold, args.k, not args.no_rerank)
+            for threshold in thresholds
+        ]
+        report[backend] = {"latency_ms": summarize(latencies), "thresholds": rows}
+        print_table(f"{backend} ({len(queries)} queries)", report[backend]["latency_ms"], rows)
+
+        if unanswered_queries:
+            # a miss is only checked against the best unanswered question, like the app does
+            runs, latencies = asyncio.run(
+                sweep(
+                    backend == "atlas",
+                    unanswered_queries,
+                    UNANSWERED_QUESTIONS_COLLECTION,
+                    UNANSWERED_QUESTIONS_INDEX,
+                    unanswered_thresholds,
+                    1,
+                    args.detect_language,
+                )
+            )
+            unanswered_rows = [
+                score_threshold(unanswered_queries, runs[threshold], threshold, 1, False)
+                for threshold in unanswered_thresholds
+            ]
+            report[backend]["unanswered"] = {
+                "latency_ms": summarize(latencies),
+                "thresholds": unanswered_rows,
+            }
+            print_table(
+                f"{backend} unanswered questions ({len(unanswered_queries)} queries)",
+                report[backend]["unanswered"]["latency_ms"],
+                unanswered_rows,
+            )
+
+        if args.fail_under is not None:
+            configured = next(
+                row for row in rows if row["threshold"] == SCORE_THRESHOLD_MULTILINGUAL
+            )
+            if configured["recall@1"] < args.fail_under:
+                print(
+                    f"FAIL: {backend} recall@1 {configured['recall@1']:.3f} at threshold "
+                    f"{SCORE_THRESHOLD_MULTILINGUAL} is below {args.fail_under}"
+                )
+                failed = True
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2)
+    return 1 if failed else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Evaluate the knowledge base retrieval and tune its thresholds."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    export_parser = commands.add_parser(
+        "export", help="Export a labeled dataset from the chat logs."
+    )
+    export_parser.add_argument("--output", required=True)
+    export_parser.add_argument("--limit", type=int, default=10000)
+
+    evaluate_parser = commands.add_parser(
+        "evaluate", help="Evaluate retrieval backends over a threshold sweep."
+    )
+    evaluate_parser.add_argument(
+        "--dataset", help="Dataset file, exported from MongoDB when omitted."
+    )
+    evaluate_parser.add_argument("--output-dataset", default="dataset.json")
+    evaluate_parser.add_argument("--limit", type=int, default=10000)
+    evaluate_parser.add_argument(
+        "--backends",
+        type=lambda value: value.split(","),
+        default=DEFAULT_BACKENDS,
+        help=f"Comma separated, any of {', '.join(RETRIEVERS)}.",
+    )
+    evaluate_parser.add_argument(
+        "--thresholds",
+        type=lambda value: [float(threshold) for threshold in value.split(",")],
+        default=DEFAULT_THRESHOLDS,
+    )
+    evaluate_parser.add_argument(
+        "--unanswered-thresholds",
+        type=lambda value: [float(threshold) for threshold in value.split(",")],
+        default=DEFAULT_UNANSWERED_THRESHOLDS,
+        help="Sweep of SCORE_THRESHOLD_UNANSWERED, for datasets with unanswered queries.",
+    )
+    evaluate_parser.add_argument("--k", type=int, default=5)
+    evaluate_parser.add_argument(
+        "--detect-language",
+        action="store_true",
+        help="Route every question to its detected language partition.",
+    )
+    evaluate_parser.add_argument("--no-rerank", action="store_true")
+    evaluate_parser.add_argument("--output", help="Write the report as JSON.")
+    evaluate_parser.add_argument(
+        "--fail-under",
+        type=float,
+        help="Exit with 1 if recall@1 at SCORE_THRESHOLD_MULTILINGUAL is below this value.",
+    )
+
+    args = parser.parse_args(argv)
+    # the retrieval functions log every query
+    logging.getLogger().setLevel(logging.ERROR)
+
+    if args.command == "export":
+        from pymongo import MongoClient
+
+        export_dataset(MongoClient(CONNECTION_STRING), args.output, args.limit)
+        return 0
+    return evaluate(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
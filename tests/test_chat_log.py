@@ -0,0 +1,107 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from bson import ObjectId
+from fastapi import HTTPException
+
+from routers import review_chat
+from utils.base_models import RateChatRequest
+from utils.chat_log import ChatLogWriter
+
+
+class FakeCollection:
+    def __init__(self):
+        self.fail = False
+        self.documents = {}
+
+    def insert_many(self, documents, ordered=True):
+        if self.fail:
+            raise ConnectionError("unreachable")
+        for document in documents:
+            self.documents[document["_id"]] = document
+
+    def insert_one(self, document):
+        self.documents[ObjectId()] = document
+
+    def find_one(self, query):
+        return self.documents.get(query["_id"])
+
+
+class FakeClient:
+    """Stands in for client[db][collection], one collection per name."""
+
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name == "RAG-index":
+            return self
+        return self.collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def writer(tmp_path):
+    writer = ChatLogWriter(spill_file=str(tmp_path / "spill.jsonl"))
+    writer._client = FakeClient()
+    return writer
+
+
+def logs(writer):
+    return writer._client["Chat-Logs"]
+
+
+def test_a_spilled_log_can_be_found_until_it_is_written(writer):
+    logs(writer).fail = True
+    log_id = writer.log("question", "answer", "chat", None)
+    assert writer.find(log_id)["question"] == "question"
+
+    writer._write(writer._next_batch(timeout=0))
+    assert writer.get_pending(log_id) is None
+    assert writer.find(log_id)["answer"] == "answer"
+
+    logs(writer).fail = False
+    writer._replay()
+    assert writer.find(log_id) is None
+    assert ObjectId(log_id) in logs(writer).documents
+
+
+def test_logs_spilled_by_another_worker_can_be_found(writer, tmp_path):
+    other = ChatLogWriter(spill_file=str(tmp_path / "spill.jsonl"))
+    other._spill([{"_id": ObjectId(), "question": "elsewhere"}])
+    log_id = str(ObjectId())
+    other._spill([{"_id": ObjectId(log_id), "question": "mine"}])
+
+    assert writer.find(log_id)["question"] == "mine"
+    assert writer.find(str(ObjectId())) is None
+
+
+@pytest.fixture
+def rate_chat(writer, monkeypatch):
+    monkeypatch.setattr(review_chat, "chat_log_writer", writer)
+
+    def rate_chat(log_id):
+        return review_chat.rate_chat_endpoint(RateChatRequest(log_id=log_id), writer._client)
+
+    return rate_chat
+
+
+def test_rate_chat_reviews_a_spilled_log(rate_chat, writer):
+    logs(writer).fail = True
+    log_id = writer.log("question", "answer", "chat", None)
+    writer._write(writer._next_batch(timeout=0))
+
+    assert rate_chat(log_id) == {"detail": "Chat log reviewed successfully."}
+    reviews = writer._client["Review-Questions"].documents
+    assert [review["log_id"] for review in reviews.values()] == [log_id]
+
+
+def test_rate_chat_asks_to_retry_for_a_recent_unknown_log(rate_chat):
+    with pytest.raises(HTTPException) as error:
+        rate_chat(str(ObjectId()))
+    assert error.value.status_code == 503
+    assert "Retry-After" in error.value.headers
+
+    old = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(hours=1))
+    with pytest.raises(HTTPException) as error:
+        rate_chat(str(old))
+    assert error.value.status_code == 404
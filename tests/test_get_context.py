@@ -0,0 +1,63 @@
+import pytest
+
+from constants import MULTILINGUAL_QUESTIONS_COLLECTION
+from utils import get_context
+from utils.get_context import get_cached_passages, on_documents_added, retrieval_cache
+from utils.retriever import BM25Retriever, HybridRetriever
+
+PASSAGES = ({"id": "1", "answer": "cached"},)
+
+
+@pytest.fixture(autouse=True)
+def empty_cache():
+    retrieval_cache.clear()
+    yield
+    retrieval_cache.clear()
+
+
+def cache(question, lang="de"):
+    cache_key, _ = get_cached_passages(question, lang)
+    retrieval_cache.set(cache_key, PASSAGES)
+    return cache_key
+
+
+def add(monkeypatch, retriever, question, lang="de"):
+    monkeypatch.setattr(get_context, "get_retriever", lambda: retriever)
+    on_documents_added(
+        MULTILINGUAL_QUESTIONS_COLLECTION,
+        [{"_id": "2", "question": question, "answer": "", "lang": lang}],
+    )
+
+
+def test_questions_with_the_same_terms_share_an_entry():
+    cache("Wo ist die Straße?")
+    assert get_cached_passages("wo ist die straße", "de")[1] == list(PASSAGES)
+    assert get_cached_passages("wo ist die straße", "en")[1] is None
+
+
+@pytest.mark.parametrize(
+    "question, document",
+    [
+        ("Wo ist die Straße?", "Straße gesperrt"),
+        ("Is C++ supported?", "C support"),
+        ("What is a user_id?", "user_id format"),
+    ],
+)
+def test_a_lexical_insert_drops_the_entries_sharing_a_term(monkeypatch, question, document):
+    cache_key = cache(question)
+    cache("Opening hours")
+    add(monkeypatch, BM25Retriever(), document)
+
+    assert retrieval_cache.get(cache_key) is None
+    assert get_cached_passages("Opening hours", "de")[1] == list(PASSAGES)
+
+
+def test_a_hybrid_insert_drops_the_entries_of_its_language(monkeypatch):
+    same_language = cache("Wo ist die Straße?", "de")
+    all_languages = cache("Wo ist die Straße?", None)
+    other_language = cache("Where is the street?", "en")
+    add(monkeypatch, HybridRetriever(), "Strase gespert")
+
+    assert retrieval_cache.get(same_language) is None
+    assert retrieval_cache.get(all_languages) is None
+    assert retrieval_cache.get(other_language) == PASSAGES
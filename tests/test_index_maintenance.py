@@ -0,0 +1,65 @@
+from types import SimpleNamespace
+
+import pytest
+
+from utils import index_maintenance
+from utils.index_maintenance import IndexMaintenanceScheduler
+
+KEY = ("Multilingual-Questions", "multilingual_questions_index")
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    clock = Clock()
+    updates = []
+    monkeypatch.setattr(index_maintenance, "time", SimpleNamespace(monotonic=clock))
+    monkeypatch.setattr(
+        index_maintenance, "update_index", lambda collection, index: updates.append(index)
+    )
+    scheduler = IndexMaintenanceScheduler(delay=2, interval=60, max_delay=30)
+    scheduler._client = {index_maintenance.DB_NAME: {KEY[0]: KEY[0]}}
+    scheduler.clock, scheduler.updates = clock, updates
+    return scheduler
+
+
+def test_the_update_waits_until_the_burst_settled(scheduler):
+    for _ in range(5):
+        scheduler.mark_dirty(*KEY)
+        scheduler.clock.now += 1.5
+        assert scheduler.run_pending() == 0
+
+    scheduler.clock.now += 0.5
+    assert scheduler.run_pending() == 1
+    assert scheduler.updates == [KEY[1]]
+    assert scheduler.coalesced == 4
+
+
+def test_a_steady_stream_of_changes_is_updated_after_the_max_delay(scheduler):
+    updated_at = None
+    for second in range(40):
+        scheduler.mark_dirty(*KEY)
+        if scheduler.run_pending():
+            updated_at = second
+            break
+        scheduler.clock.now += 1
+    assert updated_at == 30
+
+
+def test_updates_of_an_index_are_spaced_by_the_interval(scheduler):
+    scheduler.mark_dirty(*KEY)
+    scheduler.clock.now += 2
+    assert scheduler.run_pending() == 1
+
+    scheduler.mark_dirty(*KEY)
+    scheduler.clock.now += 10
+    assert scheduler.run_pending() == 0
+    scheduler.clock.now += 50
+    assert scheduler.run_pending() == 1
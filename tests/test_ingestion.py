@@ -0,0 +1,256 @@
+import asyncio
+import json
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from utils import ingestion
+from utils.ingestion import ingest_rows, iter_csv_rows, iter_jsonl_rows, iter_lines
+
+HEADER = "question_en,answer_en,references"
+
+
+async def stream(*chunks):
+    for chunk in chunks:
+        yield chunk
+
+
+def collect(iterator):
+    async def run():
+        return [item async for item in iterator]
+
+    return asyncio.run(run())
+
+
+def split(data, size):
+    return [data[i : i + size] for i in range(0, len(data), size)]
+
+
+def csv_rows(text, chunk_size=7):
+    return collect(iter_csv_rows(stream(*split(text.encode(), chunk_size))))
+
+
+def test_lines_are_split_across_chunks():
+    data = "first\r\nsecond line\nlast without newline".encode()
+    for size in (1, 3, len(data)):
+        assert collect(iter_lines(stream(*split(data, size)))) == [
+            "first",
+            "second line",
+            "last without newline",
+        ]
+
+
+def test_multibyte_characters_split_between_chunks_and_the_bom():
+    data = "\ufeffKérdés\nÖffnungszeiten\n".encode()
+    assert collect(iter_lines(stream(*split(data, 1)))) == ["Kérdés", "Öffnungszeiten"]
+
+
+def test_jsonl_skips_blank_lines_and_reports_bad_rows():
+    data = b'{"question_en": "a"}\n\n  \n[1, 2]\n{broken\n{"question_en": "b"}'
+    rows = collect(iter_jsonl_rows(stream(data)))
+
+    assert [number for number, _ in rows] == [1, 2, 3, 4]
+    assert rows[0][1] == {"question_en": "a"}
+    assert str(rows[1][1]) == "A row must be a JSON object."
+    assert isinstance(rows[2][1], ValueError)
+    assert rows[3][1] == {"question_en": "b"}
+
+
+def test_csv_quoted_fields_keep_commas_line_breaks_and_quotes():
+    text = (
+        f"{HEADER}\n"
+        '"Where, exactly?","On the\n""second""\nfloor.",https://a.example https://b.example\n'
+        "\n"
+        "Opening hours?,From 9 to 5,\n"
+    )
+    for chunk_size in (1, 7, len(text)):
+        rows = csv_rows(text, chunk_size)
+        assert rows == [
+            (
+                1,
+                {
+                    "question_en": "Where, exactly?",
+                    "answer_en": 'On the\n"second"\nfloor.',
+                    "references": ["https://a.example", "https://b.example"],
+                },
+            ),
+            # empty fields are left out
+            (2, {"question_en": "Opening hours?", "answer_en": "From 9 to 5"}),
+        ]
+
+
+def test_csv_reports_a_wrong_field_count_and_goes_on():
+    rows = csv_rows(f"{HEADER}\nonly one field\nq,a,\n")
+    assert str(rows[0][1]) == "Expected 3 fields but found 1."
+    assert rows[1] == (2, {"question_en": "q", "answer_en": "a"})
+
+
+def test_csv_reports_an_unterminated_quote():
+    rows = csv_rows(f'{HEADER}\nq,a,\n"never closed,a,\n')
+    assert rows[0] == (1, {"question_en": "q", "answer_en": "a"})
+    assert rows[1][0] == 2
+    assert str(rows[1][1]) == "Unterminated quoted field."
+
+
+def test_csv_with_only_a_header_has_no_rows():
+    assert csv_rows(f"{HEADER}\n") == []
+    assert csv_rows("") == []
+
+
+class FakeCollection:
+    """insert_many / delete_many of a collection, failing the inserts of `fail_questions`."""
+
+    def __init__(self, fail_questions=()):
+        self.fail_questions = set(fail_questions)
+        self.documents = {}
+
+    async def insert_many(self, documents, ordered=True):
+        errors = []
+        for index, document in enumerate(documents):
+            document.setdefault("_id", ObjectId())
+            if document["question"] in self.fail_questions:
+                errors.append({"index": index, "code": 11000})
+            else:
+                self.documents[document["_id"]] = document
+        if errors:
+            raise BulkWriteError({"writeErrors": errors})
+
+    async def delete_many(self, query):
+        group_ids = query["group_id"]["$in"]
+        for doc_id, document in list(self.documents.items()):
+            if document["group_id"] in group_ids:
+                del self.documents[doc_id]
+
+
+class FakeClient:
+    """Stands in for client[db][collection]."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getitem__(self, name):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def ingest(monkeypatch, rows, collection, batch_size=2):
+    async def translate(data):
+        if data["question_en"] == "untranslatable":
+            raise RuntimeError("LLM down")
+        return {
+            f"{lang}_{field}": f"{data[f'{field}_en']} ({lang})"
+            for lang in ("en", "hu", "de")
+            for field in ("question", "answer")
+        }
+
+    added = []
+    monkeypatch.setattr(ingestion, "translate_to_all_languages", translate)
+    monkeypatch.setattr(
+        ingestion, "on_documents_added", lambda _, documents: added.extend(documents)
+    )
+    lines = "\n".join(json.dumps(row) for row in rows).encode()
+    report = asyncio.run(
+        ingest_rows(iter_jsonl_rows(stream(lines)), FakeClient(collection), batch_size)
+    )
+    return report, added
+
+
+def test_ingest_rows_reports_every_kind_of_failure(monkeypatch):
+    rows = [
+        {"question_en": "q1", "answer_en": "a1"},
+        {"question_en": "no answer"},
+        {"question_en": "untranslatable", "answer_en": "a"},
+        {"question_en": "q4", "answer_en": "a4", "references": ["https://a.example"]},
+        {"question_en": "q5", "answer_en": "a5"},
+    ]
+    collection = FakeCollection()
+    report, added = ingest(monkeypatch, rows, collection)
+
+    assert report["rows"] == 5
+    assert report["inserted_rows"] == 3
+    assert report["inserted_documents"] == 9
+    assert [error["row"] for error in report["errors"]] == [2, 3]
+    assert report["errors"][1]["error"] == "Translation failed."
+    assert len(collection.documents) == len(added) == 9
+
+
+def test_a_partially_inserted_row_is_deleted_and_not_indexed(monkeypatch):
+    rows = [
+        {"question_en": "q1", "answer_en": "a1"},
+        {"question_en": "q2", "answer_en": "a2"},
+    ]
+    # only the German variant of the second row fails
+    collection = FakeCollection(fail_questions={"q2 (de)"})
+    report, added = ingest(monkeypatch, rows, collection)
+
+    assert report["inserted_rows"] == 1
+    assert report["inserted_documents"] == 3
+    assert report["errors"] == [{"row": 2, "error": "Failed to insert the row."}]
+    assert {document["question"] for document in collection.documents.values()} == {
+        "q1 (en)",
+        "q1 (hu)",
+        "q1 (de)",
+    }
+    assert [document["question"] for document in added] == ["q1 (en)", "q1 (hu)", "q1 (de)"]
+
+
+def test_variants_that_cant_be_deleted_are_reported(monkeypatch):
+    class UndeletableCollection(FakeCollection):
+        async def delete_many(self, query):
+            raise ConnectionError("unreachable")
+
+    collection = UndeletableCollection(fail_questions={"q1 (hu)"})
+    report, added = ingest(monkeypatch, [{"question_en": "q1", "answer_en": "a1"}], collection)
+
+    error = report["errors"][0]
+    assert error["error"] == "Failed to insert some languages of the row."
+    assert set(error["inserted"]) == {"group_id", "en_id", "de_id"}
+    assert added == []
+
+
+class TimingOutCollection(FakeCollection):
+    """Writes the first `written` documents of a batch, then times out."""
+
+    def __init__(self, written):
+        super().__init__()
+        self.written = written
+
+    async def insert_many(self, documents, ordered=True):
+        for document in documents:
+            document.setdefault("_id", ObjectId())
+        for document in documents[: self.written]:
+            self.documents[document["_id"]] = document
+        raise TimeoutError("timed out")
+
+
+def test_a_batch_that_fails_midway_leaves_no_incomplete_group(monkeypatch):
+    rows = [
+        {"question_en": "q1", "answer_en": "a1"},
+        {"question_en": "q2", "answer_en": "a2"},
+    ]
+    collection = TimingOutCollection(written=4)
+    report, added = ingest(monkeypatch, rows, collection)
+
+    assert report["inserted_rows"] == 0
+    assert report["errors"] == [
+        {"row": 1, "error": "Failed to insert the row."},
+        {"row": 2, "error": "Failed to insert the row."},
+    ]
+    assert collection.documents == {}
+    assert added == []
+
+
+def test_groups_that_may_have_been_written_are_reported(monkeypatch):
+    class UndeletableCollection(TimingOutCollection):
+        async def delete_many(self, query):
+            raise ConnectionError("unreachable")
+
+    collection = UndeletableCollection(written=1)
+    report, _ = ingest(monkeypatch, [{"question_en": "q1", "answer_en": "a1"}], collection)
+
+    error = report["errors"][0]
+    assert error["error"].startswith("Failed to insert the row, some of its languages")
+    group_id = next(iter(collection.documents.values()))["group_id"]
+    assert error["group_id"] == str(group_id)
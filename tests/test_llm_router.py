@@ -0,0 +1,223 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from utils import llm_router as llm_router_module
+from utils.llm_router import (
+    MAX_CONSECUTIVE_FAILURES,
+    FakeChatModel,
+    LLMRouter,
+    LLMUnavailableError,
+    Provider,
+    RateLimiter,
+)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    # only the router's clock, the event loop keeps the real one
+    monkeypatch.setattr(
+        llm_router_module,
+        "time",
+        SimpleNamespace(monotonic=clock, perf_counter=time.perf_counter),
+    )
+    return clock
+
+
+def provider(name, latency=0.0, failure_rate=0.0, response=None):
+    return Provider(name, FakeChatModel(response or name, latency, failure_rate))
+
+
+def test_rate_limiter_allows_a_burst_then_refills(clock):
+    limiter = RateLimiter(2)
+    for _ in range(2):
+        assert limiter.available()
+        asyncio.run(limiter.acquire())
+    assert not limiter.available()
+
+    clock.now += 0.5
+    assert limiter.available()
+    clock.now += 10
+    limiter._refill()
+    assert limiter.tokens == limiter.capacity == 2
+
+
+def test_rate_limiter_without_a_rate_never_waits():
+    limiter = RateLimiter(None)
+    for _ in range(100):
+        asyncio.run(limiter.acquire())
+    assert limiter.available()
+
+
+def test_a_rate_below_one_still_allows_one_request(clock):
+    limiter = RateLimiter(0.5)
+    assert limiter.capacity == 1.0
+    asyncio.run(limiter.acquire())
+    assert not limiter.available()
+    clock.now += 2
+    assert limiter.available()
+
+
+def test_candidates_order(clock):
+    fast, slow, new, failing, down = (
+        provider(name) for name in ("fast", "slow", "new", "failing", "down")
+    )
+    fast.ewma, slow.ewma, failing.ewma = 0.2, 0.8, 0.1
+    failing.consecutive_failures = 1
+    down.unhealthy_until = clock.now + 60
+
+    router = LLMRouter([down, failing, slow, new, fast])
+    assert [p.name for p in router.candidates()] == [
+        "new",
+        "fast",
+        "slow",
+        "failing",
+        "down",
+    ]
+
+
+def test_a_provider_that_never_succeeded_comes_after_the_working_ones():
+    broken, working = provider("broken"), provider("working")
+    working.ewma = 5.0
+    broken.consecutive_failures = 2
+    assert LLMRouter([broken, working]).candidates() == [working, broken]
+
+
+def test_failover_to_the_next_provider():
+    router = LLMRouter(
+        [provider("first", failure_rate=1.0), provider("second")], hedge=False
+    )
+    assert asyncio.run(router.ainvoke([])).content == "second"
+    assert router.providers[0].consecutive_failures == 1
+
+
+def test_repeated_failures_mark_a_provider_unhealthy():
+    first = provider("first", failure_rate=1.0)
+    for _ in range(MAX_CONSECUTIVE_FAILURES):
+        with pytest.raises(RuntimeError):
+            asyncio.run(first.ainvoke([]))
+    assert not first.healthy()
+    assert LLMRouter([first, provider("second")]).candidates()[0].name == "second"
+
+
+def test_all_providers_failing_raises():
+    router = LLMRouter([provider("a", failure_rate=1.0), provider("b", failure_rate=1.0)])
+    with pytest.raises(LLMUnavailableError, match="a: .*b: "):
+        asyncio.run(router.ainvoke([]))
+    with pytest.raises(LLMUnavailableError):
+        asyncio.run(LLMRouter([]).ainvoke([]))
+
+
+def test_a_slow_request_is_hedged_and_the_faster_answer_wins():
+    slow, fast = provider("slow", latency=0.5), provider("fast", latency=0.01)
+    slow.hedge_delay = lambda: 0.02
+    router = LLMRouter([slow, fast], hedge=True)
+
+    assert asyncio.run(router.ainvoke([])).content == "fast"
+    assert fast.calls == 1
+
+
+def test_no_hedge_before_the_delay_is_known():
+    slow, fast = provider("slow", latency=0.05), provider("fast")
+    router = LLMRouter([slow, fast], hedge=True)
+
+    assert slow.hedge_delay() is None
+    assert asyncio.run(router.ainvoke([])).content == "slow"
+    assert fast.calls == 0
+
+
+def test_stream_fails_over_before_the_first_chunk():
+    router = LLMRouter(
+        [provider("first", failure_rate=1.0), provider("second", response="a b")]
+    )
+
+    async def collect():
+        return [chunk.content async for chunk in router.astream([])]
+
+    assert asyncio.run(collect()) == ["a ", "b "]
+
+
+class BrokenStream:
+    async def astream(self, messages, **kwargs):
+        yield SimpleNamespace(content="partial ")
+        raise RuntimeError("connection reset")
+
+
+def test_stream_does_not_fail_over_after_the_first_chunk():
+    second = provider("second")
+    router = LLMRouter([Provider("broken", BrokenStream()), second])
+
+    async def collect():
+        chunks = []
+        with pytest.raises(RuntimeError):
+            async for chunk in router.astream([]):
+                chunks.append(chunk.content)
+        return chunks
+
+    assert asyncio.run(collect()) == ["partial "]
+    assert second.calls == 0
+
+
+class StallingStream:
+    """Sends `chunks` chunks, then never sends another one."""
+
+    def __init__(self, chunks=0):
+        self.chunks = chunks
+
+    async def astream(self, messages, **kwargs):
+        for _ in range(self.chunks):
+            yield SimpleNamespace(content="partial ")
+        await asyncio.sleep(3600)
+
+
+def test_a_stream_stalled_before_the_first_chunk_fails_over():
+    stalled = Provider("stalled", StallingStream(), timeout=0.02)
+    router = LLMRouter([stalled, provider("second", response="ok")])
+
+    async def collect():
+        return [chunk.content async for chunk in router.astream([])]
+
+    assert asyncio.run(collect()) == ["ok "]
+    assert stalled.consecutive_failures == 1
+    assert stalled.limiter.in_use == 0
+
+
+def test_a_stream_stalled_between_chunks_times_out():
+    stalled = Provider("stalled", StallingStream(chunks=1), timeout=0.02)
+
+    async def collect():
+        chunks = []
+        with pytest.raises(asyncio.TimeoutError):
+            async for chunk in stalled.astream([]):
+                chunks.append(chunk.content)
+        return chunks
+
+    assert asyncio.run(collect()) == ["partial "]
+    assert stalled.failures == 1
+    assert stalled.limiter.in_use == 0
+
+
+def test_requests_waiting_for_the_rate_limit_hold_no_slot():
+    limited = Provider("limited", FakeChatModel(latency=0.0), rate_limit=20)
+    limited.rate_limiter.tokens = 0
+
+    async def main():
+        call = asyncio.ensure_future(limited.ainvoke([]))
+        await asyncio.sleep(0.01)
+        in_use = limited.limiter.in_use
+        await call
+        return in_use
+
+    assert asyncio.run(main()) == 0
+    assert limited.calls == 1
@@ -0,0 +1,103 @@
+import pytest
+
+from constants import RERANK_MIN_RELATIVE_SCORE, RERANK_RETRIEVAL_WEIGHT
+from utils.rerank import rerank, select_passages
+
+
+def candidate(doc_id, question, score=1.0, answer="An answer.", group_id=None):
+    return {
+        "_id": doc_id,
+        "question": question,
+        "answer": answer,
+        "score": score,
+        "group_id": group_id or doc_id,
+    }
+
+
+def ids(candidates):
+    return [c["_id"] for c in candidates]
+
+
+def test_rerank_of_nothing_is_empty():
+    assert rerank("question", []) == []
+    assert select_passages("question", []) == []
+
+
+def test_rerank_blends_the_retrieval_score_and_the_term_overlap():
+    ranked = rerank(
+        "reset my password",
+        [
+            candidate("close", "reset my password", score=1.0),
+            candidate("strong", "office hours", score=2.0),
+        ],
+    )
+    # "strong" has the best score but no term in common
+    assert ranked[0]["rerank_score"] == pytest.approx(
+        RERANK_RETRIEVAL_WEIGHT * 0.5 + (1 - RERANK_RETRIEVAL_WEIGHT) * 1.0
+    )
+    assert ranked[1]["rerank_score"] == pytest.approx(RERANK_RETRIEVAL_WEIGHT)
+    assert ids(ranked) == ["close", "strong"]
+
+
+def test_rerank_prefers_the_fused_score():
+    ranked = rerank(
+        "opening hours",
+        [
+            {"_id": "a", "question": "opening hours", "score": 9.0, "fused_score": 0.01},
+            {"_id": "b", "question": "opening hours", "score": 1.0, "fused_score": 0.03},
+        ],
+    )
+    assert ids(ranked) == ["b", "a"]
+
+
+def test_select_passages_keeps_the_best_even_over_budget():
+    passages = select_passages(
+        "reset password",
+        [candidate("a", "reset password", answer="x" * 400)],
+        token_budget=10,
+    )
+    assert ids(passages) == ["a"]
+
+
+def test_select_passages_respects_the_maximum():
+    candidates = [candidate(str(n), "reset password") for n in range(5)]
+    assert len(select_passages("reset password", candidates, max_passages=2)) == 2
+
+
+def test_select_passages_stops_below_the_minimum_relative_score():
+    passages = select_passages(
+        "reset my password",
+        [
+            candidate("best", "reset my password", score=1.0),
+            candidate("weak", "office hours", score=0.1),
+        ],
+    )
+    assert ids(passages) == ["best"]
+    # the weak candidate scores 0.05 against 1.0
+    assert 0.05 < RERANK_MIN_RELATIVE_SCORE * passages[0]["rerank_score"]
+
+
+def test_select_passages_skips_other_languages_of_a_kept_group():
+    passages = select_passages(
+        "reset password",
+        [
+            candidate("en", "reset password", group_id="g1"),
+            candidate("de", "reset password", group_id="g1"),
+            candidate("other", "reset password", group_id="g2"),
+        ],
+    )
+    assert ids(passages) == ["en", "other"]
+
+
+def test_select_passages_skips_what_exceeds_the_token_budget():
+    passages = select_passages(
+        "reset password",
+        [
+            candidate("a", "reset password", score=1.0, answer="x" * 40),
+            candidate("long", "reset password", score=0.9, answer="x" * 400),
+            candidate("short", "reset password", score=0.8, answer="x" * 40),
+        ],
+        token_budget=25,
+    )
+    # 10 tokens each for the short answers, 100 for the long one
+    assert ids(passages) == ["a", "short"]
@@ -0,0 +1,158 @@
+import asyncio
+import math
+
+from utils.retriever import BM25_B, BM25_K1, BM25Index, BM25Retriever, tokenize
+
+COLLECTION = "Multilingual-Questions"
+
+
+def test_tokenize_lowercases_and_ignores_non_text():
+    assert tokenize("How do I Reset-my password?") == [
+        "how",
+        "do",
+        "i",
+        "reset",
+        "my",
+        "password",
+    ]
+    assert tokenize(None) == []
+    assert tokenize(42) == []
+
+
+def test_bm25_score_matches_the_lucene_formula():
+    index = BM25Index(fields=("question",))
+    index.add({"_id": "a", "question": "reset password"})
+    index.add({"_id": "b", "question": "change the office address"})
+
+    # "password" occurs once in a document of 2 tokens, the average length is 3
+    idf = math.log(1 + (2 - 1 + 0.5) / (1 + 0.5))
+    norm = BM25_K1 * (1 - BM25_B + BM25_B * 2 / 3)
+    assert index.scores("password") == {"a": idf * 1 / (1 + norm)}
+
+
+def test_search_ranks_and_applies_the_threshold():
+    index = BM25Index()
+    index.add({"_id": "a", "question": "How do I reset my password?", "answer": "x"})
+    index.add({"_id": "b", "question": "Where is the office?", "answer": "Downtown"})
+    index.add({"_id": "c", "question": "Password rules", "answer": "Long"})
+
+    results = index.search("reset password", score_threshold=0.0, limit=5)
+    assert [result["_id"] for result in results] == ["a", "c"]
+    assert results[0]["score"] > results[1]["score"]
+
+    threshold = results[1]["score"]
+    assert [r["_id"] for r in index.search("reset password", threshold, 5)] == ["a"]
+    assert index.search("reset password", 0.0, limit=1)[0]["_id"] == "a"
+
+
+def test_add_replaces_and_remove_cleans_the_postings():
+    index = BM25Index()
+    index.add({"_id": "a", "question": "reset password", "answer": "x"})
+    index.add({"_id": "a", "question": "office hours", "answer": "y"})
+
+    assert len(index) == 1
+    assert index.scores("password") == {}
+    assert set(index.scores("office")) == {"a"}
+
+    assert index.remove("a") is True
+    assert index.remove("a") is False
+    assert len(index) == 0
+    assert index.scores("office") == {}
+    assert all(not postings for postings in index._postings.values())
+    assert all(total == 0 for total in index._total_lengths.values())
+
+
+def test_empty_index_finds_nothing():
+    index = BM25Index()
+    assert index.search("anything", 0.0, 5) == []
+    index.add({"_id": "a", "question": "", "answer": None})
+    assert index.search("anything", 0.0, 5) == []
+
+
+def test_retriever_searches_the_language_and_untagged_partitions():
+    retriever = BM25Retriever()
+    retriever.load_documents(
+        COLLECTION,
+        [
+            {"_id": "en", "question": "opening hours", "lang": "en"},
+            {"_id": "de", "question": "opening hours", "lang": "de"},
+            {"_id": "untagged", "question": "opening hours"},
+        ],
+    )
+
+    def search(lang):
+        results = retriever.search(None, "opening hours", COLLECTION, None, 0.0, 10, lang)
+        return {result["_id"] for result in results}
+
+    assert search("en") == {"en", "untagged"}
+    assert search(None) == {"en", "de", "untagged"}
+    assert search("hu") == {"untagged"}
+
+
+def test_retriever_survives_an_emptied_partition():
+    retriever = BM25Retriever()
+    retriever.load_documents(
+        COLLECTION, [{"_id": "de", "question": "Öffnungszeiten", "lang": "de"}]
+    )
+    retriever.document_removed(COLLECTION, "de")
+    assert retriever.search(None, "Öffnungszeiten", COLLECTION, None, 0.0, 5, "de") == []
+
+    retriever.document_added(
+        COLLECTION, {"_id": "de2", "question": "Öffnungszeiten", "lang": "de"}
+    )
+    results = retriever.search(None, "Öffnungszeiten", COLLECTION, None, 0.0, 5, "de")
+    assert [result["_id"] for result in results] == ["de2"]
+
+
+class FakeCursor:
+    def __init__(self, client):
+        self.client = client
+
+    async def to_list(self, length=None):
+        self.client.loads += 1
+        await asyncio.sleep(0.01)
+        return list(self.client.documents)
+
+
+class FakeAsyncClient:
+    """Stands in for client[db][collection].find(...).to_list()."""
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.loads = 0
+
+    def __getitem__(self, name):
+        return self
+
+    def find(self, *args):
+        return FakeCursor(self)
+
+
+def test_concurrent_first_queries_share_one_load_and_keep_concurrent_changes():
+    retriever = BM25Retriever()
+    client = FakeAsyncClient(
+        [
+            {"_id": "a", "question": "pay the rent", "lang": "en"},
+            {"_id": "b", "question": "rent a parking space", "lang": "en"},
+        ]
+    )
+
+    async def change_during_load():
+        await asyncio.sleep(0)
+        retriever.document_added(
+            COLLECTION, {"_id": "c", "question": "rent deposit", "lang": "en"}
+        )
+        retriever.document_removed(COLLECTION, "b")
+
+    async def main():
+        searches = [
+            retriever.asearch(client, "rent", COLLECTION, None, 0.0, 5, "en")
+            for _ in range(5)
+        ]
+        return await asyncio.gather(*searches, change_during_load())
+
+    results = asyncio.run(main())
+    assert client.loads == 1
+    for result in results[:5]:
+        assert {document["_id"] for document in result} == {"a", "c"}
+    assert retriever._loading == {}
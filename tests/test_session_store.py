@@ -0,0 +1,49 @@
+import asyncio
+
+import pytest
+
+from utils import session_store
+from utils.session_store import FileSessionStore, MemorySessionStore
+
+
+def exchange(number):
+    return [["human", f"q{number}"], ["ai", f"a{number}"]]
+
+
+@pytest.fixture(params=["memory", "file"])
+def store(request, tmp_path, monkeypatch):
+    monkeypatch.setattr(session_store, "window_size", lambda: 6)
+    if request.param == "memory":
+        return MemorySessionStore()
+    return FileSessionStore(directory=str(tmp_path))
+
+
+def test_a_fold_drops_only_the_messages_it_summarized(store):
+    async def run():
+        for number in range(3):
+            await store.append("chat", exchange(number))
+        session = await store.load("chat")
+        # the summary of the first exchange is generated while two more are appended
+        for number in range(3, 5):
+            await store.append("chat", exchange(number))
+        await store.fold("chat", "summary", session["start"] + 2)
+        return await store.load("chat")
+
+    session = asyncio.run(run())
+    assert session["summary"] == "summary"
+    assert session["messages"] == exchange(2) + exchange(3) + exchange(4)
+    assert session["start"] == 4
+
+
+def test_a_fold_of_trimmed_messages_keeps_the_window(store):
+    async def run():
+        await store.append("chat", exchange(0))
+        session = await store.load("chat")
+        for number in range(1, 5):
+            await store.append("chat", exchange(number))
+        await store.fold("chat", "summary", session["start"] + 2)
+        return await store.load("chat")
+
+    session = asyncio.run(run())
+    assert session["messages"] == exchange(2) + exchange(3) + exchange(4)
+    assert session["summary"] == "summary"
@@ -0,0 +1,118 @@
+from constants import UNANSWERED_MAX_SAMPLES, UNANSWERED_SIMILARITY_THRESHOLD
+from utils.unanswered import MinHashLSH, UnansweredRecorder
+
+QUESTION = "How can I cancel my gym membership?"
+PHRASING = "how can i cancel my gym membership"
+OTHER = "Which documents do I need for a visa application?"
+
+
+def test_lsh_finds_a_near_identical_phrasing():
+    lsh = MinHashLSH()
+    lsh.add("cancel", lsh.signature(QUESTION))
+    lsh.add("visa", lsh.signature(OTHER))
+
+    key, similarity = lsh.query(lsh.signature(PHRASING), UNANSWERED_SIMILARITY_THRESHOLD)
+    assert key == "cancel"
+    assert similarity >= UNANSWERED_SIMILARITY_THRESHOLD
+
+
+def test_lsh_finds_nothing_for_an_unrelated_question():
+    lsh = MinHashLSH()
+    lsh.add("cancel", lsh.signature(QUESTION))
+    assert lsh.query(lsh.signature(OTHER), UNANSWERED_SIMILARITY_THRESHOLD) is None
+
+
+def test_signatures_are_deterministic_and_handle_empty_text():
+    lsh = MinHashLSH()
+    assert (lsh.signature(QUESTION) == MinHashLSH().signature(QUESTION)).all()
+    empty = lsh.signature("")
+    assert len(empty) == 64
+    lsh.add("empty", empty)
+    assert lsh.query(lsh.signature("?!"), 1.0) == ("empty", 1.0)
+
+
+def test_remove_cleans_the_buckets():
+    lsh = MinHashLSH()
+    lsh.add("cancel", lsh.signature(QUESTION))
+    assert lsh.remove("cancel") is True
+    assert lsh.remove("cancel") is False
+    assert len(lsh) == 0
+    assert all(not buckets for buckets in lsh._buckets)
+    assert lsh.query(lsh.signature(QUESTION), 0.0) is None
+
+
+def test_record_clusters_phrasings_and_samples_them_once():
+    recorder = UnansweredRecorder()
+    cluster = recorder.record(QUESTION, "en")
+    assert recorder.record(PHRASING, "en") == cluster
+    assert recorder.record(PHRASING, "en") == cluster
+    assert recorder.record(OTHER, "en") != cluster
+
+    pending = recorder._pending[cluster]
+    assert pending["question"] == QUESTION
+    assert pending["count"] == 3
+    assert pending["samples"] == [PHRASING]
+    assert recorder.stats()["clusters"] == 2
+    assert recorder.stats()["pending_misses"] == 4
+
+
+def test_samples_are_capped():
+    recorder = UnansweredRecorder()
+    cluster = recorder.record(QUESTION)
+    for n in range(UNANSWERED_MAX_SAMPLES + 3):
+        recorder.record(f"{PHRASING}{'?' * (n + 1)}")
+    assert len(recorder._pending[cluster]["samples"]) == UNANSWERED_MAX_SAMPLES
+
+
+class FakeCollection:
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.writes = []
+
+    def bulk_write(self, operations, ordered=True):
+        if self.fail:
+            raise ConnectionError("unreachable")
+        self.writes.append(operations)
+
+
+class FakeClient:
+    """Stands in for client[db][collection]."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getitem__(self, name):
+        return self
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+
+def test_flush_writes_one_upsert_per_cluster():
+    recorder = UnansweredRecorder()
+    recorder.record(QUESTION)
+    recorder.record(PHRASING)
+    recorder.record(OTHER)
+    collection = FakeCollection()
+
+    assert recorder.flush(FakeClient(collection)) == 2
+    assert len(collection.writes) == 1
+    counts = sorted(op._doc["$inc"]["count"] for op in collection.writes[0])
+    assert counts == [1, 2]
+    assert recorder.stats()["pending_misses"] == 0
+    assert recorder.flush(FakeClient(collection)) == 0
+
+
+def test_a_failed_flush_requeues_and_merges_the_counts():
+    recorder = UnansweredRecorder()
+    cluster = recorder.record(QUESTION)
+    recorder.record(PHRASING)
+
+    assert recorder.flush(FakeClient(FakeCollection(fail=True))) == 0
+    assert recorder.flush_errors == 1
+    recorder.record(PHRASING)
+    assert recorder._pending[cluster]["count"] == 3
+
+    collection = FakeCollection()
+    assert recorder.flush(FakeClient(collection)) == 1
+    assert collection.writes[0][0]._doc["$inc"]["count"] == 3
@@ -0,0 +1,112 @@
+import zlib
+
+import numpy as np
+
+from constants import SCORE_THRESHOLD_SIMILARITY
+
+from utils.retriever import RRF_K, HybridIndex
+from utils.vector_index import NgramVectorIndex, char_ngrams, fold_text
+
+QUESTIONS = {
+    "reset": "How do I reset my password?",
+    "office": "Where is the office?",
+    "hours": "What are the opening hours?",
+    "parking": "Is there parking for visitors?",
+    "invoice": "How do I get an invoice?",
+}
+
+
+def build_index(documents, capacity=2):
+    index = NgramVectorIndex(256, capacity=capacity)
+    for doc_id, text in documents.items():
+        index.add(doc_id, text)
+    return index
+
+
+def test_fold_text_strips_diacritics_and_punctuation():
+    assert fold_text("Zurücksetzen!") == "zurucksetzen"
+    assert " ab" in set(char_ngrams("ab", sizes=(3,)))
+
+
+def test_a_misspelled_question_finds_its_document():
+    index = build_index(QUESTIONS)
+    doc_id, similarity = index.search("how do i reset my pasword", 1)[0]
+    assert doc_id == "reset"
+    assert 0.5 < similarity <= 1.0 + 1e-6
+
+
+def test_the_matrix_grows_past_its_capacity():
+    index = build_index(QUESTIONS, capacity=2)
+    assert len(index) == len(QUESTIONS)
+    assert index._matrix.shape[0] >= len(QUESTIONS)
+    for doc_id, text in QUESTIONS.items():
+        assert index.search(text, 1)[0][0] == doc_id
+
+
+def test_removed_rows_are_never_returned_and_are_reused():
+    index = build_index(QUESTIONS)
+    row = index._rows["office"]
+    assert index.remove("office") is True
+    assert index.remove("office") is False
+    assert all(doc_id != "office" for doc_id, _ in index.search(QUESTIONS["office"], 10))
+
+    rows = index._matrix.shape[0]
+    index.add("new", "Where can I park?")
+    assert index._rows["new"] == row
+    assert index._matrix.shape[0] == rows
+    assert len(index) == len(QUESTIONS)
+
+
+def test_document_frequencies_match_a_fresh_index_after_changes():
+    index = build_index(QUESTIONS)
+    index.remove("office")
+    index.add("reset", "How can I change my password?")
+
+    remaining = dict(QUESTIONS, reset="How can I change my password?")
+    del remaining["office"]
+    fresh = build_index(remaining)
+    np.testing.assert_array_equal(index._df, fresh._df)
+    assert index.search("change password", 1)[0][0] == "reset"
+
+
+def test_an_empty_query_or_index_finds_nothing():
+    index = NgramVectorIndex(64)
+    assert index.search("anything", 5) == []
+    index.add("a", "text")
+    assert index.search("", 5) == []
+    index.remove("a")
+    assert index.search("text", 5) == []
+
+
+def test_hybrid_accepts_a_typo_through_the_vectors_alone():
+    index = HybridIndex()
+    for doc_id, text in QUESTIONS.items():
+        index.add({"_id": doc_id, "question": text, "answer": "..."})
+
+    # the misspelled terms don't count, the rest scores below the threshold
+    results = index.search("how do i resett my pasword", score_threshold=5.0, limit=3)
+    assert [result["_id"] for result in results] == ["reset"]
+    assert results[0]["score"] < 5.0
+    assert results[0]["similarity"] >= SCORE_THRESHOLD_SIMILARITY
+
+
+def test_hybrid_fuses_both_rankings():
+    index = HybridIndex()
+    for doc_id, text in QUESTIONS.items():
+        index.add({"_id": doc_id, "question": text, "answer": "..."})
+
+    results = index.search("reset my password", score_threshold=0.0, limit=5)
+    assert results[0]["_id"] == "reset"
+    # first in both rankings
+    assert results[0]["fused_score"] == 2 / (RRF_K + 1)
+    fused = [result["fused_score"] for result in results]
+    assert fused == sorted(fused, reverse=True)
+
+    index.remove("reset")
+    assert all(result["_id"] != "reset" for result in index.search("reset", 0.0, 5))
+
+
+def test_features_do_not_depend_on_the_process_hash_seed():
+    index = NgramVectorIndex(4096)
+    features = {zlib.crc32(ngram.encode()) % 4096 for ngram in char_ngrams("abc")}
+    assert set(np.flatnonzero(index.vectorize("abc"))) == features
@@ -52,6 +52,19 @@ class ChatResponse(BaseModel):
     response: str
     reference_question_id: Optional[str] = None
     log_id: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+
+
+class ChatBatchItem(BaseModel):
+    status_code: int = Field(
+        200, description="HTTP status code the question would have got from /chat."
+    )
+    id: Optional[str] = None
+    response: Optional[str] = None
+    reference_question_id: Optional[str] = None
+    log_id: Optional[str] = None
+    prompt_tokens: Optional[int] = None
+    error: Optional[str] = Field(None, description="Why the question was not answered.")
 
 
 # Pydantic model for the response schema with detailed parameter descriptions
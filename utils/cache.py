@@ -0,0 +1,136 @@
+# This file contains the in-memory cache used in front of the slower lookups of the app
+
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+
+def normalize_text(text):
+    """
+    Normalize a question for use as a cache key.
+
+    Case is folded and punctuation is replaced with whitespace, so trivially different
+    phrasings share a key.
+    """
+    text = "".join(
+        " " if unicodedata.category(char).startswith("P") else char
+        for char in text.casefold()
+    )
+    return WHITESPACE_PATTERN.sub(" ", text).strip()
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache with an optional time to live.
+
+    Entries can carry tags (e.g. the ids of the documents they were built from) so
+    that every entry depending on a document can be invalidated at once.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # key -> (expires_at, value, tags)
+        self._data = OrderedDict()
+        # tag -> keys
+        self._tags = defaultdict(set)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires_at, value, _ = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._pop(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, tags=()):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._pop(key)
+            self._data[key] = (expires_at, value, tuple(tags))
+            for tag in tags:
+                self._tags[tag].add(key)
+            while len(self._data) > self.maxsize:
+                oldest_key = next(iter(self._data))
+                self._pop(oldest_key)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            if self._pop(key):
+                self.invalidations += 1
+                return True
+            return False
+
+    def invalidate_tag(self, tag):
+        """Drop every entry tagged with `tag`. Returns the number of dropped entries."""
+        with self._lock:
+            keys = list(self._tags.get(tag, ()))
+            for key in keys:
+                self._pop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def invalidate_where(self, predicate):
+        """Drop every entry for which predicate(key, value) is true."""
+        with self._lock:
+            keys = [
+                key for key, (_, value, _) in self._data.items() if predicate(key, value)
+            ]
+            for key in keys:
+                self._pop(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+
+    def _pop(self, key):
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return False
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+        return True
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "invalidations": self.invalidations,
+        }
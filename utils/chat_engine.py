@@ -0,0 +1,92 @@
+# This file contains the lightweight engine running the chat LLM calls
+# The prompt is prepared once at import time and the messages are assembled directly from
+# the stored history window, instead of building a prompt template and an LLMChain on
+# every request. The engine also measures how much time is spent outside the provider.
+
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+
+from utils.metrics import observe
+
+# System prompt, split around the knowledge base context so it is only concatenated
+SYSTEM_PROMPT_PREFIX = """You are a friendly conversational chatbot who responds in the language of the user.
+Use the following information to answer the user's question:
+"""
+SYSTEM_PROMPT_SUFFIX = """
+
+And keep your answer to the point unless the user asks for more details."""
+SUMMARY_PREFIX = """
+
+Summary of the earlier conversation:
+"""
+
+MESSAGE_TYPES = {"human": HumanMessage, "ai": AIMessage}
+
+
+class ProviderTiming(BaseCallbackHandler):
+    """Records when the provider call starts and ends inside an LLM invocation."""
+
+    # called directly instead of through the executor used for sync handlers
+    run_inline = True
+
+    def __init__(self):
+        self.started = None
+        self.ended = None
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.started = time.perf_counter()
+
+    def on_llm_end(self, response, **kwargs):
+        self.ended = time.perf_counter()
+
+
+class ChatEngine:
+    """Runs chat completions of one chat model without chains or prompt templates."""
+
+    def __init__(self, llm):
+        self.llm = llm
+
+    @staticmethod
+    def system_prompt(context, summary=""):
+        prompt = SYSTEM_PROMPT_PREFIX + context + SYSTEM_PROMPT_SUFFIX
+        # in the system prompt, some providers reject a second system message
+        if summary:
+            prompt += SUMMARY_PREFIX + summary
+        return prompt
+
+    @staticmethod
+    def build_messages(system_prompt, history, question):
+        """Assemble the messages from a [role, content] history window."""
+        start = time.perf_counter()
+        messages = [SystemMessage(content=system_prompt)]
+        messages.extend(MESSAGE_TYPES[role](content=content) for role, content in history)
+        messages.append(HumanMessage(content=question))
+        observe("chat.engine.build_messages", (time.perf_counter() - start) * 1000)
+        return messages
+
+    @staticmethod
+    def _observe_overhead(timing, start, end):
+        # wall time of the call that was not spent waiting for the provider
+        if timing.started is not None and timing.ended is not None:
+            overhead = (end - start) - (timing.ended - timing.started)
+            observe("chat.engine.framework_overhead", overhead * 1000)
+
+    async def generate(self, messages):
+        """Return the text of the model's answer."""
+        timing = ProviderTiming()
+        start = time.perf_counter()
+        result = await self.llm.ainvoke(messages, config={"callbacks": [timing]})
+        self._observe_overhead(timing, start, time.perf_counter())
+        return result.content
+
+    async def stream(self, messages):
+        """
+        Yield the text chunks of the model's answer as they are generated.
+
+        The overhead is not measured here, the wall time would include the consumer.
+        """
+        async for chunk in self.llm.astream(messages):
+            if chunk.content:
+                yield chunk.content
@@ -1,6 +1,26 @@
+import glob
 import logging
+import os
+import queue
+import threading
+import time
 from datetime import datetime
-from constants import DB_NAME, CHAT_LOGS_COLLECTION
+
+from bson import ObjectId, json_util
+from pymongo.errors import BulkWriteError
+
+from constants import (
+    DB_NAME,
+    CHAT_LOGS_COLLECTION,
+    CHAT_LOG_QUEUE_SIZE,
+    CHAT_LOG_BATCH_SIZE,
+    CHAT_LOG_FLUSH_INTERVAL,
+    CHAT_LOG_SPILL_FILE,
+)
+from utils.metrics import register_metrics
+
+# Error code of a duplicate _id, a replayed log that was already written
+DUPLICATE_KEY_ERROR = 11000
 
 # Configure logging
 logging.basicConfig(
@@ -10,46 +30,362 @@ logging.basicConfig(
 )
 
 
-def chat_log(client, question, answer, chat_id, reference_question_id):
+def process_alive(pid):
+    """Whether a process with this pid is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ChatLogWriter:
     """
-    Logs the chat interaction into the Chat-Logs collection.
+    Write-behind queue of chat logs, written with `insert_many` by a background thread.
 
-    Args:
-        question (str): The question asked by the user.
-        answer (str): The answer provided.
-        chat_id (str): The unique chat session ID.
-        referenced_question_id (str): The ID of the question.
+    The ObjectId of a log is generated when it is queued, so its id can be returned
+    before the log is written. A batch is written once it has CHAT_LOG_BATCH_SIZE logs
+    or CHAT_LOG_FLUSH_INTERVAL seconds after its first log. When the queue is full or a
+    batch can't be written, the logs are appended to a spill file on disk and written
+    again once the database accepts writes.
 
-    Returns:
-        None
+    Every process spills to its own file, named after CHAT_LOG_SPILL_FILE and its pid,
+    so uvicorn workers never share one. The files left by processes that are gone are
+    taken over on start. Lines that can't be parsed, e.g. cut by a crash, are moved to
+    a ".bad" file instead of being replayed.
     """
 
-    try:
-        # Access the database and collection
-        logging.info(
-            f"Accessing database: {DB_NAME}, collection: {CHAT_LOGS_COLLECTION}."
+    def __init__(
+        self,
+        maxsize=CHAT_LOG_QUEUE_SIZE,
+        batch_size=CHAT_LOG_BATCH_SIZE,
+        interval=CHAT_LOG_FLUSH_INTERVAL,
+        spill_file=CHAT_LOG_SPILL_FILE,
+    ):
+        self.batch_size = batch_size
+        self.interval = interval
+        self.spill_root, self.spill_ext = os.path.splitext(spill_file)
+        self._queue = queue.Queue(maxsize)
+        self._spill_lock = threading.Lock()
+        # id -> log queued or being written, so it can be read before it is written
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._claimed = 0
+        self._client = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.written = 0
+        self.batches = 0
+        self.spilled = 0
+        self.replayed = 0
+        self.quarantined = 0
+        self.errors = 0
+
+    @property
+    def spill_file(self):
+        # the pid is read on every use, the writer may be created before a fork
+        return f"{self.spill_root}.{os.getpid()}{self.spill_ext}"
+
+    @property
+    def bad_file(self):
+        return f"{self.spill_root}{self.spill_ext}.bad"
+
+    def log(self, question, answer, chat_id, reference_question_id):
+        """
+        Queue a chat log entry.
+
+        Returns:
+            str: The ID the log entry will be written with.
+        """
+        return self.log_many([(question, answer, chat_id, reference_question_id)])[0]
+
+    def log_many(self, entries):
+        """
+        Queue several chat log entries at once, e.g. the answers of a batch.
+
+        They are queued together, so they are written by the same `insert_many`.
+
+        Args:
+            entries (list): (question, answer, chat_id, reference_question_id) tuples.
+
+        Returns:
+            list: The IDs the log entries will be written with, in order.
+        """
+        if not entries:
+            return []
+        timestamp = datetime.utcnow()
+        log_entries = [
+            {
+                "_id": ObjectId(),
+                "question": question,
+                "answer": answer,
+                "chat_id": chat_id,
+                "refernced_question_id": reference_question_id,
+                "timestamp": timestamp,
+            }
+            for question, answer, chat_id, reference_question_id in entries
+        ]
+        with self._pending_lock:
+            for log_entry in log_entries:
+                self._pending[str(log_entry["_id"])] = log_entry
+        try:
+            self._queue.put_nowait(log_entries)
+        except queue.Full:
+            # never block the request, the logs are written from disk later
+            self._forget(log_entries)
+            self._spill(log_entries)
+        return [str(log_entry["_id"]) for log_entry in log_entries]
+
+    def get_pending(self, log_id):
+        """The log with this id if it is queued or being written, else None."""
+        with self._pending_lock:
+            return self._pending.get(log_id)
+
+    def find(self, log_id):
+        """
+        The log with this id if it is not written yet: queued or being written by this
+        process, or spilled to disk by any process of this host. None otherwise.
+        """
+        entry = self.get_pending(log_id) or self._find_spilled(log_id)
+        # a replay moves the logs from its file to the pending ones before the file is
+        # removed, look again in case that happened during the search
+        return entry or self.get_pending(log_id)
+
+    def _find_spilled(self, log_id):
+        pattern = f"{glob.escape(self.spill_root)}*{glob.escape(self.spill_ext)}*"
+        for path in glob.glob(pattern):
+            if path.endswith(".bad"):
+                continue
+            try:
+                with open(path, encoding="utf-8", errors="replace") as file:
+                    for line in file:
+                        # only the lines containing the id are parsed
+                        if log_id not in line:
+                            continue
+                        try:
+                            entry = json_util.loads(line)
+                        except Exception:
+                            continue
+                        if isinstance(entry, dict) and str(entry.get("_id")) == log_id:
+                            return entry
+            except OSError:
+                # replayed and removed meanwhile
+                continue
+        return None
+
+    def _forget(self, entries):
+        with self._pending_lock:
+            for entry in entries:
+                self._pending.pop(str(entry.get("_id")), None)
+
+    def start(self, client):
+        """Start the background writer thread."""
+        self._client = client
+        self._stop.clear()
+        self._claim_orphans()
+        self._thread = threading.Thread(
+            target=self._run, name="chat-log-writer", daemon=True
         )
-        db = client[DB_NAME]
-        collection = db[CHAT_LOGS_COLLECTION]
-
-        # Prepare the chat log entry
-        log_entry = {
-            "question": question,
-            "answer": answer,
-            "chat_id": chat_id,
-            "refernced_question_id": reference_question_id,
-            "timestamp": datetime.utcnow(),
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and write everything that is queued or spilled."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        while True:
+            batch = self._next_batch(timeout=0)
+            if not batch:
+                break
+            self._write(batch)
+        self._replay()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                batch = self._next_batch(timeout=self.interval)
+                if batch:
+                    self._write(batch)
+                else:
+                    # idle, write what was spilled meanwhile
+                    self._replay()
+            except Exception as e:
+                # the thread must survive, the logs would pile up in the queue
+                logging.error(f"Chat log writer failed: {e!r}")
+                self.errors += 1
+                self._stop.wait(self.interval)
+
+    def _next_batch(self, timeout):
+        """
+        Collect about batch_size logs, waiting at most `timeout` seconds.
+
+        Logs queued together are never split, so a batch can be a little larger.
+        """
+        batch = []
+        deadline = time.monotonic() + timeout
+        while len(batch) < self.batch_size:
+            try:
+                if timeout:
+                    batch.extend(
+                        self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                    )
+                else:
+                    batch.extend(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch):
+        """Insert a batch, spilling the logs that could not be written. Returns success."""
+        try:
+            return self._insert(batch)
+        finally:
+            # written or spilled, either way no longer pending
+            self._forget(batch)
+
+    def _insert(self, batch):
+        if self._client is None:
+            self._spill(batch)
+            return False
+        try:
+            collection = self._client[DB_NAME][CHAT_LOGS_COLLECTION]
+            collection.insert_many(batch, ordered=False)
+            self.written += len(batch)
+            self.batches += 1
+            logging.info(f"Wrote {len(batch)} chat logs")
+            return True
+        except BulkWriteError as e:
+            # already written logs (a replay) are fine, the others are spilled
+            failed = [
+                batch[error["index"]]
+                for error in e.details.get("writeErrors", [])
+                if error.get("code") != DUPLICATE_KEY_ERROR
+            ]
+            self.written += len(batch) - len(failed)
+            if failed:
+                logging.error(f"Failed to write {len(failed)} chat logs: {e}")
+                self.errors += 1
+                self._spill(failed)
+            return not failed
+        except Exception as e:
+            logging.error(f"Failed to write {len(batch)} chat logs: {e}")
+            self.errors += 1
+            self._spill(batch)
+            return False
+
+    def _spill(self, entries):
+        if not entries:
+            return
+        try:
+            with self._spill_lock, open(self.spill_file, "a", encoding="utf-8") as file:
+                for entry in entries:
+                    file.write(json_util.dumps(entry) + "\n")
+            self.spilled += len(entries)
+        except OSError as e:
+            logging.error(f"Failed to spill {len(entries)} chat logs to disk, dropped: {e}")
+            self.errors += 1
+
+    def _claim(self, path):
+        """Rename a spill file to a replay file of this process, False if it is gone."""
+        self._claimed += 1
+        # unique even next to the replay files of an earlier process with the same pid
+        replay_file = f"{self.spill_file}.replay-{time.time_ns()}-{self._claimed}"
+        try:
+            os.replace(path, replay_file)
+            return True
+        except FileNotFoundError:
+            # claimed by another worker meanwhile
+            return False
+
+    def _claim_orphans(self):
+        """Take over the spill files of the processes that are gone."""
+        pattern = f"{glob.escape(self.spill_root)}*{glob.escape(self.spill_ext)}*"
+        for path in glob.glob(pattern):
+            if path.endswith(".bad"):
+                continue
+            pid = path[len(self.spill_root) :].split(".")[1]
+            # the files of earlier versions have no pid
+            if pid.isdigit() and (int(pid) == os.getpid() or process_alive(int(pid))):
+                continue
+            try:
+                self._claim(path)
+            except OSError as e:
+                logging.error(f"Failed to take over the chat logs of {path}: {e}")
+                self.errors += 1
+
+    def _read_spilled(self, path):
+        """The logs of a spill file, the lines that can't be parsed are quarantined."""
+        entries = []
+        bad_lines = []
+        with open(path, encoding="utf-8", errors="replace") as file:
+            for line in file:
+                if not line.strip():
+                    continue
+                try:
+                    entry = json_util.loads(line)
+                except Exception:
+                    entry = None
+                if isinstance(entry, dict) and "_id" in entry:
+                    entries.append(entry)
+                else:
+                    bad_lines.append(line if line.endswith("\n") else line + "\n")
+        if bad_lines:
+            logging.error(
+                f"Moved {len(bad_lines)} unreadable chat logs of {path} to {self.bad_file}"
+            )
+            with open(self.bad_file, "a", encoding="utf-8") as file:
+                file.writelines(bad_lines)
+            self.quarantined += len(bad_lines)
+        return entries
+
+    def _replay(self):
+        """Write the spilled logs, the ones failing again are spilled again."""
+        with self._spill_lock:
+            if os.path.exists(self.spill_file):
+                self._claim(self.spill_file)
+        # replay files left by a crash are written too
+        for replay_file in sorted(glob.glob(f"{glob.escape(self.spill_file)}.replay*")):
+            entries = []
+            try:
+                entries = self._read_spilled(replay_file)
+                # findable while they are written
+                with self._pending_lock:
+                    for entry in entries:
+                        self._pending[str(entry["_id"])] = entry
+                os.remove(replay_file)
+            except OSError as e:
+                self._forget(entries)
+                logging.error(f"Failed to read the spilled chat logs of {replay_file}: {e}")
+                self.errors += 1
+                continue
+            for start in range(0, len(entries), self.batch_size):
+                batch = entries[start : start + self.batch_size]
+                if not self._write(batch):
+                    # still failing, keep the rest for the next replay
+                    rest = entries[start + self.batch_size :]
+                    self._spill(rest)
+                    self._forget(rest)
+                    return
+                self.replayed += len(batch)
+            if entries:
+                logging.info(f"Replayed {len(entries)} spilled chat logs")
+
+    def stats(self):
+        return {
+            # pending puts, a batch of logs counts once
+            "queued": self._queue.qsize(),
+            "written": self.written,
+            "batches": self.batches,
+            "spilled": self.spilled,
+            "replayed": self.replayed,
+            "quarantined": self.quarantined,
+            "errors": self.errors,
         }
 
-        # Insert the log into the collection
-        result = collection.insert_one(log_entry)
-        if result.acknowledged:
-            logging.info(f"Chat log successfully written with ID: {result.inserted_id}")
-            return str(result.inserted_id)
-        else:
-            logging.error("Failed to write chat log to the database.")
-            return None
-
-    except Exception as e:
-        logging.error(f"An error occurred while logging chat: {e}")
-        return None
+
+chat_log_writer = ChatLogWriter()
+register_metrics("chat_logs", chat_log_writer.stats)
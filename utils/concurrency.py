@@ -0,0 +1,51 @@
+# This file contains the limits bounding how many async operations run at the same time
+# The async routes don't hold a worker thread while waiting, so these semaphores are what
+# keeps a traffic spike from opening unbounded LLM calls or database operations.
+
+import asyncio
+from contextlib import asynccontextmanager
+
+from constants import LLM_CONCURRENCY_LIMIT, DB_CONCURRENCY_LIMIT
+from utils.metrics import register_metrics
+
+
+class ConcurrencyLimiter:
+    """
+    Semaphore that is created on first use, inside the running event loop.
+
+    Creating it at import time would bind it to another loop on Python 3.9.
+    """
+
+    def __init__(self, name, limit):
+        self.name = name
+        self.limit = limit
+        self._semaphore = None
+        self.in_use = 0
+        self.waiting = 0
+
+    @asynccontextmanager
+    async def acquire(self):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_use += 1
+        try:
+            yield
+        finally:
+            self.in_use -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {"limit": self.limit, "in_use": self.in_use, "waiting": self.waiting}
+
+
+llm_limiter = ConcurrencyLimiter("llm", LLM_CONCURRENCY_LIMIT)
+db_limiter = ConcurrencyLimiter("db", DB_CONCURRENCY_LIMIT)
+
+register_metrics(
+    "concurrency", lambda: {limiter.name: limiter.stats() for limiter in (llm_limiter, db_limiter)}
+)
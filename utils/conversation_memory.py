@@ -0,0 +1,120 @@
+# This file decides which part of a chat session is sent to the LLM
+# In "summary" mode the latest messages are sent verbatim as long as they fit in a token
+# budget, and the older ones are folded into a running summary. The summary is generated
+# in the background after the answer was sent, so it never delays a request.
+
+import asyncio
+import logging
+
+from constants import (
+    SESSION_MEMORY,
+    SESSION_HISTORY_TOKEN_BUDGET,
+    SESSION_SUMMARY_MAX_WORDS,
+)
+from utils.llm_router import llm_router
+from utils.metrics import increment, register_metrics, timer
+from utils.session_store import session_store
+from utils.tokens import count_tokens
+
+# Chat ids with a summary being generated, and the tasks generating them
+_summarizing = set()
+_tasks = set()
+
+
+def split_history(messages):
+    """
+    Split the messages at the token budget.
+
+    Returns:
+        tuple: (older messages to summarize, latest messages sent verbatim)
+    """
+    if SESSION_MEMORY != "summary":
+        return [], messages
+
+    tokens = 0
+    start = len(messages)
+    # walk back from the latest message, whole exchanges only
+    while start >= 2:
+        exchange_tokens = sum(
+            count_tokens(content) for _, content in messages[start - 2 : start]
+        )
+        if tokens + exchange_tokens > SESSION_HISTORY_TOKEN_BUDGET:
+            break
+        tokens += exchange_tokens
+        start -= 2
+    return messages[:start], messages[start:]
+
+
+def prompt_history(session):
+    """
+    Return (summary, messages) of the session to put into the prompt.
+
+    Messages over the budget that are not summarized yet are left out until their
+    summary is ready.
+    """
+    _, recent = split_history(session["messages"])
+    return session["summary"], recent
+
+
+async def remember(chat_id, session, question, answer):
+    """Save an exchange and fold the messages over the budget into the summary."""
+    exchange = [["human", question], ["ai", answer]]
+    await session_store.append(chat_id, exchange)
+
+    if SESSION_MEMORY != "summary" or chat_id in _summarizing:
+        return
+    older, _ = split_history(session["messages"] + exchange)
+    if not older:
+        return
+    _summarizing.add(chat_id)
+    task = asyncio.ensure_future(
+        fold(chat_id, session["summary"], older, session["start"] + len(older))
+    )
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def summarize(summary, messages):
+    """Extend a conversation summary with the given messages."""
+    conversation = "\n".join(
+        f"{'User' if role == 'human' else 'Assistant'}: {content}"
+        for role, content in messages
+    )
+    prompt = (
+        f"Summarize the conversation between a user and an assistant below in at most "
+        f"{SESSION_SUMMARY_MAX_WORDS} words, in the language of the conversation. Keep "
+        f"the facts, names and questions the user may refer to later and only give the "
+        f"summary in output and nothing else.\n\n"
+    )
+    if summary:
+        prompt += f"Summary of the earlier conversation:\n{summary}\n\n"
+    prompt += f"Conversation:\n{conversation}"
+
+    response = await llm_router.ainvoke(prompt)
+    return response.content.strip()
+
+
+async def fold(chat_id, summary, messages, end):
+    """Summarize the messages and drop them from the session, up to the position `end`."""
+    try:
+        with timer("chat.summary"):
+            new_summary = await summarize(summary, messages)
+        await session_store.fold(chat_id, new_summary, end)
+        increment("chat.summaries")
+    except Exception as e:
+        logging.error(f"Failed to summarize chat session {chat_id}: {e}")
+        increment("chat.summary_errors")
+    finally:
+        _summarizing.discard(chat_id)
+
+
+async def wait_for_summaries():
+    """Wait for the summaries being generated, e.g. on shutdown."""
+    if _tasks:
+        await asyncio.gather(*_tasks, return_exceptions=True)
+
+
+register_metrics(
+    "conversation_memory",
+    lambda: {"mode": SESSION_MEMORY, "summaries_in_progress": len(_summarizing)},
+)
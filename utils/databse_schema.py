@@ -1,122 +1,226 @@
-# This file is used to initialize a simple databse schema and update the indexes to be used in the code
-# It pauses the initial setup while the index is being created
+# This file is used to initialize the databse schema and update the indexes to be used in the code
+# The desired collections and indexes are declared once and compared with what exists, so
+# only the missing ones are created. The bootstrap runs in a background thread at startup
+# and the process reports ready once the search indexes can be queried.
 
 import logging
+import threading
 import time
+from pymongo import ASCENDING, DESCENDING, errors
 from constants import *
+from utils.metrics import register_metrics
+
+# Definition of the Atlas Search indexes
+SEARCH_INDEX_DEFINITION = {"mappings": {"dynamic": True}}
+
+# Atlas Search indexes per collection
+SEARCH_INDEXES = {
+    MULTILINGUAL_QUESTIONS_COLLECTION: MULTILINGUAL_QUESTIONS_INDEX,
+    UNANSWERED_QUESTIONS_COLLECTION: UNANSWERED_QUESTIONS_INDEX,
+}
+
+
+def desired_collections():
+    """Collections of the database with their indexes, as (keys, options) pairs."""
+    collections = {
+        CHAT_LOGS_COLLECTION: [],
+        # find the language variants of a question, one document per language
+        MULTILINGUAL_QUESTIONS_COLLECTION: [
+            (
+                [("group_id", ASCENDING), ("lang", ASCENDING)],
+                {
+                    "unique": True,
+                    # documents added before the groups have no group_id
+                    "partialFilterExpression": {"group_id": {"$exists": True}},
+                },
+            )
+        ],
+        # rank the unanswered questions by how often they were asked
+        UNANSWERED_QUESTIONS_COLLECTION: [([("count", DESCENDING)], {})],
+        REVIEW_QUESTIONS_COLLECTION: [],
+    }
+    # expire idle chat sessions when they are shared through the database
+    if SESSION_STORE == "mongo":
+        collections[SESSIONS_COLLECTION] = [
+            ([("updated_at", ASCENDING)], {"expireAfterSeconds": SESSION_TTL})
+        ]
+    # expire cached answers and find the ones built from a knowledge base document
+    if RESPONSE_CACHE_PERSISTENT:
+        collections[RESPONSE_CACHE_COLLECTION] = [
+            ([("created_at", ASCENDING)], {"expireAfterSeconds": RESPONSE_CACHE_TTL}),
+            ([("reference_ids", ASCENDING)], {}),
+        ]
+    if TRANSLATION_CACHE_PERSISTENT:
+        collections[TRANSLATION_CACHE_COLLECTION] = []
+    return collections
+
+
+def ensure_indexes(collection, indexes):
+    """Create the missing indexes of a collection and fix changed TTLs."""
+    existing = {
+        tuple(index["key"].items()): index for index in collection.list_indexes()
+    }
+    for keys, options in indexes:
+        index = existing.get(tuple(keys))
+        if index is None:
+            collection.create_index(keys, **options)
+            logging.info(f"Created index {keys} on {collection.name}")
+        elif "expireAfterSeconds" in options and index.get(
+            "expireAfterSeconds"
+        ) != options["expireAfterSeconds"]:
+            collection.database.command(
+                "collMod",
+                collection.name,
+                index={
+                    "keyPattern": dict(keys),
+                    "expireAfterSeconds": options["expireAfterSeconds"],
+                },
+            )
+            logging.info(f"Updated the expiry of index {keys} on {collection.name}")
+
+
+def ensure_search_index(collection, index_name):
+    """
+    Create the search index if it is missing, or update it if its definition changed.
+
+    Returns:
+        bool: False if the deployment has no Atlas Search.
+    """
+    try:
+        existing = list(collection.list_search_indexes(index_name))
+    except errors.OperationFailure as e:
+        logging.warning(f"Atlas Search is not available, {index_name} not created: {e}")
+        return False
+    if not existing:
+        collection.create_search_index(
+            {"definition": SEARCH_INDEX_DEFINITION, "name": index_name}
+        )
+        logging.info(f"Created index {index_name}")
+    elif (
+        existing[0].get("latestDefinition", {}).get("mappings")
+        != SEARCH_INDEX_DEFINITION["mappings"]
+    ):
+        collection.update_search_index(index_name, SEARCH_INDEX_DEFINITION)
+        logging.info(f"Updated index {index_name}")
+    return True
+
+
+def wait_for_search_indexes(db, search_indexes, timeout=SCHEMA_SEARCH_INDEX_TIMEOUT):
+    """Poll the search indexes until they can be queried, at most `timeout` seconds."""
+    pending = dict(search_indexes)
+    deadline = time.monotonic() + timeout
+    while pending:
+        for db_collection, index_name in list(pending.items()):
+            status = next(
+                iter(db[db_collection].list_search_indexes(index_name)), {}
+            )
+            if status.get("queryable"):
+                logging.info(f"Index {index_name} is ready")
+                del pending[db_collection]
+        if not pending:
+            return True
+        if time.monotonic() >= deadline:
+            logging.warning(
+                f"Indexes {list(pending.values())} not ready after {timeout} seconds"
+            )
+            return False
+        time.sleep(SCHEMA_POLL_INTERVAL)
+    return True
 
 
 def check_and_create_db_schema(client):
+    """Create the missing collections and indexes and wait for the search indexes."""
+    db = client[DB_NAME]
+
+    # one listing, creating a collection also creates the database
+    existing = set(db.list_collection_names())
+    for db_collection, indexes in desired_collections().items():
+        if db_collection not in existing:
+            logging.info(f"Collection {db_collection} not found, creating collection")
+            try:
+                db.create_collection(db_collection)
+            except errors.CollectionInvalid:
+                # created by another worker meanwhile
+                pass
+        if indexes:
+            ensure_indexes(db[db_collection], indexes)
+
+    search_indexes = {
+        db_collection: index_name
+        for db_collection, index_name in SEARCH_INDEXES.items()
+        if ensure_search_index(db[db_collection], index_name)
+    }
+    wait_for_search_indexes(db, search_indexes)
+    logging.info("Database setup complete")
 
-    # Counter variable later used to add a 5 second delay if a table is created before creating indexes
-    count = 0
-
-    logging.basicConfig(level=logging.INFO)
-    if DB_NAME not in client.list_database_names():
-        logging.info("Database not found, creating database")
-        db = client[DB_NAME]
-        count += 1
-    else:
-        logging.info("Database found")
-        db = client[DB_NAME]
-
-    # Create collections if they don't exist
-    if CHAT_LOGS_COLLECTION not in db.list_collection_names():
-        logging.info("Chat Logs Collection not found, creating collection")
-        db.create_collection(CHAT_LOGS_COLLECTION)
-        db[CHAT_LOGS_COLLECTION].insert_one({"dummy": "dummy"})
-        db[CHAT_LOGS_COLLECTION].delete_one({"dummy": "dummy"})
-        count += 1
-    else:
-        logging.info("Chat Logs Collection found")
-
-    if MULTILINGUAL_QUESTIONS_COLLECTION not in db.list_collection_names():
-        logging.info("Multilingual Questions Collection not found, creating collection")
-        db.create_collection(MULTILINGUAL_QUESTIONS_COLLECTION)
-        db[MULTILINGUAL_QUESTIONS_COLLECTION].insert_one({"dummy": "dummy"})
-        db[MULTILINGUAL_QUESTIONS_COLLECTION].delete_one({"dummy": "dummy"})
-        count += 1
-    else:
-        logging.info("Multilingual Questions Collection found")
-
-    if UNANSWERED_QUESTIONS_COLLECTION not in db.list_collection_names():
-        logging.info("Unanswered Questions Collection not found, creating collection")
-        db.create_collection(UNANSWERED_QUESTIONS_COLLECTION)
-        db[UNANSWERED_QUESTIONS_COLLECTION].insert_one({"dummy": "dummy"})
-        db[UNANSWERED_QUESTIONS_COLLECTION].delete_one({"dummy": "dummy"})
-        count += 1
-    else:
-        logging.info("Unanswered Questions Collection found")
-
-    if REVIEW_QUESTIONS_COLLECTION not in db.list_collection_names():
-        logging.info("Review Questions Collection not found, creating collection")
-        db.create_collection(REVIEW_QUESTIONS_COLLECTION)
-        db[REVIEW_QUESTIONS_COLLECTION].insert_one({"dummy": "dummy"})
-        db[REVIEW_QUESTIONS_COLLECTION].delete_one({"dummy": "dummy"})
-        count += 1
-    else:
-        logging.info("Review Questions Collection found")
 
-    logging.info("Database setup complete")
+class SchemaBootstrap:
+    """
+    Runs the schema setup and the other startup steps in a background thread.
 
-    # If any collection is created, wait for 5 seconds to let the indexes be created
-    if count > 0:
-        time.sleep(5)
+    Every step is idempotent, so the whole bootstrap is retried until it succeeds,
+    e.g. when the database is not reachable yet at startup.
+    """
 
-    # check if index exists
-    collection = db[MULTILINGUAL_QUESTIONS_COLLECTION]
-    try:
-        new_index_definition = {"mappings": {"dynamic": True}}
+    def __init__(self):
+        self.state = "pending"
+        self.error = None
+        self.attempts = 0
+        self.duration = None
+        self._ready = threading.Event()
+        self._thread = None
+
+    def ready(self):
+        return self._ready.is_set()
 
-        collection.update_search_index(
-            MULTILINGUAL_QUESTIONS_INDEX, new_index_definition
+    def start(self, client, steps=()):
+        """Start the bootstrap, then run each `step(client)`, e.g. warming caches up."""
+        self._thread = threading.Thread(
+            target=self._run, args=(client, steps), name="schema-bootstrap", daemon=True
         )
-        logging.info(f"Updated index {MULTILINGUAL_QUESTIONS_INDEX}")
-    except:
-        pass
-    try:
-        index = {
-            "definition": {"mappings": {"dynamic": True}},
-            "name": MULTILINGUAL_QUESTIONS_INDEX,
+        self._thread.start()
+
+    def _run(self, client, steps):
+        start = time.perf_counter()
+        while True:
+            self.state = "running"
+            self.attempts += 1
+            try:
+                check_and_create_db_schema(client)
+                for step in steps:
+                    step(client)
+                break
+            except Exception as e:
+                logging.error(f"Database setup failed, retrying: {e}")
+                self.state = "failed"
+                self.error = str(e)
+                time.sleep(SCHEMA_RETRY_INTERVAL)
+        self.duration = time.perf_counter() - start
+        self.state = "ready"
+        self.error = None
+        self._ready.set()
+        logging.info(f"Startup bootstrap done in {self.duration:.1f} seconds")
+
+    def stats(self):
+        return {
+            "state": self.state,
+            "attempts": self.attempts,
+            "duration_seconds": self.duration,
+            "error": self.error,
         }
-        collection.create_search_index(index)
-        logging.info(f"Created index {MULTILINGUAL_QUESTIONS_INDEX}")
-    except:
-        pass
 
-    collection = db[UNANSWERED_QUESTIONS_COLLECTION]
-    try:
-        new_index_definition = {"mappings": {"dynamic": True}}
 
-        collection.update_search_index(UNANSWERED_QUESTIONS_INDEX, new_index_definition)
-        logging.info(f"Updated index {UNANSWERED_QUESTIONS_INDEX}")
-    except:
-        pass
-    try:
-        index = {
-            "definition": {"mappings": {"dynamic": True}},
-            "name": UNANSWERED_QUESTIONS_INDEX,
-        }
-        collection.create_search_index(index)
-        logging.info(f"Created index {UNANSWERED_QUESTIONS_INDEX}")
-    except:
-        pass
+schema_bootstrap = SchemaBootstrap()
+register_metrics("schema_bootstrap", schema_bootstrap.stats)
 
 
-# function to update the index of the given collection
+# function to update the index of the given collection, creating it if it doesn't exist
 def update_index(collection, index_name):
     try:
-        new_index_definition = {"mappings": {"dynamic": True}}
-        collection.update_search_index(index_name, new_index_definition)
+        collection.update_search_index(index_name, SEARCH_INDEX_DEFINITION)
         logging.info(f"Updated index {index_name}")
-    except Exception as e:
-        logging.error(e)
-    try:
-        index = {
-            "definition": {"mappings": {"dynamic": True}},
-            "name": index_name,
-        }
-        collection.create_search_index(index)
+    except errors.OperationFailure:
+        collection.create_search_index(
+            {"definition": SEARCH_INDEX_DEFINITION, "name": index_name}
+        )
         logging.info(f"Created index {index_name}")
-    except:
-        pass
@@ -1,4 +1,6 @@
 import logging
+from bson import ObjectId
+from pymongo import UpdateOne
 
 
 from constants import (
@@ -9,12 +11,22 @@ from constants import (
     UNANSWERED_QUESTIONS_INDEX,
     SCORE_THRESHOLD_MULTILINGUAL,
     SCORE_THRESHOLD_UNANSWERED,
+    COMBINED_RETRIEVAL,
+    RETRIEVAL_CACHE_SIZE,
+    RETRIEVAL_CACHE_TTL,
+    RETRIEVAL_TOP_K,
+    UNANSWERED_TRACKING,
 )
+from utils.retriever import get_retriever, tokenize
+from utils.rerank import select_passages
+from utils.cache import LRUCache
+from utils.metrics import register_metrics, timer
+from utils.unanswered import unanswered_recorder
+from utils.response_cache import response_cache
+from utils.concurrency import db_limiter
+from utils.singleflight import SingleFlight
 
-# MongoDB Atlas Search parameters
-
-SEARCH_PATH = "*"
-SORT_ORDER = -1
+# Retrieval parameters
 LIMIT = 1
 
 # Error codes
@@ -27,87 +39,392 @@ logging.basicConfig(
     handlers=[logging.StreamHandler()],
 )
 
+# Collections searched by the combined retrieval, with their index and threshold
+COMBINED_SOURCES = [
+    (
+        MULTILINGUAL_QUESTIONS_COLLECTION,
+        MULTILINGUAL_QUESTIONS_INDEX,
+        SCORE_THRESHOLD_MULTILINGUAL,
+    ),
+    (
+        UNANSWERED_QUESTIONS_COLLECTION,
+        UNANSWERED_QUESTIONS_INDEX,
+        SCORE_THRESHOLD_UNANSWERED,
+    ),
+]
+
+# Cache of knowledge base passages keyed by the language and the search terms of the question
+retrieval_cache = LRUCache(RETRIEVAL_CACHE_SIZE, RETRIEVAL_CACHE_TTL)
+register_metrics("retrieval_cache", retrieval_cache.stats)
+
+# Concurrent retrievals of the same question share one search
+retrieval_flight = SingleFlight("retrieval")
+register_metrics("retrieval_singleflight", retrieval_flight.stats)
+
+
+async def afind_passages_in_knowledge_base(client, question, lang=None):
+    """
+    Fetch the top RETRIEVAL_TOP_K candidates and rerank them into LLM context passages.
+
+    If `lang` is given only that language partition (and untagged documents)
+    is searched. Hits are cached by language and search terms. Misses are
+    not cached, so every miss is still recorded in the unanswered questions
+    collection. Concurrent lookups of the same question are coalesced into one search.
+
+    Returns:
+        list: passages ({"id", "question", "answer", "lang", "group_id", "score",
+        "rerank_score"}) best first, empty if nothing passed the threshold.
+    """
+    cache_key, cached = get_cached_passages(question, lang)
+    if cached is not None:
+        return cached
+
+    passages, coalesced = await retrieval_flight.do(
+        cache_key, lambda: asearch_passages(client, cache_key, question, lang)
+    )
+    if coalesced:
+        # every ask still counts towards its unanswered question, the combined and
+        # sequential lookups only record the miss of the search they shared
+        if not passages and UNANSWERED_TRACKING == "lsh":
+            unanswered_recorder.record(question, lang)
+        return list(passages)
+    return passages
 
-def find_answer_in_knowledge_base(client, question):
-    """Search for an exact match in the knowledge base."""
-    result, error_code = fetch_top_result(
+
+async def asearch_passages(client, cache_key, question, lang=None):
+    """Search the knowledge base and rerank the candidates into passages."""
+    with timer("retrieval.search"):
+        # misses are clustered in memory, so only the knowledge base is searched and
+        # COMBINED_RETRIEVAL has nothing to combine
+        if UNANSWERED_TRACKING == "lsh":
+            candidates = await afind_candidates_tracked(client, question, lang)
+        elif COMBINED_RETRIEVAL:
+            candidates = await afind_candidates_combined(client, question, lang)
+        else:
+            candidates = await afind_candidates_sequential(client, question, lang)
+    return rerank_passages(cache_key, question, candidates)
+
+
+async def afind_group_answer(client, group_id, lang):
+    """
+    Return the answer of the language variant `lang` of a question group, None if the
+    group has none. An indexed lookup on (group_id, lang).
+    """
+    async with db_limiter.acquire():
+        document = await client[DB_NAME][MULTILINGUAL_QUESTIONS_COLLECTION].find_one(
+            {"group_id": ObjectId(group_id), "lang": lang}, {"answer": 1}
+        )
+    return document["answer"] if document is not None else None
+
+
+async def afind_passages_batch(client, questions, langs):
+    """
+    Find the passages of several questions with one bulk retrieval pass.
+
+    Cached questions are answered from the retrieval cache, the others are searched
+    together by the retrieval backend (a single aggregation for Atlas Search) and their
+    misses are recorded in the unanswered questions with one bulk write.
+
+    Returns:
+        list: the passages of every question, in order, empty on a miss.
+    """
+    results = [None] * len(questions)
+    # cache key -> indexes of the questions still to search
+    pending = {}
+    for index, (question, lang) in enumerate(zip(questions, langs)):
+        cache_key, cached = get_cached_passages(question, lang)
+        if cached is not None:
+            results[index] = cached
+        else:
+            pending.setdefault(cache_key, []).append(index)
+
+    if pending:
+        queries = [
+            (questions[indexes[0]], langs[indexes[0]]) for indexes in pending.values()
+        ]
+        with timer("retrieval.batch_search"):
+            candidate_lists = await get_retriever().abatch_search(
+                client,
+                queries,
+                MULTILINGUAL_QUESTIONS_COLLECTION,
+                MULTILINGUAL_QUESTIONS_INDEX,
+                SCORE_THRESHOLD_MULTILINGUAL,
+                RETRIEVAL_TOP_K,
+            )
+
+        misses = []
+        for (cache_key, indexes), (question, lang), candidates in zip(
+            pending.items(), queries, candidate_lists
+        ):
+            passages = rerank_passages(cache_key, question, candidates)
+            for index in indexes:
+                results[index] = list(passages)
+                if not passages:
+                    misses.append((questions[index], langs[index]))
+        if misses:
+            await arecord_misses(client, misses)
+    return results
+
+
+async def arecord_misses(client, misses):
+    """Record (question, lang) misses of a batch in the unanswered questions."""
+    if UNANSWERED_TRACKING == "lsh":
+        for question, lang in misses:
+            unanswered_recorder.record(question, lang)
+        return
+
+    # like the combined lookup, the upserts keep a question from being stored twice
+    operations = [
+        UpdateOne(
+            {"question": question},
+            {"$setOnInsert": {"question": question, "lang": lang}},
+            upsert=True,
+        )
+        for question, lang in misses
+    ]
+    try:
+        async with db_limiter.acquire():
+            result = await client[DB_NAME][UNANSWERED_QUESTIONS_COLLECTION].bulk_write(
+                operations, ordered=False
+            )
+    except Exception as e:
+        logging.error(f"Failed to record the unanswered questions of a batch: {e}")
+        return
+    on_documents_added(
+        UNANSWERED_QUESTIONS_COLLECTION,
+        [
+            {"_id": doc_id, "question": misses[index][0], "lang": misses[index][1]}
+            for index, doc_id in result.upserted_ids.items()
+        ],
+    )
+    logging.info(f"Added {len(result.upserted_ids)} questions to unanswered questions")
+
+
+def get_cached_passages(question, lang):
+    """
+    Return (cache_key, cached passages or None).
+
+    The key holds the terms the lexical search sees, so questions differing only in
+    case or punctuation share an entry and an insert can find the entries it affects.
+    """
+    cache_key = (lang, " ".join(tokenize(question)))
+    cached = retrieval_cache.get(cache_key)
+    if cached is not None:
+        logging.info(f"Retrieval cache hit for question: '{question}'")
+        return cache_key, list(cached)
+    return cache_key, None
+
+
+def rerank_passages(cache_key, question, candidates):
+    """Rerank the candidates into passages and cache them."""
+    if not candidates:
+        return []
+
+    with timer("retrieval.rerank"):
+        passages = [
+            {
+                "id": str(candidate["_id"]),
+                "question": candidate.get("question"),
+                "answer": candidate.get("answer"),
+                "lang": candidate.get("lang"),
+                "group_id": (
+                    str(candidate["group_id"]) if candidate.get("group_id") else None
+                ),
+                "score": candidate.get("score"),
+                "rerank_score": candidate["rerank_score"],
+            }
+            for candidate in select_passages(question, candidates)
+        ]
+
+    retrieval_cache.set(
+        cache_key, tuple(passages), tags=[passage["id"] for passage in passages]
+    )
+    return passages
+
+
+def on_documents_added(db_collection, documents):
+    """Keep the retrieval backend and the retrieval cache in sync after an insert."""
+    retriever = get_retriever()
+    for document in documents:
+        retriever.document_added(db_collection, document)
+
+    if db_collection != MULTILINGUAL_QUESTIONS_COLLECTION or not documents:
+        return
+    if not retriever.lexical:
+        # A new document can be the best match without any common term, e.g. through
+        # the character n-grams of a misspelled question, so every entry of its
+        # language (and of the questions searched in all languages) is dropped
+        langs = {document.get("lang") for document in documents}
+        retrieval_cache.invalidate_where(
+            lambda key, value: None in langs or key[0] in langs or key[0] is None
+        )
+        return
+    # A new document can only change the lexical results of questions sharing
+    # at least one term with it, so only those entries are dropped. The keys hold
+    # the tokenized question, the terms are compared as the search compares them.
+    terms = set()
+    for document in documents:
+        terms.update(tokenize(document.get("question")))
+        terms.update(tokenize(document.get("answer")))
+    retrieval_cache.invalidate_where(
+        lambda key, value: not terms.isdisjoint(key[1].split())
+    )
+
+
+def on_document_removed(db_collection, doc_id, client=None):
+    """
+    Keep the retrieval backend and the caches in sync after a delete or a replace.
+
+    With a `client`, the answers cached in the database are invalidated as well.
+    """
+    get_retriever().document_removed(db_collection, doc_id)
+    if db_collection == MULTILINGUAL_QUESTIONS_COLLECTION:
+        retrieval_cache.invalidate_tag(str(doc_id))
+        response_cache.invalidate_document(doc_id, client)
+    elif db_collection == UNANSWERED_QUESTIONS_COLLECTION:
+        unanswered_recorder.remove(doc_id)
+
+
+async def afind_candidates_tracked(client, question, lang=None):
+    """
+    Search the knowledge base and count a miss in the unanswered question clusters.
+
+    The miss is only recorded in memory, the background flush of the
+    unanswered recorder writes it to the database.
+
+    Returns:
+        list: knowledge base documents best first, empty on a miss.
+    """
+    results, error_code = await afetch_top_results(
         client,
         question,
         MULTILINGUAL_QUESTIONS_COLLECTION,
         MULTILINGUAL_QUESTIONS_INDEX,
         SCORE_THRESHOLD_MULTILINGUAL,
+        lang,
+        RETRIEVAL_TOP_K,
     )
-    if error_code:
-        # adding to unanswered questions if not already present
-        result, error_code = fetch_top_result(
-            client,
-            question,
-            UNANSWERED_QUESTIONS_COLLECTION,
-            UNANSWERED_QUESTIONS_INDEX,
-            SCORE_THRESHOLD_UNANSWERED,
-        )
-        if result is None:
-            unanswered_collection = client[DB_NAME][UNANSWERED_QUESTIONS_COLLECTION]
-            document = {"question": question}
-            unanswered_collection.insert_one(document)
-            logging.info(f"Added question to unanswered questions: '{question}'")
-            return ["", None]
+    if error_code == ERROR_CODE_NO_RESULTS:
+        unanswered_recorder.record(question, lang)
+    return results or []
 
-        logging.info(f"Found question in unanswered questions Already: '{question}'")
-        return ["", None]
+
+async def afind_candidates_sequential(client, question, lang=None):
+    """
+    Search the knowledge base, then the unanswered questions on a miss.
+
+    Returns:
+        list: knowledge base documents best first, empty on a miss.
+    """
+    results, error_code = await afetch_top_results(
+        client,
+        question,
+        MULTILINGUAL_QUESTIONS_COLLECTION,
+        MULTILINGUAL_QUESTIONS_INDEX,
+        SCORE_THRESHOLD_MULTILINGUAL,
+        lang,
+        RETRIEVAL_TOP_K,
+    )
+    if not error_code:
+        return results
+
+    # adding to unanswered questions if not already present
+    unanswered, error_code = await afetch_top_results(
+        client,
+        question,
+        UNANSWERED_QUESTIONS_COLLECTION,
+        UNANSWERED_QUESTIONS_INDEX,
+        SCORE_THRESHOLD_UNANSWERED,
+        lang,
+    )
+    if unanswered is None:
+        unanswered_collection = client[DB_NAME][UNANSWERED_QUESTIONS_COLLECTION]
+        document = {"question": question, "lang": lang}
+        async with db_limiter.acquire():
+            await unanswered_collection.insert_one(document)
+        on_documents_added(UNANSWERED_QUESTIONS_COLLECTION, [document])
+        logging.info(f"Added question to unanswered questions: '{question}'")
     else:
-        return result
+        logging.info(f"Found question in unanswered questions Already: '{question}'")
+    return []
 
 
-def fetch_top_result(client, question, db_collection, db_index, score_threshold):
+async def afind_candidates_combined(client, question, lang=None):
     """
-    Fetches the top result for a question using MongoDB aggregation pipeline.
+    Search the knowledge base and the unanswered questions in a single query.
 
-    Args:
-        question (str): The question to search.
+    On a miss the question is upserted into the unanswered questions collection,
+    so the whole miss path costs one search and at most one write.
 
     Returns:
-        tuple: (result, error_code)
-            - result: [id, answer] if found, else None.
-            - error_code: None if successful, or error code string.
+        list: knowledge base documents best first, empty on a miss.
     """
-
+    retriever = get_retriever()
     try:
-        # Access the database and collection
         logging.info(
-            f"Accessing database: {DB_NAME}, collection: {MULTILINGUAL_QUESTIONS_COLLECTION}."
+            f"Executing combined {retriever.name} search for question: '{question}'"
+        )
+        results = await retriever.acombined_search(
+            client, question, COMBINED_SOURCES, RETRIEVAL_TOP_K, lang
         )
-        db = client[DB_NAME]
-        collection = db[db_collection]
+    except Exception as e:
+        logging.error(f"An error occurred during query execution: {e}")
+        return []
 
-        # Define the aggregation pipeline
-        pipeline = [
-            {
-                "$search": {
-                    "index": db_index,
-                    "text": {"query": question, "path": {"wildcard": SEARCH_PATH}},
-                }
-            },
-            {"$addFields": {"score": {"$meta": "searchScore"}}},
-            {"$match": {"score": {"$gt": score_threshold}}},
-            {"$sort": {"score": SORT_ORDER}},
-            {"$limit": LIMIT},
-        ]
+    if results[MULTILINGUAL_QUESTIONS_COLLECTION]:
+        top_result = results[MULTILINGUAL_QUESTIONS_COLLECTION][0]
+        logging.info(f"Top result found with score: {top_result.get('score')}")
+        return results[MULTILINGUAL_QUESTIONS_COLLECTION]
 
-        # Log the query execution
-        logging.info(f"Executing aggregation pipeline for question: '{question}'")
-        results = list(collection.aggregate(pipeline))
+    if results[UNANSWERED_QUESTIONS_COLLECTION]:
+        logging.info(f"Found question in unanswered questions Already: '{question}'")
+        return []
 
-        # Handle results
-        if results:
-            top_result = results[0]
-            logging.info(f"Top result found with score: {top_result.get('score')}")
-            return [str(top_result["_id"]), top_result.get("answer", None)], None
-        else:
-            logging.warning("No results found with a score above the threshold.")
-            logging.info("Adding the question to unanswered questions.")
+    # adding to unanswered questions, the upsert keeps concurrent misses from duplicating it
+    unanswered_collection = client[DB_NAME][UNANSWERED_QUESTIONS_COLLECTION]
+    document = {"question": question, "lang": lang}
+    async with db_limiter.acquire():
+        result = await unanswered_collection.update_one(
+            {"question": question}, {"$setOnInsert": document}, upsert=True
+        )
+    if result.upserted_id is not None:
+        on_documents_added(
+            UNANSWERED_QUESTIONS_COLLECTION, [{"_id": result.upserted_id, **document}]
+        )
+        logging.info(f"Added question to unanswered questions: '{question}'")
+    return []
+
+
+async def afetch_top_results(
+    client, question, db_collection, db_index, score_threshold, lang=None, limit=LIMIT
+):
+    """
+    Fetches the top results for a question using the configured retrieval backend.
+
+    Args:
+        question (str): The question to search.
+        db_collection (str): The collection to search in.
+        db_index (str): The Atlas Search index of the collection.
+        score_threshold (float): Minimum score for a result to count as a match.
+        lang (str): Language partition to search, all languages if None.
+        limit (int): Maximum number of results.
 
-            return None, ERROR_CODE_NO_RESULTS
+    Returns:
+        tuple: (results, error_code)
+            - results: list of documents best first if found, else None.
+            - error_code: None if successful, or error code string.
+    """
+    try:
+        retriever = get_retriever()
+        logging.info(f"Executing {retriever.name} search for question: '{question}'")
+        results = await retriever.asearch(
+            client, question, db_collection, db_index, score_threshold, limit, lang
+        )
+        if results:
+            logging.info(f"Top result found with score: {results[0].get('score')}")
+            return results, None
+        logging.warning("No results found with a score above the threshold.")
+        return None, ERROR_CODE_NO_RESULTS
 
     except Exception as e:
         logging.error(f"An error occurred during query execution: {e}")
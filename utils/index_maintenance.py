@@ -0,0 +1,145 @@
+# This file contains the scheduler updating the Atlas Search indexes in the background
+# Requests only mark an index as dirty and return. A background thread updates each dirty
+# index once the burst of changes has settled (no change for INDEX_UPDATE_DELAY seconds, or
+# INDEX_UPDATE_MAX_DELAY seconds after its first change), at most once per
+# INDEX_UPDATE_INTERVAL, so a burst of inserts or misses costs one index update instead of
+# one per request.
+
+import logging
+import threading
+import time
+
+from constants import (
+    DB_NAME,
+    INDEX_UPDATE_DELAY,
+    INDEX_UPDATE_MAX_DELAY,
+    INDEX_UPDATE_INTERVAL,
+    INDEX_MAINTENANCE_POLL_INTERVAL,
+)
+from utils.databse_schema import update_index
+from utils.metrics import register_metrics, timer
+
+
+class IndexMaintenanceScheduler:
+    """Coalesces index update requests per collection and runs them in a background thread."""
+
+    def __init__(
+        self,
+        delay=INDEX_UPDATE_DELAY,
+        interval=INDEX_UPDATE_INTERVAL,
+        poll_interval=INDEX_MAINTENANCE_POLL_INTERVAL,
+        max_delay=INDEX_UPDATE_MAX_DELAY,
+    ):
+        self.delay = delay
+        self.max_delay = max_delay
+        self.interval = interval
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        # (db_collection, index_name) -> monotonic times the index was first and last
+        # marked dirty
+        self._dirty = {}
+        # (db_collection, index_name) -> monotonic time of the last update
+        self._updated_at = {}
+        self._client = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.requests = 0
+        self.coalesced = 0
+        self.completed = 0
+        self.errors = 0
+
+    def mark_dirty(self, db_collection, index_name):
+        """Request an update of the index, returns right away."""
+        key = (db_collection, index_name)
+        now = time.monotonic()
+        with self._lock:
+            self.requests += 1
+            if key in self._dirty:
+                self.coalesced += 1
+                # every change postpones the update until the burst settled
+                self._dirty[key] = (self._dirty[key][0], now)
+                return
+            self._dirty[key] = (now, now)
+
+    def _due(self, force=False):
+        """
+        Dirty indexes whose burst settled, or lasted max_delay already, and whose last
+        update is old enough.
+        """
+        now = time.monotonic()
+        with self._lock:
+            due = [
+                key
+                for key, (first_marked_at, last_marked_at) in self._dirty.items()
+                if force
+                or (
+                    (
+                        now >= last_marked_at + self.delay
+                        # a steady stream of changes can't postpone the update forever
+                        or now >= first_marked_at + self.max_delay
+                    )
+                    and now >= self._updated_at.get(key, float("-inf")) + self.interval
+                )
+            ]
+            for key in due:
+                # changes arriving during the update mark the index dirty again
+                del self._dirty[key]
+                self._updated_at[key] = now
+        return due
+
+    def run_pending(self, force=False):
+        """Update the due indexes, or all dirty ones if `force`. Returns the number updated."""
+        client = self._client
+        if client is None:
+            return 0
+        due = self._due(force)
+        for db_collection, index_name in due:
+            try:
+                with timer("index_maintenance.update"):
+                    update_index(client[DB_NAME][db_collection], index_name)
+                self.completed += 1
+            except Exception as e:
+                logging.error(f"Failed to update index {index_name}: {e}")
+                self.errors += 1
+                # try again at the next interval
+                now = time.monotonic()
+                with self._lock:
+                    self._dirty.setdefault((db_collection, index_name), (now, now))
+        return len(due)
+
+    def start(self, client):
+        """Start the background thread updating the indexes with `client`."""
+        self._client = client
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="index-maintenance", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and run the pending updates."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.run_pending(force=True)
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            self.run_pending()
+
+    def stats(self):
+        with self._lock:
+            pending = [index_name for _, index_name in self._dirty]
+        return {
+            "pending": pending,
+            "requests": self.requests,
+            "coalesced": self.coalesced,
+            "completed": self.completed,
+            "errors": self.errors,
+        }
+
+
+index_scheduler = IndexMaintenanceScheduler()
+register_metrics("index_maintenance", index_scheduler.stats)
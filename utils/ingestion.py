@@ -0,0 +1,244 @@
+# This file contains the knowledge base ingestion shared by the single and the bulk endpoints
+# Bulk uploads are parsed incrementally from the request stream, as JSON lines or CSV, and
+# ingested in batches: the rows of a batch are translated concurrently and written with one
+# insert_many, so a large upload never has to fit in memory.
+
+import asyncio
+import codecs
+import csv
+import json
+import logging
+from datetime import datetime
+
+from bson import ObjectId
+from pydantic import ValidationError
+from pymongo.errors import BulkWriteError
+
+from constants import *
+from utils.base_models import MultilingualQuestionRequest
+from utils.concurrency import db_limiter
+from utils.get_context import on_documents_added
+from utils.translation import translate_to_all_languages
+
+
+def build_documents(translations, references, group_id=None):
+    """
+    Build the knowledge base document of every supported language, linked by a
+    `group_id` (a new one unless given).
+    """
+    group_id = group_id or ObjectId()
+    return [
+        {
+            "question": translations.get(f"{lang}_question"),
+            "answer": translations.get(f"{lang}_answer"),
+            "lang": lang,
+            "group_id": group_id,
+            "references": references or [],
+            "timestamp": datetime.utcnow(),
+        }
+        for lang in SUPPORTED_LANGUAGES
+    ]
+
+
+async def iter_lines(chunks):
+    """Split a stream of byte chunks into text lines, decoding UTF-8 incrementally."""
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        lines = buffer.split("\n")
+        buffer = lines.pop()
+        for line in lines:
+            yield line.rstrip("\r")
+    buffer += decoder.decode(b"", final=True)
+    if buffer:
+        yield buffer.rstrip("\r")
+
+
+async def iter_jsonl_rows(chunks):
+    """Yield (row number, dict or parse error) for every non-blank JSON line."""
+    number = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        number += 1
+        try:
+            row = json.loads(line)
+            if not isinstance(row, dict):
+                raise ValueError("A row must be a JSON object.")
+            yield number, row
+        except ValueError as e:
+            yield number, e
+
+
+async def iter_csv_rows(chunks):
+    """
+    Yield (row number, dict or parse error) for every CSV record after the header.
+
+    Quoted fields may contain line breaks, a record ends with a line that leaves its
+    quotes balanced. The references column holds whitespace separated URLs.
+    """
+    header = None
+    number = 0
+    record = []
+    async for line in iter_lines(chunks):
+        record.append(line)
+        text = "\n".join(record)
+        if text.count('"') % 2:
+            continue
+        record = []
+        if not text.strip():
+            continue
+        fields = next(csv.reader([text]))
+        if header is None:
+            header = [field.strip() for field in fields]
+            continue
+        number += 1
+        if len(fields) != len(header):
+            yield number, ValueError(
+                f"Expected {len(header)} fields but found {len(fields)}."
+            )
+            continue
+        row = {name: value for name, value in zip(header, fields) if value != ""}
+        if "references" in row:
+            row["references"] = row["references"].split()
+        yield number, row
+    if record:
+        yield number + 1, ValueError("Unterminated quoted field.")
+
+
+async def ingest_rows(rows, client, batch_size=BULK_INGEST_BATCH_SIZE):
+    """
+    Validate, translate and insert the rows of an upload, one batch at a time.
+
+    Returns:
+        dict: the number of "rows", of "inserted_rows" and "inserted_documents", and the
+        "errors" of the rows that were not (completely) inserted.
+    """
+    report = {"rows": 0, "inserted_rows": 0, "inserted_documents": 0, "errors": []}
+    batch = []
+    async for number, row in rows:
+        report["rows"] += 1
+        batch.append((number, row))
+        if len(batch) >= batch_size:
+            await ingest_batch(batch, client, report)
+            batch = []
+    if batch:
+        await ingest_batch(batch, client, report)
+    report["errors"].sort(key=lambda error: error["row"])
+    return report
+
+
+async def ingest_batch(batch, client, report):
+    # validate the rows first, the parse errors are reported as they are
+    requests = []
+    for number, row in batch:
+        if isinstance(row, Exception):
+            report["errors"].append({"row": number, "error": str(row)})
+            continue
+        try:
+            request = MultilingualQuestionRequest(**row)
+            request.validate_languages()
+        except (ValidationError, ValueError, TypeError) as e:
+            report["errors"].append({"row": number, "error": str(e)})
+            continue
+        requests.append((number, request))
+
+    # translate the rows concurrently, the translation limiter bounds the LLM calls
+    translations = await asyncio.gather(
+        *(translate_to_all_languages(request.model_dump()) for _, request in requests),
+        return_exceptions=True,
+    )
+    # documents to insert and the row each of them belongs to
+    documents = []
+    document_rows = []
+    for (number, request), translation in zip(requests, translations):
+        if isinstance(translation, BaseException):
+            logging.error(f"Failed to translate row {number}: {translation!r}")
+            report["errors"].append({"row": number, "error": "Translation failed."})
+            continue
+        row_documents = build_documents(translation, request.references)
+        documents.extend(row_documents)
+        document_rows.extend([number] * len(row_documents))
+    if not documents:
+        return
+
+    failed = set()
+    # whether the failed documents may have been written anyway
+    uncertain = False
+    try:
+        async with db_limiter.acquire():
+            await client[DB_NAME][MULTILINGUAL_QUESTIONS_COLLECTION].insert_many(
+                documents, ordered=False
+            )
+    except BulkWriteError as e:
+        failed = {error["index"] for error in e.details.get("writeErrors", [])}
+    except Exception as e:
+        # e.g. a timeout or a network error after a part of the batch was written
+        logging.error(f"Failed to insert a batch of questions: {e}")
+        failed = set(range(len(documents)))
+        uncertain = True
+    failed_rows = {document_rows[index] for index in failed}
+    if failed_rows:
+        await remove_failed_rows(
+            client, documents, document_rows, failed, report, uncertain
+        )
+
+    inserted = [
+        document
+        for document, number in zip(documents, document_rows)
+        if number not in failed_rows
+    ]
+    report["inserted_rows"] += len(set(document_rows) - failed_rows)
+    report["inserted_documents"] += len(inserted)
+    # keep the retrieval backend and cache in sync with the collection
+    on_documents_added(MULTILINGUAL_QUESTIONS_COLLECTION, inserted)
+
+
+async def remove_failed_rows(
+    client, documents, document_rows, failed, report, uncertain=False
+):
+    """
+    Report the rows with a failed insert and delete their language variants that were
+    inserted, so no incomplete group is left behind. If they can't be deleted, the row
+    is reported with the ids of its inserted variants.
+
+    When it is `uncertain` which documents were written, the groups of all failed rows
+    are deleted, and reported by `group_id` if that fails.
+    """
+    failed_rows = {document_rows[index] for index in failed}
+    # row number -> group_id and <lang>_id of its inserted variants
+    partial = {}
+    for index, (document, number) in enumerate(zip(documents, document_rows)):
+        if number not in failed_rows:
+            continue
+        if uncertain:
+            partial.setdefault(number, {"group_id": document["group_id"]})
+        elif index not in failed:
+            row = partial.setdefault(number, {"group_id": document["group_id"]})
+            row[f"{document['lang']}_id"] = document["_id"]
+
+    if partial:
+        group_ids = [row["group_id"] for row in partial.values()]
+        try:
+            async with db_limiter.acquire():
+                await client[DB_NAME][MULTILINGUAL_QUESTIONS_COLLECTION].delete_many(
+                    {"group_id": {"$in": group_ids}}
+                )
+            partial = {}
+        except Exception as e:
+            logging.error(f"Failed to delete the partially inserted rows: {e}")
+
+    for number in sorted(failed_rows):
+        error = {"row": number, "error": "Failed to insert the row."}
+        if number in partial and uncertain:
+            error["error"] = (
+                "Failed to insert the row, some of its languages may have been inserted."
+            )
+            error["group_id"] = str(partial[number]["group_id"])
+        elif number in partial:
+            error["error"] = "Failed to insert some languages of the row."
+            error["inserted"] = {
+                key: str(value) for key, value in partial[number].items()
+            }
+        report["errors"].append(error)
@@ -0,0 +1,193 @@
+# This file keeps the in-process copies of the knowledge base in sync across workers
+# The local retrieval backends and the retrieval and response caches live in the memory of
+# every uvicorn worker, while a route only updates those of the worker serving it. A change
+# stream on the indexed collections applies the inserts, replaces and deletes made by the
+# other workers. Where change streams are not supported (a standalone server) everything is
+# reloaded every KNOWLEDGE_BASE_RESYNC_INTERVAL seconds instead.
+
+import logging
+import threading
+
+from pymongo import errors
+
+from constants import (
+    DB_NAME,
+    KNOWLEDGE_BASE_RESYNC_INTERVAL,
+    MULTILINGUAL_QUESTIONS_COLLECTION,
+)
+from utils.get_context import on_document_removed, on_documents_added, retrieval_cache
+from utils.metrics import register_metrics
+from utils.response_cache import response_cache
+from utils.retriever import INDEX_PROJECTION, INDEXED_COLLECTIONS, get_retriever
+
+# Error codes of a deployment without change streams, and of a resume token that is no
+# longer in the oplog
+CHANGE_STREAMS_UNSUPPORTED = 40573
+CHANGE_STREAM_HISTORY_LOST = 286
+
+# Milliseconds the server waits for a change before an empty reply, so stop() is noticed
+WATCH_MAX_AWAIT_MS = 1000
+
+WATCH_PIPELINE = [
+    {
+        "$match": {
+            "ns.coll": {"$in": list(INDEXED_COLLECTIONS)},
+            "operationType": {"$in": ["insert", "replace", "update", "delete"]},
+        }
+    }
+]
+
+
+class KnowledgeBaseSync:
+    """Applies the changes of the indexed collections to this process in the background."""
+
+    def __init__(self, interval=KNOWLEDGE_BASE_RESYNC_INTERVAL):
+        self.interval = interval
+        # "change_stream" or "reload", None until the first stream is opened
+        self.mode = None
+        self._client = None
+        self._resume_token = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.changes = 0
+        self.resyncs = 0
+        self.errors = 0
+
+    def start(self, client):
+        """
+        Open the change stream and start applying it in the background.
+
+        Start it before the local indexes are loaded, the changes made during the load
+        are then applied on top of it.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._client = client
+        self._stop.clear()
+        stream = self._open()
+        self._thread = threading.Thread(
+            target=self._run, args=(stream,), name="knowledge-base-sync", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _open(self):
+        """Open the change stream, resuming after the last change seen. None on failure."""
+        try:
+            stream = self._client[DB_NAME].watch(
+                WATCH_PIPELINE,
+                full_document="updateLookup",
+                resume_after=self._resume_token,
+                max_await_time_ms=WATCH_MAX_AWAIT_MS,
+            )
+            self.mode = "change_stream"
+            return stream
+        except errors.OperationFailure as e:
+            if e.code == CHANGE_STREAMS_UNSUPPORTED:
+                logging.warning(
+                    "Change streams are not supported by the database, reloading the "
+                    f"knowledge base every {self.interval} seconds instead"
+                )
+                self.mode = "reload"
+                return None
+            if e.code == CHANGE_STREAM_HISTORY_LOST and self._resume_token is not None:
+                # the missed changes are gone, start over from the current state
+                logging.warning("Knowledge base changes were missed, reloading it")
+                self._resume_token = None
+                stream = self._open()
+                self._safe_resync()
+                return stream
+            logging.error(f"Failed to watch the knowledge base: {e}")
+            self.errors += 1
+            return None
+        except errors.PyMongoError as e:
+            logging.error(f"Failed to watch the knowledge base: {e}")
+            self.errors += 1
+            return None
+
+    def _run(self, stream):
+        while not self._stop.is_set():
+            if stream is None:
+                if self._stop.wait(self.interval):
+                    break
+                if self.mode == "reload":
+                    self._safe_resync()
+                else:
+                    stream = self._open()
+                continue
+            try:
+                change = stream.try_next()
+                if change is not None:
+                    self.apply(change)
+                self._resume_token = stream.resume_token
+            except errors.PyMongoError as e:
+                # reopened after the interval, resuming after the last change applied
+                logging.error(f"Knowledge base change stream failed: {e}")
+                self.errors += 1
+                stream.close()
+                stream = None
+            except Exception as e:
+                logging.error(f"Failed to apply a knowledge base change: {e!r}")
+                self.errors += 1
+        if stream is not None:
+            stream.close()
+
+    def apply(self, change):
+        """Apply one change stream event to the retrieval backend and the caches."""
+        db_collection = change["ns"]["coll"]
+        operation = change["operationType"]
+        doc_id = change["documentKey"]["_id"]
+        if operation == "delete":
+            on_document_removed(db_collection, doc_id)
+            self.changes += 1
+            return
+
+        if operation == "update":
+            description = change.get("updateDescription", {})
+            fields = [
+                *description.get("updatedFields", {}),
+                *description.get("removedFields", []),
+            ]
+            changed = {field.split(".")[0] for field in fields}
+            # e.g. the counts of the unanswered questions, nothing that is indexed
+            if changed.isdisjoint(INDEX_PROJECTION):
+                return
+        if operation != "insert" and db_collection == MULTILINGUAL_QUESTIONS_COLLECTION:
+            # drop the cached answers built from the old version
+            on_document_removed(db_collection, doc_id)
+        document = change.get("fullDocument")
+        if document is not None:
+            on_documents_added(db_collection, [document])
+        self.changes += 1
+
+    def resync(self):
+        """Reload the local indexes and drop the cached retrievals and answers."""
+        get_retriever().warm_up(self._client)
+        retrieval_cache.clear()
+        response_cache.memory.clear()
+        self.resyncs += 1
+
+    def _safe_resync(self):
+        try:
+            self.resync()
+        except Exception as e:
+            logging.error(f"Failed to reload the knowledge base: {e}")
+            self.errors += 1
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "changes": self.changes,
+            "resyncs": self.resyncs,
+            "errors": self.errors,
+        }
+
+
+knowledge_base_sync = KnowledgeBaseSync()
+register_metrics("knowledge_base_sync", knowledge_base_sync.stats)
@@ -0,0 +1,33 @@
+# This file contains the language detection used to route questions to a language partition
+
+import logging
+
+from langdetect import DetectorFactory, LangDetectException, detect_langs
+
+from constants import SUPPORTED_LANGUAGES, LANGUAGE_DETECTION_MIN_CONFIDENCE
+
+# Make detection deterministic for the same input
+DetectorFactory.seed = 0
+
+
+def detect_language(text):
+    """
+    Detect the language of a text.
+
+    Returns:
+        str: one of SUPPORTED_LANGUAGES if detected with at least
+        LANGUAGE_DETECTION_MIN_CONFIDENCE, else None.
+    """
+    try:
+        candidates = detect_langs(text)
+    except LangDetectException as e:
+        logging.warning(f"Language detection failed: {e}")
+        return None
+
+    for candidate in candidates:
+        if (
+            candidate.lang in SUPPORTED_LANGUAGES
+            and candidate.prob >= LANGUAGE_DETECTION_MIN_CONFIDENCE
+        ):
+            return candidate.lang
+    return None
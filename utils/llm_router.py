@@ -0,0 +1,392 @@
+# This file contains the router spreading the LLM calls over all configured providers
+# Every provider with an API key is kept, with its own concurrency and rate limit. Calls go
+# to the currently fastest healthy provider, fail over to the next one on errors or
+# timeouts, and a hedged second request is sent when the first one is slower than usual.
+# Local fake providers can be configured to test the routing without any API key.
+
+import asyncio
+import logging
+import os
+import random
+import time
+from collections import deque
+from types import SimpleNamespace
+
+from constants import (
+    GROQ_API_KEY,
+    MODEL_TEMPERATURE,
+    LLM_PROVIDERS,
+    LLM_TIMEOUT,
+    LLM_HEDGE_ENABLED,
+    LLM_HEDGE_MIN_DELAY,
+    LLM_HEDGE_PERCENTILE,
+    LLM_EWMA_ALPHA,
+    LLM_FAILURE_COOLDOWN,
+)
+from utils.concurrency import ConcurrencyLimiter
+from utils.metrics import increment, percentile, register_metrics
+
+# Models that may answer, part of the keys of the cached LLM outputs so they are dropped
+# when the configuration changes
+MODELS = ",".join(provider.get("model", provider["name"]) for provider in LLM_PROVIDERS)
+
+# Number of recent latencies kept per provider for the hedging delay
+LATENCY_SAMPLES = 200
+# Latencies needed before hedging a provider's requests
+MIN_HEDGE_SAMPLES = 20
+# Consecutive failures after which a provider is skipped for LLM_FAILURE_COOLDOWN
+MAX_CONSECUTIVE_FAILURES = 3
+
+
+class LLMUnavailableError(Exception):
+    """Raised when no provider could answer."""
+
+
+class FakeChatModel:
+    """
+    Local stand-in for a chat model, answering after `latency` seconds.
+
+    Fails with probability `failure_rate`, for testing the failover and hedging.
+    """
+
+    def __init__(self, response="This is a test answer.", latency=0.1, failure_rate=0.0):
+        self.response = response
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    async def ainvoke(self, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Fake provider failure")
+        return SimpleNamespace(content=self.response)
+
+    async def astream(self, messages, **kwargs):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise RuntimeError("Fake provider failure")
+        for word in self.response.split(" "):
+            yield SimpleNamespace(content=word + " ")
+
+
+def build_chat_model(config):
+    """Create the chat model of a provider config, None if its API key is missing."""
+    kind = config["kind"]
+    model = config.get("model")
+    # the provider packages are only imported when they are used
+    if kind == "groq" and GROQ_API_KEY:
+        from langchain_groq import ChatGroq
+
+        return ChatGroq(
+            groq_api_key=GROQ_API_KEY, model_name=model, temperature=MODEL_TEMPERATURE
+        )
+    if kind == "openai" and os.getenv("OPENAI_API_KEY"):
+        from langchain_openai import ChatOpenAI
+
+        return ChatOpenAI(model=model, temperature=MODEL_TEMPERATURE, max_retries=0)
+    if kind == "google" and os.getenv("GOOGLE_API_KEY"):
+        from langchain_google_genai import ChatGoogleGenerativeAI
+
+        return ChatGoogleGenerativeAI(model=model, temperature=MODEL_TEMPERATURE)
+    if kind == "fake":
+        return FakeChatModel(
+            config.get("response", "This is a test answer."),
+            config.get("latency", 0.1),
+            config.get("failure_rate", 0.0),
+        )
+    return None
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second, with bursts of up to `rate`."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        # a rate below 1 still needs room for one request
+        self.capacity = max(1.0, rate or 0.0)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    def available(self):
+        if not self.rate:
+            return True
+        self._refill()
+        return self.tokens >= 1
+
+    async def acquire(self):
+        if not self.rate:
+            return
+        self._refill()
+        while self.tokens < 1:
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+            self._refill()
+        self.tokens -= 1
+
+
+class Provider:
+    """One chat model with its limits, latency statistics and health."""
+
+    def __init__(
+        self, name, llm, model=None, concurrency=16, rate_limit=None, timeout=LLM_TIMEOUT
+    ):
+        self.name = name
+        self.llm = llm
+        self.model = model
+        self.timeout = timeout
+        self.limiter = ConcurrencyLimiter(name, concurrency)
+        self.rate_limiter = RateLimiter(rate_limit)
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.ewma = None
+
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.unhealthy_until = 0.0
+
+    def healthy(self):
+        return self.unhealthy_until <= time.monotonic()
+
+    def available(self):
+        """Whether a call would start right away, without waiting for a limit."""
+        return self.limiter.in_use < self.limiter.limit and self.rate_limiter.available()
+
+    def hedge_delay(self):
+        """Seconds to wait for this provider before hedging, None if not known yet."""
+        if len(self.latencies) < MIN_HEDGE_SAMPLES:
+            return None
+        return max(
+            LLM_HEDGE_MIN_DELAY, percentile(sorted(self.latencies), LLM_HEDGE_PERCENTILE)
+        )
+
+    def _record_success(self, latency, hedge_sample=True):
+        if hedge_sample:
+            self.latencies.append(latency)
+        self.ewma = (
+            latency
+            if self.ewma is None
+            else LLM_EWMA_ALPHA * latency + (1 - LLM_EWMA_ALPHA) * self.ewma
+        )
+        self.consecutive_failures = 0
+
+    def _record_failure(self, error):
+        self.failures += 1
+        self.consecutive_failures += 1
+        increment(f"llm.{self.name}.failures")
+        logging.warning(f"LLM provider {self.name} failed: {error!r}")
+        if self.consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            self.unhealthy_until = time.monotonic() + LLM_FAILURE_COOLDOWN
+            logging.error(
+                f"LLM provider {self.name} skipped for {LLM_FAILURE_COOLDOWN} seconds"
+            )
+
+    async def ainvoke(self, messages, **kwargs):
+        # wait for the rate limit before taking a concurrency slot, so the requests
+        # waiting for a token don't hold slots the others could use
+        await self.rate_limiter.acquire()
+        async with self.limiter.acquire():
+            self.calls += 1
+            start = time.perf_counter()
+            try:
+                result = await asyncio.wait_for(
+                    self.llm.ainvoke(messages, **kwargs), self.timeout
+                )
+            except Exception as e:
+                self._record_failure(e)
+                raise
+            self._record_success(time.perf_counter() - start)
+            return result
+
+    async def astream(self, messages, **kwargs):
+        """
+        Stream the chunks of the chat model.
+
+        The wait for the first chunk and the gap between two chunks are each bounded by
+        `timeout`, so a stalled stream fails (and can fail over) instead of holding its
+        concurrency slot forever.
+        """
+        await self.rate_limiter.acquire()
+        async with self.limiter.acquire():
+            self.calls += 1
+            start = time.perf_counter()
+            first_chunk = True
+            chunks = self.llm.astream(messages, **kwargs).__aiter__()
+            try:
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), self.timeout)
+                    except StopAsyncIteration:
+                        return
+                    if first_chunk:
+                        # time to the first token is what the stream waits for, it
+                        # is not comparable to the complete calls the hedging uses
+                        self._record_success(
+                            time.perf_counter() - start, hedge_sample=False
+                        )
+                        first_chunk = False
+                    yield chunk
+            except Exception as e:
+                self._record_failure(e)
+                raise
+            finally:
+                close = getattr(chunks, "aclose", None)
+                if close is not None:
+                    await close()
+
+    def stats(self):
+        return {
+            "model": self.model,
+            "healthy": self.healthy(),
+            "calls": self.calls,
+            "failures": self.failures,
+            "in_use": self.limiter.in_use,
+            "waiting": self.limiter.waiting,
+            "ewma_ms": self.ewma * 1000 if self.ewma is not None else None,
+            "hedge_delay_ms": (
+                self.hedge_delay() * 1000 if self.hedge_delay() is not None else None
+            ),
+        }
+
+
+class LLMRouter:
+    """
+    Chat model facade over several providers.
+
+    `ainvoke` and `astream` behave like the ones of a LangChain chat model, so the
+    router can be used wherever a single chat model was used before.
+    """
+
+    def __init__(self, providers, hedge=LLM_HEDGE_ENABLED):
+        self.providers = providers
+        self.hedge = hedge
+
+    @classmethod
+    def from_config(cls, configs):
+        providers = []
+        for config in configs:
+            try:
+                llm = build_chat_model(config)
+            except Exception as e:
+                logging.error(f"LLM provider {config['name']} could not be created: {e}")
+                continue
+            if llm is None:
+                continue
+            providers.append(
+                Provider(
+                    config["name"],
+                    llm,
+                    config.get("model"),
+                    config.get("concurrency", 16),
+                    config.get("rate_limit"),
+                    config.get("timeout", LLM_TIMEOUT),
+                )
+            )
+            logging.info(f"LLM provider {config['name']} configured")
+        if not providers:
+            logging.error("LLM Error: no provider configured, API keys not found")
+        return cls(providers)
+
+    def candidates(self):
+        """
+        Providers in the order they should be tried.
+
+        Healthy before unhealthy, the ones that can start right away before the
+        saturated ones, the ones that failed their last calls after the others, then
+        the lowest latency EWMA. Providers not called yet come first among the ones
+        without failures so they get measured, a provider that never succeeded (e.g. a
+        wrong model name) is only tried after the working ones.
+        """
+        order = {provider.name: index for index, provider in enumerate(self.providers)}
+        return sorted(
+            self.providers,
+            key=lambda provider: (
+                not provider.healthy(),
+                not provider.available(),
+                provider.consecutive_failures,
+                provider.ewma or 0.0,
+                order[provider.name],
+            ),
+        )
+
+    async def ainvoke(self, messages, **kwargs):
+        candidates = self.candidates()
+        if not candidates:
+            raise LLMUnavailableError("No LLM provider configured")
+
+        tasks = {}
+        errors = []
+        next_index = 0
+        hedged = False
+
+        def start_next():
+            nonlocal next_index
+            provider = candidates[next_index]
+            next_index += 1
+            tasks[asyncio.ensure_future(provider.ainvoke(messages, **kwargs))] = provider
+            return provider
+
+        provider = start_next()
+        try:
+            while tasks:
+                delay = None
+                if self.hedge and not hedged and next_index < len(candidates):
+                    delay = provider.hedge_delay()
+                done, _ = await asyncio.wait(
+                    tasks, timeout=delay, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # the request is slower than the provider's usual, ask another one too
+                    hedged = True
+                    increment("llm.hedged_requests")
+                    start_next()
+                    continue
+
+                for task in done:
+                    failed_provider = tasks.pop(task)
+                    if task.exception() is None:
+                        if hedged and failed_provider is not provider:
+                            increment("llm.hedge_wins")
+                        return task.result()
+                    errors.append(f"{failed_provider.name}: {task.exception()!r}")
+
+                if not tasks and next_index < len(candidates):
+                    increment("llm.failovers")
+                    provider = start_next()
+        finally:
+            for task in tasks:
+                task.cancel()
+        raise LLMUnavailableError(f"All LLM providers failed: {'; '.join(errors)}")
+
+    async def astream(self, messages, **kwargs):
+        """
+        Stream from the best provider, failing over until the first chunk is received.
+
+        Streams are not hedged, a second stream would double the output tokens.
+        """
+        errors = []
+        for index, provider in enumerate(self.candidates()):
+            if index:
+                increment("llm.failovers")
+            started = False
+            try:
+                async for chunk in provider.astream(messages, **kwargs):
+                    started = True
+                    yield chunk
+                return
+            except Exception as e:
+                if started:
+                    raise
+                errors.append(f"{provider.name}: {e!r}")
+        raise LLMUnavailableError(f"All LLM providers failed: {'; '.join(errors)}")
+
+    def stats(self):
+        return {provider.name: provider.stats() for provider in self.providers}
+
+
+llm_router = LLMRouter.from_config(LLM_PROVIDERS)
+register_metrics("llm_providers", llm_router.stats)
@@ -0,0 +1,88 @@
+# This file collects the runtime metrics exposed by the /metrics endpoint
+# Components register a function returning their current stats, simple counters
+# can be incremented directly and timings are kept as distributions of recent samples
+
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+# Number of recent samples kept per distribution
+MAX_SAMPLES = 2048
+
+_lock = threading.Lock()
+_providers = {}
+_counters = defaultdict(int)
+_distributions = defaultdict(lambda: deque(maxlen=MAX_SAMPLES))
+
+
+def register_metrics(name, provider):
+    """Register a function returning a dict of stats under `name`."""
+    _providers[name] = provider
+
+
+def increment(name, value=1):
+    """Increment the counter `name`."""
+    with _lock:
+        _counters[name] += value
+
+
+def get_counter(name):
+    return _counters.get(name, 0)
+
+
+def observe(name, value):
+    """Record a sample of the distribution `name`, e.g. a latency in milliseconds."""
+    with _lock:
+        _distributions[name].append(value)
+
+
+@contextmanager
+def timer(name):
+    """Record the wall time of the block in milliseconds under `name`."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, (time.perf_counter() - start) * 1000)
+
+
+def percentile(sorted_values, fraction):
+    """Nearest rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def summarize(values):
+    """Return count, mean and p50/p95/p99/max of a list of samples."""
+    values = sorted(values)
+    if not values:
+        return {"count": 0}
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values),
+        "p50": percentile(values, 0.50),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1],
+    }
+
+
+def get_distribution(name):
+    with _lock:
+        return list(_distributions.get(name, ()))
+
+
+def collect_metrics():
+    """Return a snapshot of all counters, distributions and registered stats."""
+    with _lock:
+        metrics = {"counters": dict(_counters)}
+        distributions = {name: list(values) for name, values in _distributions.items()}
+    metrics["distributions"] = {
+        name: summarize(values) for name, values in distributions.items()
+    }
+    for name, provider in _providers.items():
+        metrics[name] = provider()
+    return metrics
@@ -1,32 +1,245 @@
+# This file contains the MongoDB clients shared by the whole process
+# One sync and one asyncio client are created lazily and reused by every request. Both
+# are needed: the sync routes and the background threads can't use the asyncio client,
+# which is bound to the event loop, so each driver gets its own pool and the two pools
+# share the MONGO_MAX_POOL_SIZE connections of the process. Liveness is tracked from the heartbeats the driver sends
+# in the background, so requests never pay for a ping, and the command and pool events
+# feed the /metrics endpoint.
+
 from fastapi import HTTPException
 import logging
+import threading
+import time
 
-from pymongo import MongoClient, errors
+from pymongo import MongoClient, errors, monitoring
 
 from constants import *
+from utils.metrics import increment, observe, register_metrics
+
+
+class CommandMetrics(monitoring.CommandListener):
+    """Records the latency of every database command under `mongo.command.<name>`."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe(f"mongo.command.{event.command_name}", event.duration_micros / 1000)
+
+    def failed(self, event):
+        observe(f"mongo.command.{event.command_name}", event.duration_micros / 1000)
+        increment("mongo.command_failures")
+
+
+class PoolMetrics(monitoring.ConnectionPoolListener):
+    """Records how long operations wait for a pooled connection."""
+
+    def __init__(self):
+        self.checked_out = 0
+        self.connections = 0
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        increment("mongo.pool_cleared")
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.connections += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.connections -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        if event.reason == monitoring.ConnectionCheckOutFailedReason.TIMEOUT:
+            increment("mongo.pool_wait_timeouts")
+        else:
+            increment("mongo.pool_check_out_failures")
+
+    def connection_checked_out(self, event):
+        self.checked_out += 1
+        # the duration of the check out events is only reported by recent drivers
+        duration = getattr(event, "duration", None)
+        if duration is not None:
+            observe("mongo.pool_wait", duration * 1000)
+
+    def connection_checked_in(self, event):
+        self.checked_out -= 1
+
+    def stats(self):
+        return {"connections": self.connections, "checked_out": self.checked_out}
+
+
+class HeartbeatHealth(monitoring.ServerHeartbeatListener):
+    """
+    Health of the deployment from the heartbeats of the driver's monitor threads.
 
-import os
-from dotenv import load_dotenv
+    The driver checks every server every MONGO_HEARTBEAT_INTERVAL seconds, and more often
+    while a server is down, so this stays current without any request sending a ping.
+    """
 
-# Load environment variables from .env file
-load_dotenv()
+    def __init__(self):
+        self._lock = threading.Lock()
+        # address -> (ok, monotonic time, round trip in ms or error)
+        self._servers = {}
 
-# MongoDB connection string from environment variables
-CONNECTION_STRING = os.getenv("MONGODB_CONN_STR")
+    def started(self, event):
+        pass
 
-# Initialize MongoDB client
-client = None
+    def succeeded(self, event):
+        with self._lock:
+            self._servers[event.connection_id] = (
+                True,
+                time.monotonic(),
+                event.duration * 1000,
+            )
+
+    def failed(self, event):
+        with self._lock:
+            was_ok = self._servers.get(event.connection_id, (True,))[0]
+            self._servers[event.connection_id] = (
+                False,
+                time.monotonic(),
+                repr(event.reply),
+            )
+        if was_ok:
+            logging.error(f"MongoDB server {event.connection_id} is down: {event.reply}")
+        increment("mongo.heartbeat_failures")
+
+    def healthy(self):
+        """False only once every known server failed its last heartbeat."""
+        with self._lock:
+            return not self._servers or any(ok for ok, _, _ in self._servers.values())
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            servers = {
+                f"{host}:{port}": {
+                    "ok": ok,
+                    "last_heartbeat_seconds_ago": round(now - checked_at, 3),
+                    ("round_trip_ms" if ok else "error"): detail,
+                }
+                for (host, port), (ok, checked_at, detail) in self._servers.items()
+            }
+        return {"healthy": self.healthy(), "servers": servers}
+
+
+class MongoConnectionManager:
+    """Creates the shared clients on first use and closes them on shutdown."""
+
+    def __init__(self, connection_string=CONNECTION_STRING):
+        self.connection_string = connection_string
+        self.health = HeartbeatHealth()
+        self.pool_metrics = {"sync": PoolMetrics(), "async": PoolMetrics()}
+        self._lock = threading.Lock()
+        self._client = None
+        self._async_client = None
+
+    def _options(self, pool):
+        return {
+            "maxPoolSize": self.max_pool_size(pool),
+            "minPoolSize": MONGO_MIN_POOL_SIZE,
+            "connectTimeoutMS": MONGO_CONNECT_TIMEOUT * 1000,
+            "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT * 1000,
+            "socketTimeoutMS": MONGO_SOCKET_TIMEOUT * 1000,
+            "waitQueueTimeoutMS": MONGO_WAIT_QUEUE_TIMEOUT * 1000,
+            "heartbeatFrequencyMS": MONGO_HEARTBEAT_INTERVAL * 1000,
+            "event_listeners": [CommandMetrics(), self.pool_metrics[pool], self.health],
+        }
+
+    def client(self):
+        """The sync client, raises a PyMongoError if it can't be created."""
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    logging.info("Connecting to MongoDB cluster...")
+                    self._client = MongoClient(
+                        self.connection_string, **self._options("sync")
+                    )
+        return self._client
+
+    def async_client(self):
+        """The asyncio client used by the async routes."""
+        if self._async_client is None:
+            with self._lock:
+                if self._async_client is None:
+                    # imported here so the sync routes and scripts don't need motor
+                    from motor.motor_asyncio import AsyncIOMotorClient
+
+                    logging.info("Connecting to MongoDB cluster with the asyncio driver...")
+                    self._async_client = AsyncIOMotorClient(
+                        self.connection_string, **self._options("async")
+                    )
+        return self._async_client
+
+    @staticmethod
+    def max_pool_size(pool):
+        return MONGO_SYNC_MAX_POOL_SIZE if pool == "sync" else MONGO_ASYNC_MAX_POOL_SIZE
+
+    def healthy(self):
+        return self.health.healthy()
+
+    def close(self):
+        with self._lock:
+            for client in (self._client, self._async_client):
+                if client is not None:
+                    client.close()
+            self._client = None
+            self._async_client = None
+        logging.info("MongoDB connections closed.")
+
+    def stats(self):
+        stats = self.health.stats()
+        for pool, metrics in self.pool_metrics.items():
+            stats[f"{pool}_pool"] = dict(
+                metrics.stats(), max_pool_size=self.max_pool_size(pool)
+            )
+        return stats
+
+
+mongo_manager = MongoConnectionManager()
+register_metrics("mongo", mongo_manager.stats)
+
+
+def check_database_health():
+    """Fail fast while the heartbeats report the database down, instead of waiting
+    for the server selection timeout of every operation."""
+    if not mongo_manager.healthy():
+        raise HTTPException(status_code=503, detail="Database unavailable")
 
 
 def get_mongo_client():
-    """Get the MongoDB client, reconnecting if necessary."""
-    global client
-    if client is None or not client.admin.command("ping"):
-        try:
-            logging.info("Connecting to MongoDB cluster...")
-            client = MongoClient(CONNECTION_STRING)
-            logging.info("Successfully connected to MongoDB cluster.")
-        except errors.PyMongoError as e:
-            logging.error(f"Failed to connect to MongoDB: {e}")
-            raise HTTPException(status_code=500, detail="Database connection failed")
-    return client
+    """Get the shared MongoDB client."""
+    check_database_health()
+    try:
+        return mongo_manager.client()
+    except errors.PyMongoError as e:
+        logging.error(f"Failed to connect to MongoDB: {e}")
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+
+def get_async_mongo_client():
+    """Get the shared asyncio MongoDB client used by the async routes."""
+    check_database_health()
+    try:
+        return mongo_manager.async_client()
+    except errors.PyMongoError as e:
+        logging.error(f"Failed to connect to MongoDB: {e}")
+        raise HTTPException(status_code=500, detail="Database connection failed")
+
+
+def close_mongo_clients():
+    mongo_manager.close()
@@ -0,0 +1,83 @@
+# This file contains the in-process reranking stage applied to the retrieved candidates
+# before they are passed to the LLM as context
+
+from constants import (
+    CONTEXT_MAX_PASSAGES,
+    CONTEXT_TOKEN_BUDGET,
+    RERANK_RETRIEVAL_WEIGHT,
+    RERANK_MIN_RELATIVE_SCORE,
+)
+from utils.retriever import tokenize
+from utils.tokens import count_tokens
+
+
+def rerank(question, candidates):
+    """
+    Score candidates by their retrieval score and their token overlap with the question.
+
+    The retrieval score is normalized by the best candidate, the overlap is the F1 of the
+    question terms and the candidate question terms. Each candidate gets a
+    `rerank_score` and the list is returned best first.
+    """
+    if not candidates:
+        return []
+    query_terms = set(tokenize(question))
+    retrieval_scores = [
+        candidate.get("fused_score", candidate.get("score") or 0.0)
+        for candidate in candidates
+    ]
+    best_score = max(retrieval_scores) or 1.0
+
+    for candidate, retrieval_score in zip(candidates, retrieval_scores):
+        candidate_terms = set(tokenize(candidate.get("question")))
+        common = len(query_terms & candidate_terms)
+        if common:
+            recall = common / len(query_terms)
+            precision = common / len(candidate_terms)
+            overlap = 2 * recall * precision / (recall + precision)
+        else:
+            overlap = 0.0
+        candidate["rerank_score"] = (
+            RERANK_RETRIEVAL_WEIGHT * retrieval_score / best_score
+            + (1 - RERANK_RETRIEVAL_WEIGHT) * overlap
+        )
+    return sorted(candidates, key=lambda candidate: candidate["rerank_score"], reverse=True)
+
+
+def select_passages(
+    question,
+    candidates,
+    max_passages=CONTEXT_MAX_PASSAGES,
+    token_budget=CONTEXT_TOKEN_BUDGET,
+):
+    """
+    Rerank the candidates and keep the best ones that fit in the token budget.
+
+    The best passage is always kept. Further passages are skipped when they score below
+    RERANK_MIN_RELATIVE_SCORE of the best one, would exceed the budget or are another
+    language variant of a kept passage.
+    """
+    ranked = rerank(question, candidates)
+    if not ranked:
+        return []
+
+    best = ranked[0]
+    passages = [best]
+    groups = {best.get("group_id")}
+    used_tokens = count_tokens(best.get("answer"))
+    for candidate in ranked[1:]:
+        if len(passages) >= max_passages:
+            break
+        if candidate["rerank_score"] < RERANK_MIN_RELATIVE_SCORE * best["rerank_score"]:
+            break
+        group_id = candidate.get("group_id")
+        if group_id is not None and group_id in groups:
+            # searching all languages finds the same answer in every language
+            continue
+        tokens = count_tokens(candidate.get("answer"))
+        if used_tokens + tokens > token_budget:
+            continue
+        passages.append(candidate)
+        groups.add(group_id)
+        used_tokens += tokens
+    return passages
@@ -0,0 +1,159 @@
+# This file contains the cache of generated chat answers
+# With a temperature of 0 the same question answered from the same knowledge base passages
+# and the same conversation history gives the same answer, so it is generated only once.
+# Entries live in an in-memory LRU and optionally in a MongoDB collection shared by the
+# workers, and are invalidated when a knowledge base document they were built from changes.
+
+import hashlib
+import json
+import logging
+from datetime import datetime, timedelta
+
+from constants import (
+    DB_NAME,
+    RESPONSE_CACHE_COLLECTION,
+    RESPONSE_CACHE_ENABLED,
+    RESPONSE_CACHE_PERSISTENT,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+)
+from utils.cache import LRUCache, normalize_text
+from utils.concurrency import db_limiter
+from utils.llm_router import MODELS
+from utils.metrics import register_metrics
+from utils.mongo_client import mongo_manager
+
+
+def response_cache_key(reference_ids, question, history):
+    """
+    Key of an answer: the models, the passages of the context, the normalized question
+    and a fingerprint of the conversation history window.
+    """
+    history_hash = (
+        hashlib.sha256(json.dumps(history, ensure_ascii=False).encode("utf-8")).hexdigest()
+        if history
+        else ""
+    )
+    key = json.dumps(
+        [MODELS, list(reference_ids), normalize_text(question), history_hash],
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """In-memory LRU of answers in front of an optional MongoDB collection with a TTL."""
+
+    def __init__(
+        self,
+        maxsize=RESPONSE_CACHE_SIZE,
+        ttl=RESPONSE_CACHE_TTL,
+        persistent=RESPONSE_CACHE_PERSISTENT,
+    ):
+        self.ttl = ttl
+        self.persistent = persistent
+        self.memory = LRUCache(maxsize, ttl)
+        self.persistent_hits = 0
+        self.persistent_misses = 0
+        self.errors = 0
+
+    def _collection(self):
+        return mongo_manager.async_client()[DB_NAME][RESPONSE_CACHE_COLLECTION]
+
+    async def get(self, key):
+        """Return the cached answer, None on a miss."""
+        answer = self.memory.get(key)
+        if answer is not None or not self.persistent:
+            return answer
+
+        try:
+            async with db_limiter.acquire():
+                document = await self._collection().find_one(
+                    {
+                        "_id": key,
+                        # the TTL monitor only runs every minute
+                        "created_at": {
+                            "$gte": datetime.utcnow() - timedelta(seconds=self.ttl)
+                        },
+                    }
+                )
+        except Exception as e:
+            logging.error(f"Failed to read the response cache: {e}")
+            self.errors += 1
+            return None
+        if document is None:
+            self.persistent_misses += 1
+            return None
+        self.persistent_hits += 1
+        self.memory.set(key, document["answer"], tags=document["reference_ids"])
+        return document["answer"]
+
+    async def set(self, key, answer, reference_ids):
+        reference_ids = [str(reference_id) for reference_id in reference_ids]
+        self.memory.set(key, answer, tags=reference_ids)
+        if not self.persistent:
+            return
+
+        try:
+            async with db_limiter.acquire():
+                await self._collection().replace_one(
+                    {"_id": key},
+                    {
+                        "answer": answer,
+                        "reference_ids": reference_ids,
+                        "created_at": datetime.utcnow(),
+                    },
+                    upsert=True,
+                )
+        except Exception as e:
+            logging.error(f"Failed to write the response cache: {e}")
+            self.errors += 1
+
+    def invalidate_document(self, doc_id, client=None):
+        """
+        Drop the answers built from a knowledge base document.
+
+        The persistent tier is only cleaned when a (sync) `client` is given.
+        """
+        doc_id = str(doc_id)
+        self.memory.invalidate_tag(doc_id)
+        if not self.persistent or client is None:
+            return
+        try:
+            client[DB_NAME][RESPONSE_CACHE_COLLECTION].delete_many(
+                {"reference_ids": doc_id}
+            )
+        except Exception as e:
+            logging.error(f"Failed to invalidate the response cache: {e}")
+            self.errors += 1
+
+    async def ainvalidate_documents(self, doc_ids):
+        """Async variant of `invalidate_document` for several documents."""
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        for doc_id in doc_ids:
+            self.memory.invalidate_tag(doc_id)
+        if not self.persistent or not doc_ids:
+            return
+        try:
+            async with db_limiter.acquire():
+                await self._collection().delete_many(
+                    {"reference_ids": {"$in": doc_ids}}
+                )
+        except Exception as e:
+            logging.error(f"Failed to invalidate the response cache: {e}")
+            self.errors += 1
+
+    def stats(self):
+        stats = self.memory.stats()
+        stats.update(
+            enabled=RESPONSE_CACHE_ENABLED,
+            persistent=self.persistent,
+            persistent_hits=self.persistent_hits,
+            persistent_misses=self.persistent_misses,
+            errors=self.errors,
+        )
+        return stats
+
+
+response_cache = ResponseCache()
+register_metrics("response_cache", response_cache.stats)
@@ -0,0 +1,647 @@
+# This file contains the pluggable retrieval backends used to search the knowledge base.
+# "atlas" runs an Atlas `$search` aggregation, "bm25" keeps an in-process inverted index
+# built from the collection and updated whenever documents are added or removed, and
+# "hybrid" fuses the BM25 ranking with a character n-gram vector ranking.
+
+import asyncio
+import heapq
+import logging
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from operator import itemgetter
+
+from constants import (
+    DB_NAME,
+    MULTILINGUAL_QUESTIONS_COLLECTION,
+    UNANSWERED_QUESTIONS_COLLECTION,
+    RETRIEVAL_BACKEND,
+    SCORE_THRESHOLD_SIMILARITY,
+)
+from utils.vector_index import NgramVectorIndex
+from utils.concurrency import db_limiter
+from utils.singleflight import SingleFlight
+
+# MongoDB Atlas Search parameters
+SEARCH_PATH = ["question", "answer", "references"]
+SORT_ORDER = -1
+
+# BM25 parameters, same defaults as the Lucene similarity used by Atlas Search
+BM25_K1 = 1.2
+BM25_B = 0.75
+BM25_FIELDS = ("question", "answer")
+
+# Maximum number of questions searched by one batch aggregation
+BATCH_SEARCH_CHUNK = 50
+
+# Hybrid parameters
+# hashed features of the 3 and 4-grams, enough to keep collisions rare (16 KB per question)
+NGRAM_VECTOR_DIM = 4096
+HYBRID_CANDIDATES = 50
+RRF_K = 60
+
+# Collections kept in memory by the local backends
+INDEXED_COLLECTIONS = (MULTILINGUAL_QUESTIONS_COLLECTION, UNANSWERED_QUESTIONS_COLLECTION)
+
+# Document field holding the language of a document
+LANGUAGE_FIELD = "lang"
+
+# Document field linking the language variants of a question
+GROUP_FIELD = "group_id"
+
+# Fields loaded into the local backends
+INDEX_PROJECTION = {field: 1 for field in (*BM25_FIELDS, LANGUAGE_FIELD, GROUP_FIELD)}
+
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def tokenize(text):
+    """Lowercase and split text into word tokens, like the Lucene standard analyzer."""
+    if not isinstance(text, str):
+        return []
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class BM25Index:
+    """
+    In-memory inverted index over the text fields of one collection.
+
+    Every field is scored separately and the per-field scores are summed, which mirrors
+    how Atlas scores a wildcard path query. Scores use the Lucene BM25 formula so they
+    stay comparable with the thresholds in constants.py.
+    """
+
+    def __init__(self, fields=BM25_FIELDS, k1=BM25_K1, b=BM25_B):
+        self.fields = fields
+        self.k1 = k1
+        self.b = b
+        self._lock = threading.RLock()
+        # field -> term -> {doc_id: term frequency}
+        self._postings = {field: defaultdict(dict) for field in fields}
+        # field -> {doc_id: number of tokens}
+        self._lengths = {field: {} for field in fields}
+        self._total_lengths = {field: 0 for field in fields}
+        # doc_id -> {"question", "answer", "lang", "group_id", "terms"}
+        self._documents = {}
+
+    def __len__(self):
+        return len(self._documents)
+
+    def add(self, document):
+        """Add or replace a document in the index."""
+        doc_id = str(document["_id"])
+        with self._lock:
+            self._remove(doc_id)
+            terms = {}
+            for field in self.fields:
+                counts = Counter(tokenize(document.get(field)))
+                if not counts:
+                    continue
+                terms[field] = counts
+                for term, tf in counts.items():
+                    self._postings[field][term][doc_id] = tf
+                length = sum(counts.values())
+                self._lengths[field][doc_id] = length
+                self._total_lengths[field] += length
+            self._documents[doc_id] = {
+                "question": document.get("question"),
+                "answer": document.get("answer"),
+                "lang": document.get(LANGUAGE_FIELD),
+                "group_id": document.get(GROUP_FIELD),
+                "terms": terms,
+            }
+
+    def add_many(self, documents):
+        count = 0
+        for document in documents:
+            self.add(document)
+            count += 1
+        return count
+
+    def remove(self, doc_id):
+        """Remove a document from the index. Returns True if it was indexed."""
+        with self._lock:
+            return self._remove(str(doc_id))
+
+    def _remove(self, doc_id):
+        entry = self._documents.pop(doc_id, None)
+        if entry is None:
+            return False
+        for field, counts in entry["terms"].items():
+            postings = self._postings[field]
+            for term in counts:
+                docs = postings.get(term)
+                if docs is None:
+                    continue
+                docs.pop(doc_id, None)
+                if not docs:
+                    del postings[term]
+            self._total_lengths[field] -= self._lengths[field].pop(doc_id, 0)
+        return True
+
+    def get(self, doc_id):
+        entry = self._documents.get(str(doc_id))
+        if entry is None:
+            return None
+        return {
+            "_id": str(doc_id),
+            "question": entry["question"],
+            "answer": entry["answer"],
+            LANGUAGE_FIELD: entry["lang"],
+            GROUP_FIELD: entry["group_id"],
+        }
+
+    def scores(self, question):
+        """Return {doc_id: score} for every document sharing at least one term with question."""
+        query_terms = tokenize(question)
+        scores = defaultdict(float)
+        with self._lock:
+            for field in self.fields:
+                postings = self._postings[field]
+                lengths = self._lengths[field]
+                doc_count = len(lengths)
+                if not doc_count:
+                    continue
+                avg_length = self._total_lengths[field] / doc_count
+                for term in query_terms:
+                    docs = postings.get(term)
+                    if not docs:
+                        continue
+                    df = len(docs)
+                    idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                    for doc_id, tf in docs.items():
+                        norm = self.k1 * (
+                            1 - self.b + self.b * lengths[doc_id] / avg_length
+                        )
+                        scores[doc_id] += idf * tf / (tf + norm)
+        return scores
+
+    def search(self, question, score_threshold, limit):
+        """Return up to `limit` documents scoring above `score_threshold`, best first."""
+        scores = self.scores(question)
+        ranked = sorted(
+            ((score, doc_id) for doc_id, score in scores.items() if score > score_threshold),
+            reverse=True,
+        )[:limit]
+        results = []
+        with self._lock:
+            for score, doc_id in ranked:
+                document = self.get(doc_id)
+                if document is not None:
+                    document["score"] = score
+                    results.append(document)
+        return results
+
+
+class HybridIndex(BM25Index):
+    """
+    BM25Index that also keeps a character n-gram vector of every question.
+
+    Both rankings are combined with reciprocal rank fusion. A candidate is accepted
+    when either its BM25 score passes the collection threshold or its cosine
+    similarity passes SCORE_THRESHOLD_SIMILARITY, which lets paraphrased and
+    misspelled questions match without lowering the lexical threshold.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.vectors = NgramVectorIndex(NGRAM_VECTOR_DIM)
+
+    def add(self, document):
+        super().add(document)
+        self.vectors.add(str(document["_id"]), document.get("question") or "")
+
+    def remove(self, doc_id):
+        self.vectors.remove(str(doc_id))
+        return super().remove(doc_id)
+
+    def search(self, question, score_threshold, limit):
+        lexical_scores = self.scores(question)
+        lexical_ranking = heapq.nlargest(
+            HYBRID_CANDIDATES, lexical_scores.items(), key=itemgetter(1)
+        )
+        vector_ranking = self.vectors.search(question, HYBRID_CANDIDATES)
+        similarities = dict(vector_ranking)
+
+        fused_scores = defaultdict(float)
+        for ranking in (lexical_ranking, vector_ranking):
+            for rank, (doc_id, _) in enumerate(ranking, start=1):
+                fused_scores[doc_id] += 1 / (RRF_K + rank)
+
+        accepted = [
+            doc_id
+            for doc_id in fused_scores
+            if lexical_scores.get(doc_id, 0.0) > score_threshold
+            or similarities.get(doc_id, 0.0) >= SCORE_THRESHOLD_SIMILARITY
+        ]
+        accepted.sort(key=fused_scores.get, reverse=True)
+
+        results = []
+        for doc_id in accepted[:limit]:
+            document = self.get(doc_id)
+            if document is None:
+                continue
+            document["score"] = lexical_scores.get(doc_id, 0.0)
+            document["similarity"] = similarities.get(doc_id, 0.0)
+            document["fused_score"] = fused_scores[doc_id]
+            results.append(document)
+        return results
+
+
+class Retriever:
+    """
+    Base class for knowledge base retrieval backends.
+
+    `asearch` returns a list of documents with at least `_id`, `answer` and `score`,
+    sorted best first. When `lang` is given only documents of that language, or
+    without a language, are searched. The `document_added` / `document_removed` hooks
+    are called by the routes that change a collection so local backends can stay
+    in sync.
+    """
+
+    name = None
+    # whether a document can only match questions sharing at least one term with it
+    lexical = True
+
+    async def asearch(
+        self, client, question, db_collection, db_index, score_threshold, limit, lang=None
+    ):
+        """Search a collection with an asyncio (motor) client."""
+        raise NotImplementedError
+
+    async def acombined_search(self, client, question, sources, limit, lang=None):
+        """
+        Search several collections for the same question.
+
+        Args:
+            sources (list): (db_collection, db_index, score_threshold) tuples.
+
+        Returns:
+            dict: db_collection -> list of results, best first.
+        """
+        return {
+            db_collection: await self.asearch(
+                client, question, db_collection, db_index, score_threshold, limit, lang
+            )
+            for db_collection, db_index, score_threshold in sources
+        }
+
+    async def abatch_search(
+        self, client, queries, db_collection, db_index, score_threshold, limit
+    ):
+        """
+        Search the same collection for several questions.
+
+        Args:
+            queries (list): (question, lang) tuples.
+
+        Returns:
+            list: the list of results of every query, in order.
+        """
+        return [
+            await self.asearch(
+                client, question, db_collection, db_index, score_threshold, limit, lang
+            )
+            for question, lang in queries
+        ]
+
+    def warm_up(self, client):
+        """Prepare the backend at startup."""
+
+    def document_added(self, db_collection, document):
+        """Called after a document is inserted into `db_collection`."""
+
+    def document_removed(self, db_collection, doc_id):
+        """Called after a document is deleted from `db_collection`."""
+
+
+class AtlasSearchRetriever(Retriever):
+    """Runs a `$search` aggregation against the Atlas Search index of the collection."""
+
+    name = "atlas"
+
+    def _pipeline(self, question, db_collection, db_index, score_threshold, limit, lang):
+        text_query = {"text": {"query": question, "path": SEARCH_PATH}}
+        if lang:
+            # Filter clauses don't contribute to the score, so thresholds still apply
+            search = {
+                "index": db_index,
+                "compound": {
+                    "must": [text_query],
+                    "filter": [
+                        {
+                            "compound": {
+                                "should": [
+                                    {"text": {"query": lang, "path": LANGUAGE_FIELD}},
+                                    {
+                                        "compound": {
+                                            "mustNot": [
+                                                {"exists": {"path": LANGUAGE_FIELD}}
+                                            ]
+                                        }
+                                    },
+                                ],
+                                "minimumShouldMatch": 1,
+                            }
+                        }
+                    ],
+                },
+            }
+        else:
+            search = {"index": db_index, **text_query}
+
+        return [
+            {"$search": search},
+            {"$addFields": {"score": {"$meta": "searchScore"}, "source": db_collection}},
+            {"$match": {"score": {"$gt": score_threshold}}},
+            {"$sort": {"score": SORT_ORDER}},
+            {"$limit": limit},
+        ]
+
+    async def asearch(
+        self, client, question, db_collection, db_index, score_threshold, limit, lang=None
+    ):
+        collection = client[DB_NAME][db_collection]
+        pipeline = self._pipeline(
+            question, db_collection, db_index, score_threshold, limit, lang
+        )
+        async with db_limiter.acquire():
+            return await collection.aggregate(pipeline).to_list(length=None)
+
+    async def acombined_search(self, client, question, sources, limit, lang=None):
+        first_collection, pipeline = self._combined_pipeline(
+            question, sources, limit, lang
+        )
+        async with db_limiter.acquire():
+            documents = await (
+                client[DB_NAME][first_collection].aggregate(pipeline).to_list(length=None)
+            )
+        return self._split_sources(sources, documents)
+
+    def _combined_pipeline(self, question, sources, limit, lang):
+        # Search the first collection and append the others with $unionWith,
+        # so all sources are answered by a single aggregation round trip
+        (first_collection, first_index, first_threshold), *others = sources
+        pipeline = self._pipeline(
+            question, first_collection, first_index, first_threshold, limit, lang
+        )
+        for db_collection, db_index, score_threshold in others:
+            pipeline.append(
+                {
+                    "$unionWith": {
+                        "coll": db_collection,
+                        "pipeline": self._pipeline(
+                            question,
+                            db_collection,
+                            db_index,
+                            score_threshold,
+                            limit,
+                            lang,
+                        ),
+                    }
+                }
+            )
+        return first_collection, pipeline
+
+    def _split_sources(self, sources, documents):
+        results = {db_collection: [] for db_collection, _, _ in sources}
+        for document in documents:
+            results[document.pop("source")].append(document)
+        return results
+
+    async def abatch_search(
+        self, client, queries, db_collection, db_index, score_threshold, limit
+    ):
+        # One aggregation per chunk of questions, the first question is searched by the
+        # pipeline itself and the others are appended with $unionWith
+        chunks = [
+            queries[start : start + BATCH_SEARCH_CHUNK]
+            for start in range(0, len(queries), BATCH_SEARCH_CHUNK)
+        ]
+        chunk_results = await asyncio.gather(
+            *(
+                self._abatch_search_chunk(
+                    client, chunk, db_collection, db_index, score_threshold, limit
+                )
+                for chunk in chunks
+            )
+        )
+        return [results for chunk in chunk_results for results in chunk]
+
+    async def _abatch_search_chunk(
+        self, client, queries, db_collection, db_index, score_threshold, limit
+    ):
+        def query_pipeline(index):
+            question, lang = queries[index]
+            pipeline = self._pipeline(
+                question, db_collection, db_index, score_threshold, limit, lang
+            )
+            pipeline.append({"$addFields": {"query": index}})
+            return pipeline
+
+        pipeline = query_pipeline(0)
+        for index in range(1, len(queries)):
+            pipeline.append(
+                {"$unionWith": {"coll": db_collection, "pipeline": query_pipeline(index)}}
+            )
+
+        async with db_limiter.acquire():
+            documents = await (
+                client[DB_NAME][db_collection].aggregate(pipeline).to_list(length=None)
+            )
+        results = [[] for _ in queries]
+        for document in documents:
+            document.pop("source", None)
+            results[document.pop("query")].append(document)
+        return results
+
+
+class BM25Retriever(Retriever):
+    """
+    Keeps BM25 indexes of the collections in process memory.
+
+    Every collection is split in one index per language (plus one for documents
+    without a language), so a query with a known language only scores its own
+    partition. Indexes are loaded from MongoDB with a plain `find`, so this backend
+    works against any MongoDB deployment, not only Atlas.
+    """
+
+    name = "bm25"
+    index_class = BM25Index
+    rank_field = "score"
+
+    def __init__(self):
+        # db_collection -> lang -> index
+        self._indexes = {}
+        self._lock = threading.Lock()
+        # db_collection -> change lists of the loads in progress, the documents added
+        # or removed during a load are applied to its indexes once they are swapped in
+        self._loading = {}
+        self._changes_lock = threading.Lock()
+        # concurrent first queries of a collection share one load
+        self._load_flight = SingleFlight(f"{self.name}_load")
+
+    def _get_partitions(self, client, db_collection):
+        partitions = self._indexes.get(db_collection)
+        if partitions is None:
+            with self._lock:
+                partitions = self._indexes.get(db_collection)
+                if partitions is None:
+                    partitions = self.load_index(client, db_collection)
+        return partitions
+
+    def load_index(self, client, db_collection):
+        """(Re)build the indexes of a collection from the database."""
+        documents = client[DB_NAME][db_collection].find({}, INDEX_PROJECTION)
+        partitions = self.load_documents(db_collection, documents)
+        logging.info(
+            f"Built {self.name} index for {db_collection} with "
+            f"{sum(len(index) for index in partitions.values())} documents"
+        )
+        return partitions
+
+    async def aload_index(self, client, db_collection):
+        """Async variant of `load_index`, taking an asyncio (motor) client."""
+
+        async def fetch():
+            cursor = client[DB_NAME][db_collection].find({}, INDEX_PROJECTION)
+            async with db_limiter.acquire():
+                return await cursor.to_list(length=None)
+
+        changes = self._begin_load(db_collection)
+        try:
+            documents = await fetch()
+        except BaseException:
+            self._end_load(db_collection, changes)
+            raise
+        return self._end_load(db_collection, changes, self.build_partitions(documents))
+
+    def load_documents(self, db_collection, documents):
+        """Build the indexes of a collection from an iterable of documents."""
+        changes = self._begin_load(db_collection)
+        try:
+            partitions = self.build_partitions(documents)
+        except BaseException:
+            self._end_load(db_collection, changes)
+            raise
+        return self._end_load(db_collection, changes, partitions)
+
+    def build_partitions(self, documents):
+        partitions = {}
+        for document in documents:
+            self._add(partitions, document)
+        return partitions
+
+    def _begin_load(self, db_collection):
+        changes = []
+        with self._changes_lock:
+            self._loading.setdefault(db_collection, []).append(changes)
+        return changes
+
+    def _end_load(self, db_collection, changes, partitions=None):
+        """Swap the loaded indexes in, with the changes made during the load."""
+        with self._changes_lock:
+            loading = [
+                other for other in self._loading[db_collection] if other is not changes
+            ]
+            if loading:
+                self._loading[db_collection] = loading
+            else:
+                del self._loading[db_collection]
+            if partitions is None:
+                return None
+            for apply, argument in changes:
+                apply(partitions, argument)
+            self._indexes[db_collection] = partitions
+        return partitions
+
+    def _add(self, partitions, document):
+        lang = document.get(LANGUAGE_FIELD)
+        if lang not in partitions:
+            partitions[lang] = self.index_class()
+        partitions[lang].add(document)
+
+    def _remove(self, partitions, doc_id):
+        for index in list(partitions.values()):
+            if index.remove(doc_id):
+                break
+
+    def _apply(self, db_collection, apply, argument):
+        with self._changes_lock:
+            for changes in self._loading.get(db_collection, ()):
+                changes.append((apply, argument))
+            # Collections that are not loaded yet will pick the change up when they are
+            partitions = self._indexes.get(db_collection)
+            if partitions is not None:
+                apply(partitions, argument)
+
+    def search(
+        self, client, question, db_collection, db_index, score_threshold, limit, lang=None
+    ):
+        """In-memory search of `asearch`, loading the collection with a pymongo client."""
+        partitions = self._get_partitions(client, db_collection)
+        results = []
+        for partition_lang, index in list(partitions.items()):
+            if lang and partition_lang not in (lang, None):
+                continue
+            results.extend(index.search(question, score_threshold, limit))
+        results.sort(key=itemgetter(self.rank_field), reverse=True)
+        return results[:limit]
+
+    async def asearch(
+        self, client, question, db_collection, db_index, score_threshold, limit, lang=None
+    ):
+        # Searching is in memory, only a collection that is not loaded yet needs I/O
+        if db_collection not in self._indexes:
+            await self._load_flight.do(
+                db_collection, lambda: self.aload_index(client, db_collection)
+            )
+        return self.search(
+            client, question, db_collection, db_index, score_threshold, limit, lang
+        )
+
+    def warm_up(self, client):
+        for db_collection in INDEXED_COLLECTIONS:
+            self.load_index(client, db_collection)
+
+    def document_added(self, db_collection, document):
+        self._apply(db_collection, self._add, document)
+
+    def document_removed(self, db_collection, doc_id):
+        self._apply(db_collection, self._remove, doc_id)
+
+
+class HybridRetriever(BM25Retriever):
+    """BM25Retriever whose partitions also rank questions by n-gram vector similarity."""
+
+    name = "hybrid"
+    lexical = False
+    index_class = HybridIndex
+    rank_field = "fused_score"
+
+
+RETRIEVERS = {
+    AtlasSearchRetriever.name: AtlasSearchRetriever,
+    BM25Retriever.name: BM25Retriever,
+    HybridRetriever.name: HybridRetriever,
+}
+
+_retriever = None
+
+
+def get_retriever():
+    """Return the retriever configured by RETRIEVAL_BACKEND."""
+    global _retriever
+    if _retriever is None:
+        if RETRIEVAL_BACKEND not in RETRIEVERS:
+            raise ValueError(f"Unknown retrieval backend: {RETRIEVAL_BACKEND}")
+        _retriever = RETRIEVERS[RETRIEVAL_BACKEND]()
+        logging.info(f"Using {RETRIEVAL_BACKEND} retrieval backend")
+    return _retriever
+
+
+def set_retriever(retriever):
+    """Replace the configured retriever, e.g. to compare backends offline."""
+    global _retriever
+    _retriever = retriever
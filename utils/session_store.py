@@ -0,0 +1,386 @@
+# This file contains the stores keeping the conversation history of the chat sessions
+# A session is a compact window of the last messages, stored as [role, content] pairs
+# ("human" or "ai") instead of LangChain memory objects, so it can be kept in process,
+# in MongoDB shared by every uvicorn worker, or in local files. With the "summary"
+# memory mode it also holds a running summary of the messages folded out of the window.
+# `start` is the position of the first message of the window among all the messages of
+# the session, so a summary folds out the messages it covers even if the window moved.
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from constants import (
+    DB_NAME,
+    SESSIONS_COLLECTION,
+    SESSION_STORE,
+    SESSION_MEMORY,
+    SESSION_HISTORY_WINDOW,
+    SESSION_MAX_MESSAGES,
+    SESSION_TTL,
+    SESSION_MAX_BYTES,
+    SESSION_FILE_DIRECTORY,
+)
+from utils.concurrency import db_limiter
+from utils.metrics import register_metrics
+from utils.mongo_client import mongo_manager
+
+# Approximate bookkeeping bytes of one stored message besides its text
+MESSAGE_OVERHEAD = 64
+
+
+def window_size():
+    """Maximum number of messages kept per session."""
+    if SESSION_MEMORY == "summary":
+        # older messages are summarized, this only bounds a summary falling behind
+        return SESSION_MAX_MESSAGES
+    # a human and an ai message per exchange
+    return SESSION_HISTORY_WINDOW * 2
+
+
+def new_session():
+    return {"messages": [], "summary": "", "start": 0}
+
+
+def append_messages(session, messages):
+    """Return the session with the messages appended and the window trimmed."""
+    combined = session["messages"] + [list(message) for message in messages]
+    trimmed = max(0, len(combined) - window_size())
+    return {
+        "messages": combined[trimmed:],
+        "summary": session["summary"],
+        "start": session.get("start", 0) + trimmed,
+    }
+
+
+def fold_messages(session, summary, end):
+    """Return the session with the summary replaced and the messages before `end` dropped."""
+    start = session.get("start", 0)
+    dropped = min(max(0, end - start), len(session["messages"]))
+    return {
+        "messages": session["messages"][dropped:],
+        "summary": summary,
+        "start": start + dropped,
+    }
+
+
+def session_bytes(session):
+    return len(session["summary"].encode("utf-8")) + sum(
+        len(content.encode("utf-8")) + MESSAGE_OVERHEAD
+        for _, content in session["messages"]
+    )
+
+
+class SessionStore:
+    """
+    Base class of the session stores.
+
+    `load` returns the session ({"messages", "summary", "start"}), or None if the session
+    is unknown or expired. `append` adds the messages of one exchange and trims the window.
+    `fold` replaces the summary and drops the messages before the position `end` it now
+    covers, whatever was appended or trimmed since the session was loaded.
+    """
+
+    name = None
+
+    async def load(self, chat_id):
+        raise NotImplementedError
+
+    async def append(self, chat_id, messages):
+        raise NotImplementedError
+
+    async def fold(self, chat_id, summary, end):
+        raise NotImplementedError
+
+    def stats(self):
+        return {"store": self.name}
+
+
+class MemorySessionStore(SessionStore):
+    """
+    In-process LRU of sessions with a time to live, bounded by the bytes of the stored text.
+
+    Sessions are not shared between worker processes.
+    """
+
+    name = "memory"
+
+    def __init__(self, max_bytes=SESSION_MAX_BYTES, ttl=SESSION_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # chat_id -> (expires_at, session, size)
+        self._sessions = OrderedDict()
+        self.bytes = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _pop(self, chat_id):
+        entry = self._sessions.pop(chat_id, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+        return entry
+
+    def _put(self, chat_id, session):
+        size = session_bytes(session)
+        self._sessions[chat_id] = (time.monotonic() + self.ttl, session, size)
+        self.bytes += size
+        # evict the least recently used sessions, but always keep the current one
+        while self.bytes > self.max_bytes and len(self._sessions) > 1:
+            self._pop(next(iter(self._sessions)))
+            self.evictions += 1
+
+    async def load(self, chat_id):
+        with self._lock:
+            entry = self._sessions.get(chat_id)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                self._pop(chat_id)
+                self.expirations += 1
+                return None
+            self._sessions.move_to_end(chat_id)
+            session = entry[1]
+            return {
+                "messages": list(session["messages"]),
+                "summary": session["summary"],
+                "start": session["start"],
+            }
+
+    async def append(self, chat_id, messages):
+        with self._lock:
+            entry = self._pop(chat_id)
+            session = entry[1] if entry is not None else new_session()
+            self._put(chat_id, append_messages(session, messages))
+
+    async def fold(self, chat_id, summary, end):
+        with self._lock:
+            entry = self._pop(chat_id)
+            if entry is None:
+                return
+            self._put(chat_id, fold_messages(entry[1], summary, end))
+
+    def stats(self):
+        with self._lock:
+            return {
+                "store": self.name,
+                "sessions": len(self._sessions),
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class MongoSessionStore(SessionStore):
+    """
+    Sessions shared by every worker, one document per session in the sessions collection.
+
+    Appending and folding are single pipeline updates, so concurrent exchanges and
+    summaries on different workers don't overwrite each other. `appended` counts every
+    message ever appended, which places the window among them: a summary drops exactly
+    the messages it covers, and one covering less than the stored summary (`folded`) is
+    discarded. A TTL index on `updated_at` removes idle sessions.
+    """
+
+    name = "mongo"
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self.errors = 0
+
+    def _collection(self):
+        return mongo_manager.async_client()[DB_NAME][SESSIONS_COLLECTION]
+
+    async def load(self, chat_id):
+        try:
+            async with db_limiter.acquire():
+                document = await self._collection().find_one(
+                    {
+                        "_id": chat_id,
+                        # the TTL monitor only runs every minute
+                        "updated_at": {
+                            "$gte": datetime.utcnow() - timedelta(seconds=self.ttl)
+                        },
+                    },
+                    {"messages": 1, "summary": 1, "appended": 1},
+                )
+        except Exception as e:
+            logging.error(f"Failed to load chat session {chat_id}: {e}")
+            self.errors += 1
+            return None
+        if document is None:
+            return None
+        messages = document.get("messages", [])
+        return {
+            "messages": messages,
+            "summary": document.get("summary", ""),
+            "start": document.get("appended", len(messages)) - len(messages),
+        }
+
+    async def append(self, chat_id, messages):
+        try:
+            async with db_limiter.acquire():
+                stored = {"$ifNull": ["$messages", []]}
+                await self._collection().update_one(
+                    {"_id": chat_id},
+                    [
+                        {
+                            "$set": {
+                                "messages": {
+                                    "$slice": [
+                                        {
+                                            "$concatArrays": [
+                                                stored,
+                                                # the text may start with "$"
+                                                {
+                                                    "$literal": [
+                                                        list(message)
+                                                        for message in messages
+                                                    ]
+                                                },
+                                            ]
+                                        },
+                                        -window_size(),
+                                    ]
+                                },
+                                "appended": {
+                                    "$add": [
+                                        {"$ifNull": ["$appended", {"$size": stored}]},
+                                        len(messages),
+                                    ]
+                                },
+                                "updated_at": datetime.utcnow(),
+                            }
+                        }
+                    ],
+                    upsert=True,
+                )
+        except Exception as e:
+            logging.error(f"Failed to save chat session {chat_id}: {e}")
+            self.errors += 1
+
+    async def fold(self, chat_id, summary, end):
+        size = {"$size": "$messages"}
+        start = {"$subtract": [{"$ifNull": ["$appended", size]}, size]}
+        try:
+            async with db_limiter.acquire():
+                await self._collection().update_one(
+                    {
+                        "_id": chat_id,
+                        # a summary of another worker may already cover more
+                        "$expr": {"$lt": [{"$ifNull": ["$folded", 0]}, end]},
+                    },
+                    [
+                        {
+                            "$set": {
+                                "summary": summary,
+                                "folded": end,
+                                "messages": {
+                                    "$slice": [
+                                        "$messages",
+                                        {"$max": [0, {"$subtract": [end, start]}]},
+                                        {"$max": [1, size]},
+                                    ]
+                                },
+                            }
+                        }
+                    ],
+                )
+        except Exception as e:
+            logging.error(f"Failed to save the summary of chat session {chat_id}: {e}")
+            self.errors += 1
+
+    def stats(self):
+        return {"store": self.name, "errors": self.errors}
+
+
+class FileSessionStore(SessionStore):
+    """
+    Sessions stored as JSON files in a local directory, e.g. a volume shared by the workers.
+
+    A stand-in for the MongoDB store in single host deployments. Files are replaced
+    atomically, but two exchanges of the same session finishing at the same time can
+    lose one of them.
+    """
+
+    name = "file"
+
+    def __init__(self, directory=SESSION_FILE_DIRECTORY, ttl=SESSION_TTL):
+        self.directory = directory
+        self.ttl = ttl
+        self.errors = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, chat_id):
+        # the chat id comes from the request, never use it as a file name directly
+        digest = hashlib.sha256(chat_id.encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, f"{digest}.json")
+
+    def _read(self, path):
+        try:
+            if os.path.getmtime(path) + self.ttl <= time.time():
+                os.remove(path)
+                return None
+            with open(path, encoding="utf-8") as file:
+                session = json.load(file)
+            # sessions saved before positions were tracked
+            session.setdefault("start", 0)
+            return session
+        except FileNotFoundError:
+            return None
+
+    def _write(self, path, session):
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as file:
+            json.dump(session, file, ensure_ascii=False)
+        os.replace(temporary_path, path)
+
+    def _append(self, path, messages):
+        self._write(path, append_messages(self._read(path) or new_session(), messages))
+
+    def _fold(self, path, summary, end):
+        session = self._read(path)
+        if session is not None:
+            self._write(path, fold_messages(session, summary, end))
+
+    async def load(self, chat_id):
+        try:
+            return await asyncio.to_thread(self._read, self._path(chat_id))
+        except Exception as e:
+            logging.error(f"Failed to load chat session {chat_id}: {e}")
+            self.errors += 1
+            return None
+
+    async def append(self, chat_id, messages):
+        try:
+            await asyncio.to_thread(self._append, self._path(chat_id), messages)
+        except Exception as e:
+            logging.error(f"Failed to save chat session {chat_id}: {e}")
+            self.errors += 1
+
+    async def fold(self, chat_id, summary, end):
+        try:
+            await asyncio.to_thread(self._fold, self._path(chat_id), summary, end)
+        except Exception as e:
+            logging.error(f"Failed to save the summary of chat session {chat_id}: {e}")
+            self.errors += 1
+
+    def stats(self):
+        return {"store": self.name, "errors": self.errors}
+
+
+SESSION_STORES = {
+    MemorySessionStore.name: MemorySessionStore,
+    MongoSessionStore.name: MongoSessionStore,
+    FileSessionStore.name: FileSessionStore,
+}
+
+session_store = SESSION_STORES[SESSION_STORE]()
+register_metrics("sessions", lambda: session_store.stats())
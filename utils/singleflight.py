@@ -0,0 +1,61 @@
+# This file contains the request coalescing used to flatten bursts of identical requests
+# When many users ask the same question at once, only the first request runs the work and
+# the concurrent identical ones wait for its result instead of repeating it.
+
+import asyncio
+
+
+class SingleFlight:
+    """
+    Shares the result of an in-flight call with every concurrent call of the same key.
+
+    The shared work runs as its own task, so a waiting request being cancelled (e.g. a
+    disconnected client) doesn't cancel it for the others. Exceptions are shared too.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        # key -> task of the in-flight call
+        self._calls = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    def in_flight(self, key):
+        return key in self._calls
+
+    async def do(self, key, function):
+        """
+        Run `function()` unless a call of `key` is already in flight.
+
+        Returns:
+            tuple: (result, coalesced), coalesced is True if the result was shared.
+        """
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task), True
+
+        task = asyncio.ensure_future(function())
+        self._calls[key] = task
+        self.calls += 1
+        task.add_done_callback(lambda _: self._forget(key, task))
+        return await asyncio.shield(task), False
+
+    async def wait(self, key):
+        """Wait for the in-flight call of `key`. Returns (result, True), or (None, False) if none."""
+        task = self._calls.get(key)
+        if task is None:
+            return None, False
+        self.coalesced += 1
+        return await asyncio.shield(task), True
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def stats(self):
+        return {
+            "calls": self.calls,
+            "coalesced": self.coalesced,
+            "in_flight": len(self._calls),
+        }
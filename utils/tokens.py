@@ -0,0 +1,12 @@
+# This file contains the token estimate used to budget LLM prompts
+# It avoids pulling in a provider specific tokenizer, roughly 4 characters make a token
+# for the models and languages used by the app.
+
+CHARS_PER_TOKEN = 4
+
+
+def count_tokens(text):
+    """Estimate the number of LLM tokens of a text."""
+    if not text:
+        return 0
+    return -(-len(text) // CHARS_PER_TOKEN)
@@ -1,60 +1,146 @@
 # This is the translation utility that will be used to translate the questions and answers to different languages.
+# In "structured" mode a question and its answer are translated together with one LLM call
+# per target language returning JSON, and the target languages are translated concurrently.
+
+import asyncio
+import json
+import logging
 
-import os
 from constants import *
-from groq import Groq
-from openai import OpenAI
-from google import genai
+from utils.concurrency import ConcurrencyLimiter
+from utils.llm_router import llm_router
+from utils.metrics import increment, register_metrics, timer
+from utils.translation_cache import translation_cache, translation_cache_key
 
-# Track which API is active
-ACTIVE_API = None
+# Bounds the translation calls of all requests, the chat shares the same providers
+translation_limiter = ConcurrencyLimiter("translation", TRANSLATION_CONCURRENCY)
 
-# USE client based on the API KEY and MODEL
-if os.environ.get("GROQ_API_KEY") != None:
-    client = Groq(
-        api_key=os.environ.get("GROQ_API_KEY"),
-    )
-    ACTIVE_API = "groq"
-    print("GROQ Instance Created")
-elif os.environ.get("OPENAI_API_KEY") != None:
-    client = OpenAI(
-        api_key=os.environ.get("OPENAI_API_KEY"),
-    )
-    ACTIVE_API = "openai"
-    print("OpenAI Instance Created")
-elif os.environ.get("GOOGLE_API_KEY") != None:
-    client = genai.Client(api_key=os.environ.get("GOOGLE_API_KEY"))
-    ACTIVE_API = "google"
-    print("Google Generative AI Instance Created")
-else:
-    print(f"LLM Error: API Key not found")
+
+async def with_retries(function):
+    """Call `function()`, retrying failures with an exponential backoff."""
+    for attempt in range(TRANSLATION_RETRIES + 1):
+        try:
+            return await function()
+        except Exception as e:
+            if attempt == TRANSLATION_RETRIES:
+                raise
+            increment("translation.retries")
+            logging.warning(f"Translation failed, retrying: {e!r}")
+            await asyncio.sleep(TRANSLATION_RETRY_DELAY * 2**attempt)
 
 
-def translate_text(text: str, source_lang: str, target_lang: str) -> str:
+async def translate_text(text: str, source_lang: str, target_lang: str) -> str:
     """
     Translate text from source_lang to target_lang using the language model.
+
+    The call goes through the LLM router, like the chat, so it shares the providers'
+    limits and fails over to another provider. Translations are cached.
     """
+    key = translation_cache_key(text, source_lang, target_lang)
+    translation = await translation_cache.get(key)
+    if translation is None:
+        translation = await llm_translate_text(text, source_lang, target_lang)
+        await translation_cache.set(key, translation)
+    return translation
+
+
+async def llm_translate_text(text: str, source_lang: str, target_lang: str) -> str:
     prompt = f"Translate the following text from {source_lang} to {target_lang} and only give translation in output and nothing else:\n\n{text}"
 
-    if ACTIVE_API == "google":
-        response = client.models.generate_content(model=MODEL, contents=prompt)
-        return response.text.strip()
-
-    # Default behavior for OpenAI and Groq
-    chat_completion = client.chat.completions.create(
-        messages=[
-            {
-                "role": "user",
-                "content": prompt,
-            }
-        ],
-        model=MODEL,
+    async def call():
+        async with translation_limiter.acquire():
+            with timer("translation.llm"):
+                return await llm_router.ainvoke(prompt)
+
+    response = await with_retries(call)
+    return response.content.strip()
+
+
+def parse_translation(content):
+    """Parse the JSON object of a structured translation, tolerating code fences."""
+    start, end = content.find("{"), content.rfind("}")
+    if start == -1 or end < start:
+        raise ValueError(f"No JSON object in the translation: {content[:200]!r}")
+    translation = json.loads(content[start : end + 1])
+    if not isinstance(translation.get("question"), str) or not isinstance(
+        translation.get("answer"), str
+    ):
+        raise ValueError(f"Incomplete translation: {content[:200]!r}")
+    return translation["question"].strip(), translation["answer"].strip()
+
+
+async def translate_pair(question: str, answer: str, source_lang: str, target_lang: str):
+    """
+    Translate a question and its answer with a single LLM call.
+
+    Falls back to translating them separately if no valid JSON comes back after the
+    retries.
+
+    Returns:
+        tuple: (question, answer) in target_lang.
+    """
+    keys = [
+        translation_cache_key(question, source_lang, target_lang),
+        translation_cache_key(answer, source_lang, target_lang),
+    ]
+    cached = await translation_cache.get_many(keys)
+    if cached:
+        # only translate what changed, e.g. an edited answer
+        translation = [
+            cached[key]
+            if key in cached
+            else await llm_translate_text(text, source_lang, target_lang)
+            for key, text in zip(keys, (question, answer))
+        ]
+        await translation_cache.set_many(
+            {key: text for key, text in zip(keys, translation) if key not in cached}
+        )
+        return tuple(translation)
+
+    prompt = (
+        f"Translate the question and the answer of the following JSON object from "
+        f"{source_lang} to {target_lang}. Only give a JSON object with the keys "
+        f'"question" and "answer" in output and nothing else:\n\n'
+        f"{json.dumps({'question': question, 'answer': answer}, ensure_ascii=False)}"
     )
-    return chat_completion.choices[0].message.content.strip()
+
+    async def call():
+        async with translation_limiter.acquire():
+            with timer("translation.llm"):
+                response = await llm_router.ainvoke(prompt)
+        return parse_translation(response.content)
+
+    try:
+        translation = await with_retries(call)
+    except ValueError as e:
+        logging.error(f"Structured translation to {target_lang} failed: {e!r}")
+        increment("translation.fallbacks")
+        translation = await asyncio.gather(
+            llm_translate_text(question, source_lang, target_lang),
+            llm_translate_text(answer, source_lang, target_lang),
+        )
+    await translation_cache.set_many(dict(zip(keys, translation)))
+    return translation
 
 
-def translate_to_all_languages(data: dict) -> dict:
-    languages = ["en", "hu", "de"]
+async def translate_language(data: dict, source_lang: str, lang: str):
+    """Return the (question, answer) of `lang`, translating the missing ones."""
+    question = data.get(f"question_{lang}")
+    answer = data.get(f"answer_{lang}")
+    source_question = data[f"question_{source_lang}"]
+    source_answer = data[f"answer_{source_lang}"]
+
+    if not question and not answer and TRANSLATION_MODE == "structured":
+        return await translate_pair(source_question, source_answer, source_lang, lang)
+    if not question:
+        question = await translate_text(source_question, source_lang, lang)
+    if not answer:
+        answer = await translate_text(source_answer, source_lang, lang)
+    return question, answer
+
+
+async def translate_to_all_languages(data: dict) -> dict:
+    languages = SUPPORTED_LANGUAGES
     translated = {}
 
     # Identify the source language
@@ -71,12 +157,19 @@ def translate_to_all_languages(data: dict) -> dict:
             "At least one pair of question and answer must be provided in the same language."
         )
 
-    for lang in languages:
-        translated[f"{lang}_question"] = data.get(f"question_{lang}") or translate_text(
-            data[f"question_{source_lang}"], source_lang, lang
-        )
-        translated[f"{lang}_answer"] = data.get(f"answer_{lang}") or translate_text(
-            data[f"answer_{source_lang}"], source_lang, lang
+    # the target languages are translated concurrently
+    with timer("translation.all_languages"):
+        pairs = await asyncio.gather(
+            *(translate_language(data, source_lang, lang) for lang in languages)
         )
+    for lang, (question, answer) in zip(languages, pairs):
+        translated[f"{lang}_question"] = question
+        translated[f"{lang}_answer"] = answer
 
     return translated
+
+
+register_metrics(
+    "translation",
+    lambda: dict(mode=TRANSLATION_MODE, **translation_limiter.stats()),
+)
@@ -0,0 +1,145 @@
+# This file contains the cache of LLM translations
+# A translation is keyed by a hash of the source text, the two languages and the models,
+# so re-ingesting an edited question or adding a near-identical one only translates the
+# text that changed. Entries live in an in-memory LRU in front of a MongoDB collection
+# shared by the workers and kept across restarts.
+
+import hashlib
+import json
+import logging
+from datetime import datetime
+
+from pymongo import ReplaceOne
+
+from constants import (
+    DB_NAME,
+    TRANSLATION_CACHE_COLLECTION,
+    TRANSLATION_CACHE_ENABLED,
+    TRANSLATION_CACHE_PERSISTENT,
+    TRANSLATION_CACHE_SIZE,
+)
+from utils.cache import LRUCache
+from utils.concurrency import db_limiter
+from utils.llm_router import MODELS
+from utils.metrics import register_metrics
+from utils.mongo_client import mongo_manager
+
+
+def translation_cache_key(text, source_lang, target_lang):
+    key = json.dumps([text.strip(), source_lang, target_lang, MODELS], ensure_ascii=False)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+class TranslationCache:
+    """In-memory LRU of translations in front of an optional MongoDB collection."""
+
+    def __init__(
+        self,
+        maxsize=TRANSLATION_CACHE_SIZE,
+        persistent=TRANSLATION_CACHE_PERSISTENT,
+    ):
+        self.persistent = persistent
+        self.memory = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.persistent_hits = 0
+        self.errors = 0
+
+    def _collection(self):
+        return mongo_manager.async_client()[DB_NAME][TRANSLATION_CACHE_COLLECTION]
+
+    async def get_many(self, keys):
+        """Return the cached translations of `keys` as a dict, missing keys are left out."""
+        if not TRANSLATION_CACHE_ENABLED:
+            return {}
+        found = {}
+        for key in keys:
+            translation = self.memory.get(key)
+            if translation is not None:
+                found[key] = translation
+
+        missing = [key for key in keys if key not in found]
+        if missing and self.persistent:
+            try:
+                async with db_limiter.acquire():
+                    documents = await self._collection().find(
+                        {"_id": {"$in": missing}}, {"translation": 1}
+                    ).to_list(length=None)
+            except Exception as e:
+                logging.error(f"Failed to read the translation cache: {e}")
+                self.errors += 1
+                documents = []
+            for document in documents:
+                found[document["_id"]] = document["translation"]
+                self.memory.set(document["_id"], document["translation"])
+                self.persistent_hits += 1
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    async def get(self, key):
+        return (await self.get_many([key])).get(key)
+
+    async def set_many(self, translations):
+        """Cache a dict of key -> translation."""
+        if not TRANSLATION_CACHE_ENABLED or not translations:
+            return
+        for key, translation in translations.items():
+            self.memory.set(key, translation)
+        if not self.persistent:
+            return
+
+        now = datetime.utcnow()
+        try:
+            async with db_limiter.acquire():
+                await self._collection().bulk_write(
+                    [
+                        ReplaceOne(
+                            {"_id": key},
+                            {"translation": translation, "created_at": now},
+                            upsert=True,
+                        )
+                        for key, translation in translations.items()
+                    ],
+                    ordered=False,
+                )
+        except Exception as e:
+            logging.error(f"Failed to write the translation cache: {e}")
+            self.errors += 1
+
+    async def set(self, key, translation):
+        await self.set_many({key: translation})
+
+    def purge(self, client=None):
+        """
+        Drop every cached translation.
+
+        The persistent tier is only purged when a (sync) `client` is given, the memory
+        tier of other worker processes is not affected.
+
+        Returns:
+            int: The number of persistent entries deleted.
+        """
+        self.memory.clear()
+        if not self.persistent or client is None:
+            return 0
+        result = client[DB_NAME][TRANSLATION_CACHE_COLLECTION].delete_many({})
+        return result.deleted_count
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "enabled": TRANSLATION_CACHE_ENABLED,
+            "persistent": self.persistent,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "persistent_hits": self.persistent_hits,
+            "errors": self.errors,
+            "memory": self.memory.stats(),
+        }
+
+
+translation_cache = TranslationCache()
+register_metrics("translation_cache", translation_cache.stats)
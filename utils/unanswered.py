@@ -0,0 +1,263 @@
+# This file tracks the questions that were not found in the knowledge base
+# Misses are clustered in process with MinHash/LSH, so near-identical phrasings count
+# towards the same unanswered question, and are written to the database in batches by
+# a background thread instead of searching and inserting on the request path.
+
+import logging
+import threading
+import zlib
+from datetime import datetime
+
+import numpy as np
+from bson import ObjectId
+from pymongo import UpdateOne
+
+from constants import (
+    DB_NAME,
+    UNANSWERED_QUESTIONS_COLLECTION,
+    UNANSWERED_SIMILARITY_THRESHOLD,
+    UNANSWERED_FLUSH_INTERVAL,
+    UNANSWERED_MAX_SAMPLES,
+)
+from utils.metrics import increment, register_metrics
+from utils.vector_index import char_ngrams
+
+# MinHash parameters, 16 bands of 4 rows find pairs above ~0.5 Jaccard similarity
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+SHINGLE_SIZES = (3,)
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+class MinHashLSH:
+    """MinHash signatures of character shingles indexed with locality sensitive hashing."""
+
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, num_bands=NUM_BANDS, seed=1):
+        self.num_bands = num_bands
+        self.rows = num_permutations // num_bands
+        # a < 2^31 and shingle hashes < 2^32, so (a * x + b) never overflows 64 bits
+        generator = np.random.default_rng(seed)
+        self._a = generator.integers(1, 1 << 31, num_permutations, dtype=np.uint64)
+        self._b = generator.integers(0, 1 << 32, num_permutations, dtype=np.uint64)
+        # key -> signature, band -> bucket -> keys
+        self._signatures = {}
+        self._buckets = [{} for _ in range(num_bands)]
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def signature(self, text):
+        shingles = np.fromiter(
+            {zlib.crc32(shingle.encode()) for shingle in char_ngrams(text, SHINGLE_SIZES)},
+            dtype=np.uint64,
+        )
+        if not len(shingles):
+            shingles = np.zeros(1, dtype=np.uint64)
+        # (a * x + b) mod p for every permutation and shingle
+        hashes = (self._a[:, None] * shingles[None, :] + self._b[:, None]) % np.uint64(
+            MERSENNE_PRIME
+        )
+        return hashes.min(axis=1)
+
+    def _band_keys(self, signature):
+        for band in range(self.num_bands):
+            yield band, signature[band * self.rows : (band + 1) * self.rows].tobytes()
+
+    def add(self, key, signature):
+        self._signatures[key] = signature
+        for band, band_key in self._band_keys(signature):
+            self._buckets[band].setdefault(band_key, set()).add(key)
+
+    def remove(self, key):
+        signature = self._signatures.pop(key, None)
+        if signature is None:
+            return False
+        for band, band_key in self._band_keys(signature):
+            bucket = self._buckets[band].get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][band_key]
+        return True
+
+    def query(self, signature, threshold):
+        """Return the (key, estimated Jaccard similarity) of the most similar entry, or None."""
+        candidates = set()
+        for band, band_key in self._band_keys(signature):
+            candidates.update(self._buckets[band].get(band_key, ()))
+
+        best = None
+        for key in candidates:
+            similarity = float(np.mean(self._signatures[key] == signature))
+            if similarity >= threshold and (best is None or similarity > best[1]):
+                best = (key, similarity)
+        return best
+
+
+class UnansweredRecorder:
+    """
+    Clusters unanswered questions and flushes their counts in batches.
+
+    Every cluster is one document of the unanswered questions collection holding
+    the first phrasing as `question`, a `count`, `first_seen` / `last_seen` and a
+    few `samples` of other phrasings.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._lsh = MinHashLSH()
+        # cluster_id -> pending update
+        self._pending = {}
+        # cluster_id -> phrasings already sampled by this process
+        self._sampled = {}
+        self._client = None
+        self._stop = threading.Event()
+        self._thread = None
+
+        self.flushed_batches = 0
+        self.flush_errors = 0
+
+    def load(self, client):
+        """Seed the clusters with the unanswered questions already stored."""
+        collection = client[DB_NAME][UNANSWERED_QUESTIONS_COLLECTION]
+        with self._lock:
+            for document in collection.find({}, {"question": 1}):
+                if document.get("question"):
+                    self._lsh.add(
+                        document["_id"], self._lsh.signature(document["question"])
+                    )
+        logging.info(f"Loaded {len(self._lsh)} unanswered question clusters")
+
+    def record(self, question, lang=None):
+        """Count a miss towards the cluster of its closest phrasing. Returns the cluster id."""
+        signature = self._lsh.signature(question)
+        now = datetime.utcnow()
+        with self._lock:
+            match = self._lsh.query(signature, UNANSWERED_SIMILARITY_THRESHOLD)
+            if match is None:
+                cluster_id = ObjectId()
+                self._lsh.add(cluster_id, signature)
+                increment("unanswered.new_clusters")
+            else:
+                cluster_id = match[0]
+                increment("unanswered.clustered_misses")
+
+            pending = self._pending.get(cluster_id)
+            if pending is None:
+                pending = self._pending[cluster_id] = {
+                    "question": question,
+                    "lang": lang,
+                    "count": 0,
+                    "first_seen": now,
+                    "samples": [],
+                }
+            pending["count"] += 1
+            pending["last_seen"] = now
+
+            sampled = self._sampled.setdefault(cluster_id, set())
+            if (
+                match is not None
+                and question not in sampled
+                and len(sampled) < UNANSWERED_MAX_SAMPLES
+            ):
+                sampled.add(question)
+                pending["samples"].append(question)
+        return cluster_id
+
+    def remove(self, cluster_id):
+        """Forget a cluster, e.g. after its document was deleted."""
+        cluster_id = ObjectId(cluster_id)
+        with self._lock:
+            self._lsh.remove(cluster_id)
+            self._pending.pop(cluster_id, None)
+            self._sampled.pop(cluster_id, None)
+
+    def flush(self, client=None):
+        """Write the pending counts with one bulk write of `$inc` upserts."""
+        client = client or self._client
+        if client is None:
+            return 0
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        operations = [
+            UpdateOne(
+                {"_id": cluster_id},
+                {
+                    "$inc": {"count": update["count"]},
+                    "$setOnInsert": {
+                        "question": update["question"],
+                        "lang": update["lang"],
+                    },
+                    "$min": {"first_seen": update["first_seen"]},
+                    "$max": {"last_seen": update["last_seen"]},
+                    "$push": {
+                        "samples": {
+                            "$each": update["samples"],
+                            "$slice": -UNANSWERED_MAX_SAMPLES,
+                        }
+                    },
+                },
+                upsert=True,
+            )
+            for cluster_id, update in pending.items()
+        ]
+        try:
+            collection = client[DB_NAME][UNANSWERED_QUESTIONS_COLLECTION]
+            collection.bulk_write(operations, ordered=False)
+            self.flushed_batches += 1
+            return len(operations)
+        except Exception as e:
+            logging.error(f"Failed to flush unanswered questions: {e}")
+            self.flush_errors += 1
+            self._requeue(pending)
+            return 0
+
+    def _requeue(self, pending):
+        with self._lock:
+            for cluster_id, update in pending.items():
+                current = self._pending.get(cluster_id)
+                if current is None:
+                    self._pending[cluster_id] = update
+                    continue
+                current["count"] += update["count"]
+                current["first_seen"] = min(current["first_seen"], update["first_seen"])
+                current["samples"] = update["samples"] + current["samples"]
+
+    def start(self, client):
+        """Load the stored clusters and start the background flush thread."""
+        self._client = client
+        self.load(client)
+        self._stop.clear()
+        self._thread = threading.Thread(
+            target=self._run, name="unanswered-flush", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background thread and flush what is left."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(UNANSWERED_FLUSH_INTERVAL):
+            self.flush()
+
+    def stats(self):
+        with self._lock:
+            pending = sum(update["count"] for update in self._pending.values())
+        return {
+            "clusters": len(self._lsh),
+            "pending_misses": pending,
+            "flushed_batches": self.flushed_batches,
+            "flush_errors": self.flush_errors,
+        }
+
+
+unanswered_recorder = UnansweredRecorder()
+register_metrics("unanswered", unanswered_recorder.stats)
@@ -0,0 +1,137 @@
+# This file contains the character n-gram vector index used by the hybrid retrieval backend
+# Texts are embedded locally as hashed character n-gram TF-IDF vectors, so typos and
+# paraphrases still share most of their features without any external embedding service.
+
+import threading
+import unicodedata
+import zlib
+
+import numpy as np
+
+from utils.cache import normalize_text
+
+NGRAM_SIZES = (3, 4)
+# rows allocated per index, the matrix doubles when they are used up
+INITIAL_CAPACITY = 128
+
+
+def fold_text(text):
+    """Normalize text and strip diacritics, so "zurucksetzen" matches "zurücksetzen"."""
+    text = unicodedata.normalize("NFKD", normalize_text(text))
+    return "".join(char for char in text if not unicodedata.combining(char))
+
+
+def char_ngrams(text, sizes=NGRAM_SIZES):
+    """Return the character n-grams of the folded text, padded at word boundaries."""
+    text = f" {fold_text(text)} "
+    for size in sizes:
+        for start in range(len(text) - size + 1):
+            yield text[start : start + size]
+
+
+class NgramVectorIndex:
+    """
+    Hashed character n-gram TF-IDF vectors kept in a float32 matrix.
+
+    Rows store the sublinear term frequencies of each document and the IDF weights are
+    applied at query time, so adding or removing a document only touches its own row and
+    the document frequencies. Scoring a query is one matrix-vector product.
+    """
+
+    def __init__(self, dim, capacity=INITIAL_CAPACITY):
+        self.dim = dim
+        self._lock = threading.Lock()
+        self._matrix = np.zeros((capacity, dim), dtype=np.float32)
+        # number of documents containing each feature
+        self._df = np.zeros(dim, dtype=np.float32)
+        # doc_id -> row, row -> doc_id
+        self._rows = {}
+        self._row_ids = []
+        self._free_rows = []
+        # per row norms of the IDF weighted vectors, recomputed lazily after changes
+        self._norms = None
+
+    def __len__(self):
+        return len(self._rows)
+
+    def vectorize(self, text):
+        """Return the sublinear term frequency vector of a text."""
+        # crc32 rather than hash(), which is salted per process, so every worker and
+        # every run maps an n-gram to the same feature
+        features = np.fromiter(
+            (zlib.crc32(ngram.encode()) % self.dim for ngram in char_ngrams(text)),
+            dtype=np.int64,
+        )
+        counts = np.bincount(features, minlength=self.dim).astype(np.float32)
+        return np.log1p(counts, out=counts)
+
+    def add(self, doc_id, text):
+        """Add or replace the vector of a document."""
+        vector = self.vectorize(text)
+        with self._lock:
+            self._remove(doc_id)
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = len(self._row_ids)
+                if row == self._matrix.shape[0]:
+                    self._grow()
+                self._row_ids.append(None)
+            self._matrix[row] = vector
+            self._df += vector > 0
+            self._rows[doc_id] = row
+            self._row_ids[row] = doc_id
+            self._norms = None
+
+    def remove(self, doc_id):
+        with self._lock:
+            return self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        row = self._rows.pop(doc_id, None)
+        if row is None:
+            return False
+        self._df -= self._matrix[row] > 0
+        self._matrix[row] = 0
+        self._row_ids[row] = None
+        self._free_rows.append(row)
+        self._norms = None
+        return True
+
+    def _grow(self):
+        matrix = np.zeros((self._matrix.shape[0] * 2, self.dim), dtype=np.float32)
+        matrix[: self._matrix.shape[0]] = self._matrix
+        self._matrix = matrix
+
+    def _idf(self):
+        return np.log((1 + len(self._rows)) / (1 + self._df)) + 1
+
+    def search(self, text, limit):
+        """Return up to `limit` (doc_id, cosine similarity) pairs, best first."""
+        query = self.vectorize(text)
+        with self._lock:
+            used = len(self._row_ids)
+            if not self._rows or not query.any():
+                return []
+            idf_squared = np.square(self._idf())
+            matrix = self._matrix[:used]
+            if self._norms is None:
+                self._norms = np.sqrt(np.square(matrix) @ idf_squared)
+            query_norm = np.sqrt(np.square(query) @ idf_squared)
+
+            dots = matrix @ (query * idf_squared)
+            similarities = np.divide(
+                dots,
+                self._norms * query_norm,
+                out=np.zeros_like(dots),
+                where=self._norms > 0,
+            )
+
+            limit = min(limit, used)
+            top_rows = np.argpartition(-similarities, limit - 1)[:limit]
+            top_rows = top_rows[np.argsort(-similarities[top_rows])]
+            return [
+                (self._row_ids[row], float(similarities[row]))
+                for row in top_rows
+                if self._row_ids[row] is not None and similarities[row] > 0
+            ]